@@ -17,6 +17,8 @@ from flask import Flask
 from config import PORT, DEBUG, get_logger
 from routes import register_routes
 from services.scheduler import init_scheduler
+from services.outbox import start_replayer
+from database.write_buffer import start_write_buffer
 
 # Initialize logger
 logger = get_logger(__name__)
@@ -35,6 +37,12 @@ try:
 except Exception as e:
     logger.error(f"❌ Failed to initialize scheduler: {e}")
 
+# Resend LINE messages left in the outbox by an earlier run
+start_replayer()
+
+# Write sheet rows an earlier run accepted but never appended
+start_write_buffer()
+
 # Log startup information
 logger.info("=" * 60)
 logger.info("KwanNurse-Bot v4.0 - COMPLETE!")
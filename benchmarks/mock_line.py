@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Mock LINE Messaging API
+Local stand-in for the push and multicast endpoints
+
+Accepts what services/notification.py sends and records every request.
+Latency, server errors and rate limiting (429 with Retry-After) can be
+injected to exercise the connection pool and retry paths. A repeat of an
+accepted X-Line-Retry-Key gets 409 with x-line-accepted-request-id, as
+on the real API. Point the bot at it with LINE_API_BASE_URL.
+
+Usage:
+    python -m benchmarks.mock_line --port 8089 --latency-ms 80 --error-rate 0.05
+    LINE_API_BASE_URL=http://127.0.0.1:8089 CHANNEL_ACCESS_TOKEN=test python app.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ENDPOINTS = {
+    '/v2/bot/message/push': 'push',
+    '/v2/bot/message/multicast': 'multicast'
+}
+
+MULTICAST_MAX = 500  # Recipients per multicast call on the real API
+
+# One request as received: endpoint, parsed body, X-Line-Retry-Key, status
+# we answered, whether the message counts as delivered, and
+# time.monotonic() when it arrived
+Received = namedtuple('Received', ['endpoint', 'payload', 'retry_key', 'status', 'accepted', 'at'])
+
+SETTINGS = ('latency_ms', 'jitter_ms', 'error_rate', 'throttle_rate', 'lost_reply_rate', 'retry_after')
+
+
+class MockLineServer:
+    """
+    LINE API stand-in on a background thread
+
+    Args:
+        latency_ms: Delay before every reply
+        jitter_ms: Extra random delay, 0..jitter_ms
+        error_rate: Share of requests answered 500
+        throttle_rate: Share of requests answered 429
+        lost_reply_rate: Share of requests accepted but answered 500, as if
+                         the reply was lost (the client's retry gets 409)
+        retry_after: Retry-After seconds sent with a 429 (None = no header)
+        seed: Random seed, for repeatable fault patterns
+
+    Usage:
+        with MockLineServer(latency_ms=50, throttle_rate=0.1) as line:
+            os.environ["LINE_API_BASE_URL"] = line.url
+            ...
+            line.stats()
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, jitter_ms=0, error_rate=0.0,
+                 throttle_rate=0.0, lost_reply_rate=0.0, retry_after=1, seed=None):
+        self.received = []
+        self._accepted_keys = {}  # X-Line-Retry-Key -> request ID we answered with
+        self._connections = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.configure(latency_ms=latency_ms, jitter_ms=jitter_ms, error_rate=error_rate,
+                       throttle_rate=throttle_rate, lost_reply_rate=lost_reply_rate, retry_after=retry_after)
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def configure(self, **settings):
+        """Change any of SETTINGS while running"""
+        unknown = set(settings) - set(SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown settings: {sorted(unknown)}")
+        with self._lock:
+            for name, value in settings.items():
+                setattr(self, name, value)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-line", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset(self):
+        """Forget received requests, retry keys and connection counts"""
+        with self._lock:
+            self.received = []
+            self._accepted_keys = {}
+            self._connections = 0
+
+    def counts(self):
+        """Accepted requests per endpoint"""
+        with self._lock:
+            counts = {}
+            for request in self.received:
+                if request.accepted:
+                    counts[request.endpoint] = counts.get(request.endpoint, 0) + 1
+            return counts
+
+    def stats(self):
+        """
+        Summary of what was received
+
+        Returns:
+            dict: requests, by_status {status: count}, recipients (users
+                  reached by accepted requests) and connections opened
+        """
+        with self._lock:
+            received = list(self.received)
+            connections = self._connections
+        by_status = {}
+        recipients = 0
+        for request in received:
+            by_status[request.status] = by_status.get(request.status, 0) + 1
+            if request.accepted:
+                to = request.payload.get('to')
+                recipients += len(to) if isinstance(to, list) else 1
+        return {
+            'requests': len(received),
+            'by_status': by_status,
+            'recipients': recipients,
+            'connections': connections
+        }
+
+    def _connection_opened(self):
+        with self._lock:
+            self._connections += 1
+
+    def _respond(self, endpoint, headers, payload):
+        """(status, extra headers, body) for one request, recording it"""
+        with self._lock:
+            delay = (self.latency_ms + self._random.uniform(0, self.jitter_ms)) / 1000.0
+            roll = self._random.random()
+            error_rate, throttle_rate, retry_after = self.error_rate, self.throttle_rate, self.retry_after
+            lost_reply = roll >= throttle_rate + error_rate and self._random.random() < self.lost_reply_rate
+
+        if delay:
+            time.sleep(delay)
+
+        retry_key = headers.get('X-Line-Retry-Key')
+        extra = {}
+        if not headers.get('Authorization', '').startswith('Bearer '):
+            status, body = 401, {'message': 'Authentication failed. Confirm that the access token in the authorization header is valid.'}
+        elif _invalid(endpoint, payload):
+            status, body = 400, {'message': 'The request body has 1 error(s)', 'details': [{'message': _invalid(endpoint, payload)}]}
+        elif roll < throttle_rate:
+            status, body = 429, {'message': 'The API rate limit has been exceeded. Try again later.'}
+            if retry_after is not None:
+                extra['Retry-After'] = str(retry_after)
+        elif roll < throttle_rate + error_rate:
+            status, body = 500, {'message': 'Internal server error'}
+        else:
+            status, body = 200, {}
+
+        accepted = status == 200
+        with self._lock:
+            if accepted and retry_key:
+                accepted_id = self._accepted_keys.get(retry_key)
+                if accepted_id:
+                    accepted = False
+                    status, body = 409, {'message': 'The retry key is already accepted'}
+                    extra['x-line-accepted-request-id'] = accepted_id
+                else:
+                    self._accepted_keys[retry_key] = str(uuid.uuid4())
+            if accepted and lost_reply:
+                status, body = 500, {'message': 'Internal server error'}
+            self.received.append(Received(endpoint, payload, retry_key, status, accepted, time.monotonic()))
+
+        extra['x-line-request-id'] = str(uuid.uuid4())
+        return status, extra, body
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+            disable_nagle_algorithm = True  # Headers and body are separate writes
+
+            def setup(self):
+                super().setup()
+                server._connection_opened()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                endpoint = ENDPOINTS.get(self.path)
+                if endpoint is None:
+                    self._reply(404, {}, {'message': 'Not found'})
+                    return
+                try:
+                    payload = json.loads(body or b'{}')
+                except ValueError:
+                    self._reply(400, {}, {'message': 'The request body has 1 error(s)'})
+                    return
+                self._reply(*server._respond(endpoint, self.headers, payload))
+
+            def _reply(self, status, headers, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _invalid(endpoint, payload):
+    """Validation error for a request body, or None"""
+    to, messages = payload.get('to'), payload.get('messages')
+    if not messages or not isinstance(messages, list):
+        return "messages: must be specified"
+    if endpoint == 'push':
+        if not isinstance(to, str) or not to:
+            return "to: must be specified"
+    else:
+        if not isinstance(to, list) or not to:
+            return "to: must be specified"
+        if len(to) > MULTICAST_MAX:
+            return f"to: size must be between 0 and {MULTICAST_MAX}"
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock LINE Messaging API (push and multicast)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Share of requests answered 429")
+    parser.add_argument('--lost-reply-rate', type=float, default=0.0,
+                        help="Share of requests accepted but answered 500")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds on 429")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    line = MockLineServer(args.host, args.port, args.latency_ms, args.jitter_ms, args.error_rate,
+                          args.throttle_rate, args.lost_reply_rate, args.retry_after, args.seed).start()
+    print(f"Mock LINE API on {line.url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(line.stats()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        line.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Notification Benchmark
+LINE push throughput against the mock LINE server
+
+Scenarios (each sends one message to --messages recipients):
+    push        deliver_line_push from --concurrency threads (connection
+                pool, rate limiter and retries, no queue)
+    dispatched  send_line_push: outbox record plus dispatcher workers,
+                timed until the queue drains
+    multicast   deliver_line_multicast: recipients batched per call
+
+Faults are injected by the mock server, so retry and 429 handling can be
+measured under controlled conditions.
+
+Usage:
+    python -m benchmarks.notification_bench
+    python -m benchmarks.notification_bench --messages 1000 --latency-ms 80 --error-rate 0.05
+    python -m benchmarks.notification_bench --throttle-rate 0.1 --retry-after 0.2 --scenarios push
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.mock_line import MockLineServer
+from benchmarks.webhook_bench import configure_environment, percentile
+
+SCENARIOS = ('push', 'dispatched', 'multicast')
+
+MESSAGE = "🔔 ทดสอบการแจ้งเตือน (benchmark)"
+
+
+def _recipients(count):
+    return [f"Ubench{i:05d}" for i in range(count)]
+
+
+def run_push(count, concurrency):
+    """deliver_line_push per recipient; returns (delivered, per-call seconds)"""
+    # Imported here: config reads the environment at import time
+    from services.notification import deliver_line_push
+
+    def send(user_id):
+        started = time.perf_counter()
+        ok = deliver_line_push(MESSAGE, user_id)
+        return ok, time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, _recipients(count)))
+    return sum(1 for ok, _ in results if ok), [elapsed for _, elapsed in results]
+
+
+def run_dispatched(count, concurrency):
+    """send_line_push per recipient, then wait for the dispatcher"""
+    from services.dispatcher import drain
+    from services.notification import send_line_push
+
+    delivered = []
+    for user_id in _recipients(count):
+        send_line_push(MESSAGE, user_id, on_delivered=lambda ok, u=user_id: ok and delivered.append(u))
+    drain(600)
+    return len(delivered), []
+
+
+def run_multicast(count, concurrency):
+    """deliver_line_multicast to all recipients"""
+    from services.notification import deliver_line_multicast
+
+    started = time.perf_counter()
+    delivered = deliver_line_multicast(MESSAGE, _recipients(count))
+    return len(delivered), [time.perf_counter() - started]
+
+
+RUNNERS = {
+    'push': run_push,
+    'dispatched': run_dispatched,
+    'multicast': run_multicast
+}
+
+
+def benchmark(line, scenarios, count, concurrency):
+    """
+    Run each scenario against a freshly reset mock server
+
+    Returns:
+        dict: {scenario: {delivered, seconds, per_second, line_requests,
+                          by_status, connections, retries, p50_ms, p95_ms,
+                          accepted (recipients LINE accepted, duplicates included)}}
+    """
+    from utils.ratelimit import get_limiter
+
+    limiter = get_limiter('line')
+    results = {}
+    for name in scenarios:
+        line.reset()
+        retries_before = limiter.stats()['retries']
+
+        started = time.perf_counter()
+        delivered, latencies = RUNNERS[name](count, concurrency)
+        seconds = time.perf_counter() - started
+
+        stats = line.stats()
+        latencies.sort()
+        results[name] = {
+            'delivered': delivered,
+            'seconds': round(seconds, 3),
+            'per_second': round(delivered / seconds, 1) if seconds else 0.0,
+            'line_requests': stats['requests'],
+            'accepted': stats['recipients'],
+            'by_status': stats['by_status'],
+            'connections': stats['connections'],
+            'retries': limiter.stats()['retries'] - retries_before,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2)
+        }
+    return results
+
+
+def print_report(results, count):
+    columns = ('delivered', 'accepted', 'seconds', 'per_second', 'line_requests',
+               'connections', 'retries', 'p50_ms', 'p95_ms')
+    print(f"{'scenario':<12} " + " ".join(f"{c:>13}" for c in columns) + "  statuses")
+    for name, result in results.items():
+        print(f"{name:<12} " + " ".join(f"{result[c]:>13}" for c in columns) + f"  {result['by_status']}")
+    print(f"\n{count} recipients per scenario")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="LINE notification throughput against a mock LINE API")
+    parser.add_argument('--messages', type=int, default=500, help="Recipients per scenario")
+    parser.add_argument('--concurrency', type=int, default=8, help="Sender threads for the push scenario")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="Comma-separated: " + ", ".join(SCENARIOS))
+    parser.add_argument('--latency-ms', type=float, default=20, help="Mock server reply delay")
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Share of requests answered 429")
+    parser.add_argument('--lost-reply-rate', type=float, default=0.0,
+                        help="Share of requests accepted but answered 500 (exercises X-Line-Retry-Key)")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds on 429")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--line-rps', type=float, help="Client-side LINE rate limit (default: unlimited)")
+    parser.add_argument('--json', help="Write results to this file")
+    parser.add_argument('--verbose', action='store_true', help="Keep the bot's INFO logging")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+
+    line = MockLineServer(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                          throttle_rate=args.throttle_rate, lost_reply_rate=args.lost_reply_rate,
+                          retry_after=args.retry_after, seed=args.seed).start()
+    configure_environment(tempfile.mkdtemp(prefix='kwannurse-bench-'), line.url)
+    if args.line_rps:
+        os.environ['LINE_REQUESTS_PER_SECOND'] = str(args.line_rps)
+        os.environ['LINE_BURST'] = str(max(1, int(args.line_rps)))
+    if not args.verbose:
+        logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+
+    try:
+        results = benchmark(line, scenarios, args.messages, args.concurrency)
+        print_report(results, args.messages)
+    finally:
+        line.stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'messages': args.messages, 'results': results}, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
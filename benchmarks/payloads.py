@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Dialogflow Payloads
+Build webhook request bodies from the agent export
+
+Each training phrase of a webhook intent in "KWAN_BOT's Dialogflow/intents"
+becomes one request, with its annotated parameters resolved the way
+Dialogflow would (entity synonyms to values, dates and times to ISO) and
+required parameters it doesn't annotate filled in, since Dialogflow only
+calls the webhook once slot filling is done.
+"""
+import json
+import os
+import re
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "KWAN_BOT's Dialogflow")
+
+BANGKOK = timezone(timedelta(hours=7))
+
+# One training phrase, ready to send
+Sample = namedtuple('Sample', ['intent', 'query_text', 'params'])
+
+# Values for required parameters a phrase doesn't annotate (rotated per phrase)
+DEFAULT_VALUES = {
+    'pain_score': [3, 5, 8],
+    'age': [45, 60, 72],
+    'weight': [58, 70, 92],
+    'height': [155, 165, 175],
+    'fever_check': ['ไม่มีไข้', 'มีไข้ตัวร้อน'],
+    'reason': ['ทำแผล', 'ตรวจแผลผ่าตัด']
+}
+
+# Intents the webhook handles that the export doesn't contain (added by
+# rich menu / follow-up flows): (query text, parameters)
+EXTRA_SAMPLES = {
+    'ContactNurse': [("ปรึกษาพยาบาล", {}), ("2", {'issue_category': '2'}), ("แผล", {'issue_category': '3'})],
+    'CancelConsultation': [("ยกเลิก", {})],
+    'GetFollowUpSummary': [("สรุปการติดตาม", {})]
+}
+
+
+def _load_json(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_entities(export_dir=EXPORT_DIR):
+    """
+    Custom entities of the agent
+
+    Returns:
+        dict: {entity name: [(value, [synonyms]), ...]}
+    """
+    entities = {}
+    entity_dir = os.path.join(export_dir, 'entities')
+    for filename in sorted(os.listdir(entity_dir)):
+        if filename.endswith('.json') and '_entries_' not in filename:
+            name = filename[:-len('.json')]
+            entries_path = os.path.join(entity_dir, f"{name}_entries_th.json")
+            if os.path.exists(entries_path):
+                entities[name] = [(e['value'], e.get('synonyms', [])) for e in _load_json(entries_path)]
+    return entities
+
+
+def _resolve(data_type, text, entities, index):
+    """Parameter value Dialogflow would send for an annotated span"""
+    if data_type == '@sys.number':
+        match = re.search(r'\d+(?:\.\d+)?', text)
+        if not match:
+            return None
+        number = float(match.group())
+        return int(number) if number.is_integer() else number
+
+    if data_type == '@sys.date':
+        # Always a future date, so appointments take the full path
+        day = datetime.now(tz=BANGKOK).date() + timedelta(days=1 + index % 7)
+        return f"{day.isoformat()}T12:00:00+07:00"
+
+    if data_type == '@sys.time':
+        match = re.search(r'(\d{1,2})[:.](\d{2})', text)
+        hour, minute = (int(match.group(1)), int(match.group(2))) if match else (10, 0)
+        day = datetime.now(tz=BANGKOK).date() + timedelta(days=1)
+        return f"{day.isoformat()}T{hour:02d}:{minute:02d}:00+07:00"
+
+    if data_type == '@sys.phone-number':
+        return re.sub(r'\D', '', text)
+
+    if data_type == '@sys.person':
+        return {'name': text}
+
+    entity = entities.get(data_type.lstrip('@'))
+    if entity:
+        lowered = text.strip().lower()
+        for value, synonyms in entity:
+            if lowered == value.lower() or lowered in (s.lower() for s in synonyms):
+                return value
+    return text
+
+
+def _default(param, entities, index):
+    """Value for a required parameter the phrase doesn't annotate"""
+    if param['name'] in DEFAULT_VALUES:
+        choices = DEFAULT_VALUES[param['name']]
+        return choices[index % len(choices)]
+    entity = entities.get(param['dataType'].lstrip('@'))
+    if entity:
+        return entity[index % len(entity)][0]
+    return _resolve(param['dataType'], '', entities, index) or 'ไม่ระบุ'
+
+
+def load_samples(export_dir=EXPORT_DIR, extra=True):
+    """
+    Requests to replay, grouped by intent
+
+    Args:
+        export_dir: Dialogflow agent export directory
+        extra: Also include EXTRA_SAMPLES
+
+    Returns:
+        dict: {intent name: [Sample, ...]}
+    """
+    entities = load_entities(export_dir)
+    intent_dir = os.path.join(export_dir, 'intents')
+    samples = {}
+
+    for filename in sorted(os.listdir(intent_dir)):
+        if not filename.endswith('.json') or '_usersays_' in filename:
+            continue
+        definition = _load_json(os.path.join(intent_dir, filename))
+        if not definition.get('webhookUsed'):
+            continue
+
+        name = definition['name']
+        params = [p for response in definition.get('responses', []) for p in response.get('parameters', [])]
+        usersays_path = os.path.join(intent_dir, f"{filename[:-len('.json')]}_usersays_th.json")
+        phrases = _load_json(usersays_path) if os.path.exists(usersays_path) else [{'data': [{'text': name}]}]
+
+        intent_samples = []
+        for index, phrase in enumerate(phrases):
+            values = {}
+            for segment in phrase['data']:
+                if segment.get('alias'):
+                    values[segment['alias']] = _resolve(segment['meta'], segment['text'], entities, index)
+            for param in params:
+                value = values.get(param['name'])
+                if value in (None, '') and param.get('required'):
+                    value = _default(param, entities, index)
+                if value is None:
+                    value = ''  # Dialogflow sends unfilled parameters as ""
+                if param.get('isList') and not isinstance(value, list):
+                    value = [value] if value != '' else []
+                values[param['name']] = value
+            query_text = ''.join(segment['text'] for segment in phrase['data'])
+            intent_samples.append(Sample(name, query_text, values))
+        samples[name] = intent_samples
+
+    if extra:
+        for name, phrases in EXTRA_SAMPLES.items():
+            samples.setdefault(name, [Sample(name, text, dict(params)) for text, params in phrases])
+    return samples
+
+
+def build_request(sample, user_id, response_id=None):
+    """
+    Dialogflow ES webhook request body for a sample
+
+    Args:
+        sample: Sample
+        user_id: Session ID (the LINE user ID for this bot)
+        response_id: Dialogflow responseId (new one if not given)
+
+    Returns:
+        dict
+    """
+    return {
+        'responseId': response_id or str(uuid.uuid4()),
+        'session': f"projects/kwannurse-bench/agent/sessions/{user_id}",
+        'queryResult': {
+            'queryText': sample.query_text,
+            'parameters': sample.params,
+            'allRequiredParamsPresent': True,
+            'intent': {
+                'name': f"projects/kwannurse-bench/agent/intents/{sample.intent}",
+                'displayName': sample.intent
+            },
+            'languageCode': 'th'
+        },
+        'originalDetectIntentRequest': {'source': 'line', 'payload': {}}
+    }
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Webhook Benchmark
+Replay Dialogflow requests for every intent through the Flask app, offline
+
+Runs on the in-process LocalBackend and a mock LINE server, so no sheet
+is written and no patient gets a message. For each intent it reports
+throughput, p50/p95/p99 latency and the memory one request allocates.
+Background work (deferred writes, nurse alerts) is drained between
+intents and reported as its own time.
+
+Usage:
+    python -m benchmarks.webhook_bench
+    python -m benchmarks.webhook_bench --requests 500 --concurrency 8 --json bench.json
+    python -m benchmarks.webhook_bench --compare bench.json   # exit 1 on regression
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.mock_line import MockLineServer
+from benchmarks.payloads import EXPORT_DIR, load_samples, build_request
+
+# Requests measured with tracemalloc on (it slows calls down, so timing runs without it)
+ALLOC_SAMPLE_SIZE = 50
+
+# p95 changes smaller than this are noise, whatever the ratio
+REGRESSION_FLOOR_MS = 1.0
+
+
+def configure_environment(workdir, line_url):
+    """
+    Settings for an offline run; must happen before config is imported
+
+    Values already in the environment win, except the storage and LINE
+    targets, which always point at the stand-ins.
+    """
+    os.environ.update({
+        'STORAGE_BACKEND': 'local',
+        'LOCAL_STORE_PATH': ':memory:',
+        'LINE_API_BASE_URL': line_url,
+        'OUTBOX_DB_PATH': os.path.join(workdir, 'outbox.db'),
+        'SCHEDULER_DB_PATH': os.path.join(workdir, 'jobs.db'),
+        'MIRROR_DB_PATH': os.path.join(workdir, 'mirror.db'),
+        'QUEUE_JOURNAL_PATH': os.path.join(workdir, 'queue.jsonl')
+    })
+    os.environ.setdefault('CHANNEL_ACCESS_TOKEN', 'bench-token')
+    os.environ.setdefault('NURSE_GROUP_ID', 'Cbenchnursegroup')
+    # Measure the bot, not our own client-side throttle
+    os.environ.setdefault('LINE_REQUESTS_PER_SECOND', '100000')
+    os.environ.setdefault('LINE_BURST', '100000')
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+class WebhookRunner:
+    """Sends sample requests through the Flask test client (one client per thread)"""
+
+    def __init__(self, app, users):
+        self.app = app
+        self.users = users
+        self._local = threading.local()
+        self._counter = 0
+        self._counter_lock = threading.Lock()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client
+
+    def _next(self):
+        with self._counter_lock:
+            self._counter += 1
+            return self._counter
+
+    def send(self, sample):
+        """
+        Post one request
+
+        Returns:
+            tuple: (ok, seconds)
+        """
+        n = self._next()
+        body = build_request(sample, f"Ubench{n % self.users:05d}")
+        started = time.perf_counter()
+        response = self._client().post('/webhook', json=body)
+        elapsed = time.perf_counter() - started
+        ok = response.status_code == 200 and 'fulfillmentText' in (response.get_json(silent=True) or {})
+        return ok, elapsed
+
+    def run(self, samples, count, concurrency):
+        """
+        Send `count` requests cycling through samples
+
+        Returns:
+            tuple: (latencies in seconds, error count, wall seconds)
+        """
+        work = [samples[i % len(samples)] for i in range(count)]
+        started = time.perf_counter()
+        if concurrency <= 1:
+            results = [self.send(sample) for sample in work]
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                results = list(pool.map(self.send, work))
+        wall = time.perf_counter() - started
+        return [elapsed for _, elapsed in results], sum(1 for ok, _ in results if not ok), wall
+
+    def allocations(self, samples, count):
+        """
+        Memory per request under tracemalloc
+
+        Returns:
+            tuple: (mean peak KiB, mean retained KiB)
+        """
+        peaks, retained = [], []
+        tracemalloc.start()
+        try:
+            for i in range(count):
+                before, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                self.send(samples[i % len(samples)])
+                after, peak = tracemalloc.get_traced_memory()
+                peaks.append(peak - before)
+                retained.append(after - before)
+        finally:
+            tracemalloc.stop()
+        return sum(peaks) / len(peaks) / 1024, sum(retained) / len(retained) / 1024
+
+
+def drain_background(timeout=60):
+    """
+    Wait for deferred tasks and queued notifications
+
+    Returns:
+        float: Seconds it took
+    """
+    # Imported here: config reads the environment at import time
+    from services.alert_digest import flush_alert_digest
+    from services.deferred import drain as drain_deferred
+    from services.dispatcher import drain as drain_dispatcher
+
+    started = time.perf_counter()
+    drain_deferred(timeout)
+    flush_alert_digest()
+    drain_dispatcher(timeout)
+    return time.perf_counter() - started
+
+
+def benchmark(runner, samples_by_intent, requests, warmup, concurrency, measure_alloc=True):
+    """
+    Benchmark each intent in turn
+
+    Returns:
+        dict: {intent: {requests, errors, rps, p50_ms, p95_ms, p99_ms, max_ms,
+                        alloc_kib, retained_kib, background_s}}
+    """
+    results = {}
+    for name, samples in samples_by_intent.items():
+        if warmup:
+            runner.run(samples, warmup, 1)
+            drain_background()
+
+        latencies, errors, wall = runner.run(samples, requests, concurrency)
+        background = drain_background()
+        latencies.sort()
+
+        result = {
+            'requests': requests,
+            'errors': errors,
+            'rps': round(requests / wall, 1) if wall else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            'background_s': round(background, 3)
+        }
+        if measure_alloc:
+            alloc, retained = runner.allocations(samples, min(requests, ALLOC_SAMPLE_SIZE))
+            drain_background()
+            result['alloc_kib'] = round(alloc, 1)
+            result['retained_kib'] = round(retained, 1)
+        results[name] = result
+    return results
+
+
+def print_report(results, line_counts):
+    columns = ('requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'alloc_kib', 'background_s')
+    width = max([len(name) for name in results] + [6])
+    print(f"{'intent':<{width}} " + " ".join(f"{c:>12}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<{width}} " + " ".join(f"{result.get(c, '-'):>12}" for c in columns))
+    print(f"\nMock LINE received: {line_counts or 'nothing'}")
+
+
+def compare(results, baseline, tolerance):
+    """
+    Intents whose p95 got worse than baseline by more than `tolerance`
+
+    Returns:
+        list: Human-readable regression lines
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        old, new = before['p95_ms'], result['p95_ms']
+        if new - old > REGRESSION_FLOOR_MS and new > old * (1 + tolerance):
+            regressions.append(f"{name}: p95 {old} ms -> {new} ms (+{(new / old - 1) * 100 if old else 100:.0f}%)")
+        if result['errors'] > before.get('errors', 0):
+            regressions.append(f"{name}: errors {before.get('errors', 0)} -> {result['errors']}")
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Offline webhook load test")
+    parser.add_argument('--requests', type=int, default=200, help="Measured requests per intent")
+    parser.add_argument('--warmup', type=int, default=20, help="Unmeasured requests per intent first")
+    parser.add_argument('--concurrency', type=int, default=1, help="Client threads")
+    parser.add_argument('--users', type=int, default=50, help="Distinct LINE user IDs to rotate through")
+    parser.add_argument('--intents', help="Comma-separated intents to run (default: all)")
+    parser.add_argument('--export-dir', default=EXPORT_DIR, help="Dialogflow agent export")
+    parser.add_argument('--real-hours', action='store_true',
+                        help="Keep real office hours (default: always open, so ContactNurse queues)")
+    parser.add_argument('--no-alloc', action='store_true', help="Skip the tracemalloc pass")
+    parser.add_argument('--json', help="Write results to this file")
+    parser.add_argument('--compare', help="Baseline results file; exit 1 on regression")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed p95 slowdown vs baseline")
+    parser.add_argument('--verbose', action='store_true', help="Keep the bot's INFO logging")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='kwannurse-bench-')
+    line = MockLineServer().start()
+    configure_environment(workdir, line.url)
+
+    if not args.verbose:
+        # Before config's basicConfig, which then leaves it alone
+        logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+
+    # Imported here: config reads the environment at import time
+    from app import app
+    from config import OFFICE_HOURS
+    from database.backend import LocalBackend, set_backend
+
+    set_backend(LocalBackend())
+    if not args.real_hours:
+        OFFICE_HOURS.update(start='00:00', end='23:59', weekdays=list(range(7)))
+
+    samples = load_samples(args.export_dir)
+    if args.intents:
+        wanted = {name.strip() for name in args.intents.split(',')}
+        samples = {name: s for name, s in samples.items() if name in wanted}
+    if not samples:
+        print("No intents to run", file=sys.stderr)
+        return 2
+
+    runner = WebhookRunner(app, args.users)
+    try:
+        results = benchmark(runner, samples, args.requests, args.warmup, args.concurrency, not args.no_alloc)
+        print_report(results, line.counts())
+    finally:
+        line.stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'results': results
+            }, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions against " + args.compare + ":")
+            for line_text in regressions:
+                print("  " + line_text)
+            return 1
+        print(f"\nNo regressions against {args.compare}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
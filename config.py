@@ -22,6 +22,22 @@ WORKSHEET_LINK = os.environ.get(
 GSPREAD_CREDENTIALS = os.environ.get("GSPREAD_CREDENTIALS")
 SPREADSHEET_NAME = "KhwanBot_Data"
 
+# Seconds an opened Spreadsheet/Worksheet handle is reused before re-resolving
+WORKSHEET_CACHE_TTL = int(os.environ.get("WORKSHEET_CACHE_TTL", 600))
+
+# Write-behind buffering of appended rows (flushed with one append_rows per sheet)
+WRITE_BUFFER_ENABLED = os.environ.get("WRITE_BUFFER_ENABLED", "true").lower() in ("1", "true", "yes")
+WRITE_BUFFER_FLUSH_SECONDS = float(os.environ.get("WRITE_BUFFER_FLUSH_SECONDS", 2))
+WRITE_BUFFER_BATCH_SIZE = int(os.environ.get("WRITE_BUFFER_BATCH_SIZE", 50))
+
+# Storage backend: "sheets" (Google Sheets) or "local" (SQLite only, for offline runs)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sheets").lower()
+LOCAL_STORE_PATH = os.environ.get("LOCAL_STORE_PATH", ":memory:")
+
+# Local SQLite mirror of the sheets (reads are served from here)
+MIRROR_DB_PATH = os.environ.get("MIRROR_DB_PATH", "kwannurse_mirror.db")
+MIRROR_SYNC_SECONDS = int(os.environ.get("MIRROR_SYNC_SECONDS", 300))
+
 # Sheet Names
 SHEET_SYMPTOM_LOG = "SymptomLog"
 SHEET_RISK_PROFILE = "RiskProfile"
@@ -31,10 +47,133 @@ SHEET_REMINDER_SCHEDULES = "ReminderSchedules"
 SHEET_TELECONSULT_SESSIONS = "TeleconsultSessions"
 SHEET_TELECONSULT_QUEUE = "TeleconsultQueue"
 
+# Default column layout, used when a sheet's header row is missing or incomplete
+SHEET_HEADERS = {
+    SHEET_SYMPTOM_LOG: [
+        "Timestamp", "User_ID", "Pain_Score", "Wound_Status", "Fever",
+        "Mobility", "Risk_Level", "Risk_Score"
+    ],
+    SHEET_RISK_PROFILE: [
+        "Timestamp", "User_ID", "Age", "Weight", "Height", "BMI",
+        "Diseases", "Risk_Level", "Risk_Score"
+    ],
+    SHEET_APPOINTMENTS: [
+        "Timestamp", "User_ID", "Name", "Phone", "Preferred_Date",
+        "Preferred_Time", "Reason", "Status", "Assigned_To", "Notes"
+    ],
+    SHEET_FOLLOW_UP_REMINDERS: [
+        "Timestamp", "User_ID", "Reminder_Type", "Status",
+        "Response_Text", "Message_Sent", "Response_Timestamp"
+    ],
+    SHEET_REMINDER_SCHEDULES: [
+        "Created_At", "User_ID", "Discharge_Date", "Reminder_Type",
+        "Scheduled_Date", "Status", "Notes"
+    ],
+    SHEET_TELECONSULT_SESSIONS: [
+        "Session_ID", "Timestamp", "User_ID", "Issue_Type", "Priority", "Status",
+        "Description", "Queue_Position", "Assigned_Nurse", "Started_At",
+        "Completed_At", "Notes"
+    ],
+    SHEET_TELECONSULT_QUEUE: [
+        "Queue_ID", "Timestamp", "Session_ID", "User_ID", "Issue_Type",
+        "Priority", "Status", "Estimated_Wait"
+    ]
+}
+
+# Unique key column per sheet; updates by this key go straight to the row
+SHEET_ROW_KEYS = {
+    SHEET_TELECONSULT_SESSIONS: "Session_ID",
+    SHEET_TELECONSULT_QUEUE: "Session_ID"
+}
+
 # LINE Messaging API Configuration
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("CHANNEL_ACCESS_TOKEN")
 NURSE_GROUP_ID = os.environ.get("NURSE_GROUP_ID")
-LINE_API_URL = "https://api.line.me/v2/bot/message/push"
+# Point at a local stand-in (benchmarks/mock_line.py) to test without sending real pushes
+LINE_API_BASE_URL = os.environ.get("LINE_API_BASE_URL", "https://api.line.me").rstrip("/")
+LINE_API_URL = f"{LINE_API_BASE_URL}/v2/bot/message/push"
+LINE_MULTICAST_URL = f"{LINE_API_BASE_URL}/v2/bot/message/multicast"
+LINE_MULTICAST_MAX = 500  # Recipients per multicast call (LINE API limit)
+
+# Shared keep-alive connection pool for the LINE API
+LINE_HTTP_POOL_SIZE = int(os.environ.get("LINE_HTTP_POOL_SIZE", 10))
+LINE_HTTP_CONNECT_TIMEOUT = float(os.environ.get("LINE_HTTP_CONNECT_TIMEOUT", 3))
+LINE_HTTP_READ_TIMEOUT = float(os.environ.get("LINE_HTTP_READ_TIMEOUT", 8))
+
+# Background dispatch of LINE pushes (webhooks reply without waiting for LINE)
+DISPATCH_ENABLED = os.environ.get("DISPATCH_ENABLED", "true").lower() in ("1", "true", "yes")
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS", 4))
+DISPATCH_QUEUE_SIZE = int(os.environ.get("DISPATCH_QUEUE_SIZE", 1000))
+DISPATCH_DRAIN_SECONDS = float(os.environ.get("DISPATCH_DRAIN_SECONDS", 10))
+
+# Deferred side effects: webhooks reply first, saves and alerts run in the background
+DEFERRED_ENABLED = os.environ.get("DEFERRED_ENABLED", "true").lower() in ("1", "true", "yes")
+DEFERRED_WORKERS = int(os.environ.get("DEFERRED_WORKERS", 2))
+DEFERRED_QUEUE_SIZE = int(os.environ.get("DEFERRED_QUEUE_SIZE", 1000))
+DEFERRED_MAX_ATTEMPTS = int(os.environ.get("DEFERRED_MAX_ATTEMPTS", 5))
+DEFERRED_RETRY_BASE_SECONDS = float(os.environ.get("DEFERRED_RETRY_BASE_SECONDS", 2))
+DEFERRED_RETRY_MAX_SECONDS = float(os.environ.get("DEFERRED_RETRY_MAX_SECONDS", 120))
+
+# Extra modules whose @intent handlers are registered at startup (comma-separated)
+INTENT_MODULES = [
+    m.strip() for m in os.environ.get("INTENT_MODULES", "routes.followup").split(",") if m.strip()
+]
+
+# Replies to Dialogflow retries are served from cache instead of re-running the intent
+IDEMPOTENCY_ENABLED = os.environ.get("IDEMPOTENCY_ENABLED", "true").lower() in ("1", "true", "yes")
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 300))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", 10000))
+# A retry arriving while the first request still runs waits this long for its reply
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get("IDEMPOTENCY_WAIT_SECONDS", 4))
+
+# Durable outbox: every LINE message is recorded, failed ones are replayed with backoff ("" disables)
+OUTBOX_DB_PATH = os.environ.get("OUTBOX_DB_PATH", "kwannurse_outbox.db")
+OUTBOX_POLL_SECONDS = float(os.environ.get("OUTBOX_POLL_SECONDS", 15))
+OUTBOX_REPLAY_BATCH = int(os.environ.get("OUTBOX_REPLAY_BATCH", 100))
+OUTBOX_RETRY_BASE_SECONDS = float(os.environ.get("OUTBOX_RETRY_BASE_SECONDS", 30))
+OUTBOX_RETRY_MAX_SECONDS = float(os.environ.get("OUTBOX_RETRY_MAX_SECONDS", 1800))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 12))
+# Messages still "sending" after this long belonged to a worker that died,
+# unless that worker is still checking in
+OUTBOX_STALE_SECONDS = int(os.environ.get("OUTBOX_STALE_SECONDS", 300))
+OUTBOX_RETENTION_HOURS = int(os.environ.get("OUTBOX_RETENTION_HOURS", 72))
+
+# Nurse alerts below emergency priority are merged into one digest per window
+ALERT_DIGEST_ENABLED = os.environ.get("ALERT_DIGEST_ENABLED", "true").lower() in ("1", "true", "yes")
+ALERT_DIGEST_WINDOW_SECONDS = float(os.environ.get("ALERT_DIGEST_WINDOW_SECONDS", 60))
+LINE_TEXT_MAX = 5000  # Characters per LINE text message
+
+# Digest headings per alert kind
+ALERT_CATEGORIES = {
+    'symptom': '🩺 อาการเสี่ยงสูง',
+    'risk': '📊 ความเสี่ยงส่วนบุคคลสูง',
+    'appointment': '📅 นัดหมายใหม่',
+    'teleconsult': '🔔 คำขอปรึกษาใหม่',
+    'concern': '⚠️ อาการน่ากังวล',
+    'no_response': '📢 ไม่มีการตอบกลับ'
+}
+
+# API rate limits (one token bucket per API) and retries with exponential backoff
+SHEETS_REQUESTS_PER_MINUTE = float(os.environ.get("SHEETS_REQUESTS_PER_MINUTE", 60))
+SHEETS_BURST = int(os.environ.get("SHEETS_BURST", 10))
+LINE_REQUESTS_PER_SECOND = float(os.environ.get("LINE_REQUESTS_PER_SECOND", 100))
+LINE_BURST = int(os.environ.get("LINE_BURST", 50))
+# The limits above are per Google project / LINE channel. Each worker process
+# gets an equal share (gunicorn reads the same variable for its worker count)
+WEB_CONCURRENCY = max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
+API_RETRY_ATTEMPTS = int(os.environ.get("API_RETRY_ATTEMPTS", 4))  # Retries after the first try
+API_RETRY_BASE_SECONDS = float(os.environ.get("API_RETRY_BASE_SECONDS", 0.5))
+API_RETRY_MAX_SECONDS = float(os.environ.get("API_RETRY_MAX_SECONDS", 30))
+# Dialogflow gives up on a webhook after ~5 s: API calls made while serving
+# one stop waiting (backoff, Retry-After) once this much time has passed
+WEBHOOK_API_DEADLINE_SECONDS = float(os.environ.get("WEBHOOK_API_DEADLINE_SECONDS", 3))
+
+# Request tracing: nested timing spans per webhook request
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 2000))  # Log the span tree of slower requests
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", 200))  # Recent traces kept for /debug/traces
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", 500))  # Per request; further spans are dropped
+TRACE_DEBUG_TOKEN = os.environ.get("TRACE_DEBUG_TOKEN")  # /debug/traces needs it (or DEBUG) to be set
 
 # Logging Configuration
 logging.basicConfig(
@@ -93,6 +232,27 @@ DISEASE_NEGATIVES = {
     "healthy", "null", "n/a", "ไม่"
 }
 
+# Symptom keywords per category, matched anywhere in the lowercased text
+# (see utils.keywords). Within wound and mobility the first matching
+# category in this order wins.
+SYMPTOM_KEYWORDS = {
+    'wound_infected': ["หนอง", "มีกลิ่น", "แฉะ", "pus", "discharge"],
+    'wound_inflamed': ["บวมแดง", "อักเสบ", "swelling", "red", "inflamed"],
+    'wound_normal': ["ปกติ", "ดี", "แห้ง", "normal", "dry", "good"],
+    'fever': ["มี", "ตัวร้อน", "fever", "hot", "ไข้"],
+    'immobile': ["ไม่ได้", "ติดเตียง", "ไม่เดิน", "cannot", "bedridden"],
+    'mobile': ["เดินได้", "ปกติ", "normal", "can walk"],
+    # Follow-up reminder replies that need a nurse
+    'concern': [
+        "ปวดมาก", "ปวดเพิ่มขึ้น", "หนอง", "มีกลิ่น",
+        "บวมแดง", "มีไข้", "ตัวร้อน", "เจ็บมาก",
+        "แผลแยก", "เลือดออก", "ไม่ดีขึ้น"
+    ]
+}
+# Optional JSON file {category: [keywords]} replacing those categories
+# (local or dialect terms without a code change)
+SYMPTOM_KEYWORDS_FILE = os.environ.get("SYMPTOM_KEYWORDS_FILE")
+
 # Follow-up Reminder Configuration
 REMINDER_INTERVALS = {
     'day3': {'days': 3, 'name': 'วันที่ 3 หลังจำหน่าย'},
@@ -101,12 +261,23 @@ REMINDER_INTERVALS = {
     'day30': {'days': 30, 'name': '1 เดือน'}
 }
 
+# Reminders due within this many seconds of each other go out as one multicast wave
+REMINDER_WAVE_WINDOW_SECONDS = float(os.environ.get("REMINDER_WAVE_WINDOW_SECONDS", 2))
+
 # Time to check for no-response (hours)
 NO_RESPONSE_CHECK_HOURS = 24
 
 # Scheduler Configuration
 SCHEDULER_TIMEZONE = 'Asia/Bangkok'
 SCHEDULER_JOBSTORE = 'default'
+SCHEDULER_DB_PATH = os.environ.get("SCHEDULER_DB_PATH", "kwannurse_jobs.db")
+# Reminders missed by at most this long (e.g. during a restart) still go out
+SCHEDULER_MISFIRE_GRACE_SECONDS = int(os.environ.get("SCHEDULER_MISFIRE_GRACE_SECONDS", 3600))
+# How often ReminderSchedules is checked for rows that need a job
+REMINDER_RECONCILE_MINUTES = int(os.environ.get("REMINDER_RECONCILE_MINUTES", 15))
+# Only the worker holding this lock runs jobs; the others retry every poll interval
+SCHEDULER_LOCK_PATH = os.environ.get("SCHEDULER_LOCK_PATH", SCHEDULER_DB_PATH + ".lock")
+SCHEDULER_LEADER_POLL_SECONDS = int(os.environ.get("SCHEDULER_LEADER_POLL_SECONDS", 30))
 
 # Teleconsult Configuration
 OFFICE_HOURS = {
@@ -149,4 +320,8 @@ ISSUE_CATEGORIES = {
 }
 
 MAX_QUEUE_SIZE = 20
+
+# Teleconsult queue journal (append-only JSON lines, replayed on startup; "" disables)
+QUEUE_JOURNAL_PATH = os.environ.get("QUEUE_JOURNAL_PATH", "teleconsult_queue.jsonl")
+QUEUE_JOURNAL_COMPACT_LINES = int(os.environ.get("QUEUE_JOURNAL_COMPACT_LINES", 1000))
 NURSE_RESPONSE_TIMEOUT_MINUTES = 30
@@ -2,14 +2,33 @@
 """Database package"""
 from .sheets import (
     get_sheet_client,
+    get_worksheet,
+    invalidate_worksheets,
+    get_headers,
+    patch_rows,
     save_symptom_data,
     save_profile_data,
     save_appointment_data
 )
+from .write_buffer import enqueue_append, flush_pending
+from .mirror import get_mirror, sync_sheet
+from .backend import get_backend, set_backend, LocalBackend, SheetsBackend
 
 __all__ = [
     'get_sheet_client',
+    'get_worksheet',
+    'invalidate_worksheets',
+    'get_headers',
+    'patch_rows',
     'save_symptom_data',
     'save_profile_data',
-    'save_appointment_data'
+    'save_appointment_data',
+    'enqueue_append',
+    'flush_pending',
+    'get_mirror',
+    'sync_sheet',
+    'get_backend',
+    'set_backend',
+    'LocalBackend',
+    'SheetsBackend'
 ]
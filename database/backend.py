@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Storage Backend Module
+One interface over the tables the bot reads and writes
+
+SheetsBackend is the production store (Google Sheets, with the write-behind
+buffer and the SQLite mirror in front of it). LocalBackend keeps the same
+tables in SQLite only, for offline runs, load tests and benchmarks.
+"""
+import threading
+from typing import Protocol
+from config import (
+    STORAGE_BACKEND,
+    LOCAL_STORE_PATH,
+    SHEET_ROW_KEYS,
+    get_logger
+)
+from database.mirror import SheetMirror, get_mirror, mirrored, on_sync, sync_sheet
+from database.row_index import locate_all
+from database.write_buffer import enqueue_append, flush_pending
+from utils.ratelimit import call_api
+
+logger = get_logger(__name__)
+
+
+class StorageBackend(Protocol):
+    """
+    Row store used by database/*
+
+    Rows are appended as positional lists in sheet column order and read
+    back as {column: value} dicts. Patches address "the newest row whose
+    columns match", which is how every update in the bot finds its row.
+    """
+
+    def available(self):
+        """True if the store can be used (e.g. credentials are configured)"""
+
+    def append(self, sheet_name, row):
+        """Append one row; returns True once it is accepted"""
+
+    def find_by_key(self, sheet_name, match, newest_first=False, limit=None):
+        """Rows whose columns equal `match` (list values mean "any of")"""
+
+    def scan_by_status(self, sheet_name, status, match=None):
+        """Rows with the given Status (plus optional extra `match` columns)"""
+
+    def patch_rows(self, sheet_name, patches):
+        """
+        Apply [(match, changes), ...] to the newest row matching each patch
+        Returns: list of bools, one per patch (False if no row matched)
+        """
+
+    def patch_row(self, sheet_name, match, changes):
+        """Patch the newest row matching `match`; returns True if found"""
+
+    def version(self, sheet_name):
+        """Opaque value that changes whenever the table's rows change"""
+
+    def watch(self, sheet_name, func):
+        """Call func() whenever rows may have been changed outside the bot"""
+
+    def refresh(self, sheet_name):
+        """Pick up changes made outside the bot now; True if reads are current"""
+
+
+class LocalBackend:
+    """SQLite-only backend with the same behaviour as SheetsBackend"""
+
+    def __init__(self, path=":memory:"):
+        self.mirror = SheetMirror(path)
+
+    def available(self):
+        return True
+
+    def append(self, sheet_name, row):
+        self.mirror.insert(sheet_name, row)
+        return True
+
+    def find_by_key(self, sheet_name, match, newest_first=False, limit=None):
+        return self.mirror.select(sheet_name, match, newest_first=newest_first, limit=limit)
+
+    def scan_by_status(self, sheet_name, status, match=None):
+        return self.mirror.select(sheet_name, dict(match or {}, Status=status))
+
+    def patch_rows(self, sheet_name, patches):
+        return [
+            self.mirror.update(sheet_name, match, changes, newest_only=True) > 0
+            for match, changes in patches
+        ]
+
+    def patch_row(self, sheet_name, match, changes):
+        return self.patch_rows(sheet_name, [(match, changes)])[0]
+
+    def version(self, sheet_name):
+        return (self.mirror.generation(sheet_name), self.mirror.synced_at(sheet_name))
+
+    def watch(self, sheet_name, func):
+        # Only the bot writes to the local store
+        return None
+
+    def refresh(self, sheet_name):
+        return True
+
+
+class SheetsBackend:
+    """
+    Google Sheets backend
+
+    Appends go through the write-behind buffer, reads are served from the
+    mirror, and patches write their rows with one batch_update per call.
+    Rows addressed by the sheet's key column (SHEET_ROW_KEYS) are found
+    through the row index; anything else is located with a sheet scan.
+    """
+
+    def available(self):
+        # Imported here: database.sheets stores its rows through this module
+        from database.sheets import get_sheet_client
+        return get_sheet_client() is not None
+
+    def append(self, sheet_name, row):
+        return enqueue_append(sheet_name, row)
+
+    def find_by_key(self, sheet_name, match, newest_first=False, limit=None):
+        return mirrored(sheet_name).select(
+            sheet_name, match, newest_first=newest_first, limit=limit
+        )
+
+    def scan_by_status(self, sheet_name, status, match=None):
+        return mirrored(sheet_name).select(sheet_name, dict(match or {}, Status=status))
+
+    def patch_rows(self, sheet_name, patches):
+        from database.sheets import get_worksheet, get_headers, discard_stale_worksheet, patch_rows
+
+        if not patches:
+            return []
+
+        try:
+            # Rows appended a moment ago may still be buffered
+            flush_pending(sheet_name)
+
+            # Patches by the sheet's key column go straight to the indexed row
+            key_column = SHEET_ROW_KEYS.get(sheet_name)
+            by_key = [
+                i for i, (match, _) in enumerate(patches)
+                if key_column and set(match) == {key_column}
+            ]
+            row_nums = [False] * len(patches)
+            located = locate_all(sheet_name, [patches[i][0][key_column] for i in by_key])
+            for i, row_num in zip(by_key, located):
+                row_nums[i] = row_num
+
+            if False in row_nums:
+                sheet = get_worksheet(sheet_name)
+                if not sheet:
+                    return [False] * len(patches)
+
+                all_values = call_api('sheets', sheet.get_all_values)
+                if not all_values or len(all_values) <= 1:
+                    logger.warning("%s sheet is empty, nothing to patch", sheet_name)
+                    return [False] * len(patches)
+
+                headers = all_values[0]
+                row_nums = [
+                    self._find_newest_row(all_values, headers, match) if row_num is False else row_num
+                    for (match, _), row_num in zip(patches, row_nums)
+                ]
+            else:
+                headers = get_headers(sheet_name)
+
+            changes = {}
+            for (_, values), row_num in zip(patches, row_nums):
+                if row_num is not None:
+                    changes.setdefault(row_num, {}).update(values)
+
+            found = [row_num is not None for row_num in row_nums]
+            if not patch_rows(sheet_name, changes, headers):
+                return [False] * len(patches)
+
+            mirror = get_mirror()
+            for (match, values), ok in zip(patches, found):
+                if ok:
+                    mirror.update(sheet_name, match, values, newest_only=True)
+            return found
+
+        except Exception as e:
+            discard_stale_worksheet(sheet_name, e)
+            logger.exception(f"Error patching {sheet_name}: {e}")
+            return [False] * len(patches)
+
+    def patch_row(self, sheet_name, match, changes):
+        return self.patch_rows(sheet_name, [(match, changes)])[0]
+
+    def version(self, sheet_name):
+        # Local writes bump the generation, syncs from the sheet set synced_at
+        mirror = get_mirror()
+        return (mirror.generation(sheet_name), mirror.synced_at(sheet_name))
+
+    def watch(self, sheet_name, func):
+        # Hand edits arrive with the mirror sync; loading the sheet keeps it in the sync loop
+        on_sync(sheet_name, func)
+        mirrored(sheet_name)
+
+    def refresh(self, sheet_name):
+        return sync_sheet(sheet_name)
+
+    @staticmethod
+    def _find_newest_row(all_values, headers, match):
+        """1-based row number of the last row matching `match`, or None"""
+        for i in range(len(all_values) - 1, 0, -1):
+            record = dict(zip(headers, all_values[i]))
+            if all(
+                record.get(col) in [str(v) for v in value]
+                if isinstance(value, (list, tuple, set))
+                else record.get(col) == str(value)
+                for col, value in match.items()
+            ):
+                return i + 1
+        return None
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Get the configured storage backend (singleton pattern)
+    Returns: SheetsBackend or LocalBackend (see STORAGE_BACKEND)
+    """
+    global _backend
+
+    with _backend_lock:
+        if _backend is None:
+            if STORAGE_BACKEND == "local":
+                _backend = LocalBackend(LOCAL_STORE_PATH)
+            else:
+                _backend = SheetsBackend()
+            logger.info("Storage backend: %s", type(_backend).__name__)
+        return _backend
+
+
+def set_backend(backend):
+    """Replace the storage backend (load tests, benchmarks)"""
+    global _backend
+
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,548 @@
+# -*- coding: utf-8 -*-
+"""
+Sheet Mirror Module
+Local SQLite copy of the Google Sheets tables for indexed reads
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from config import (
+    MIRROR_DB_PATH,
+    MIRROR_SYNC_SECONDS,
+    SHEET_HEADERS,
+    get_logger
+)
+from database.row_index import load_values
+from utils.ratelimit import call_api
+
+logger = get_logger(__name__)
+
+# Columns that get an index whenever a sheet has them
+INDEXED_COLUMNS = ('User_ID', 'Session_ID', 'Status')
+
+
+def _quote(name):
+    """Quote a sheet or column name as an SQLite identifier"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _cell_key(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return str(value).lower()
+    text = str(value).strip()
+    try:
+        # 25 and 25.0 are the same cell once Sheets has stored the number
+        return repr(float(text))
+    except ValueError:
+        return text.lower() if text.lower() in ('true', 'false') else text
+
+
+def row_key(values):
+    """
+    Compare a row the app built with the same row read back from Sheets
+
+    Every cell takes part, so rows differing in any column stay distinct.
+    Matches rows appended with RAW, which Sheets stores as sent; numbers
+    and TRUE/FALSE are compared by value and trailing blanks are ignored,
+    since get_all_values pads rows to the sheet width.
+    """
+    key = [_cell_key(v) for v in values]
+    while key and key[-1] == '':
+        key.pop()
+    return tuple(key)
+
+
+class SheetMirror:
+    """
+    SQLite tables mirroring worksheets, one table per sheet
+
+    Each table has the sheet's header columns (all TEXT) plus two
+    bookkeeping columns: _id keeps sheet order and _pending marks rows the
+    app has accepted but not yet written to Sheets (it holds the pid of
+    the process buffering the row, 0 once written). A sync replaces every
+    confirmed row and keeps the pending ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._columns = {}
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        if path != ':memory:':
+            # Let gunicorn workers read while another one writes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS _mirror_meta ("
+            "sheet_name TEXT PRIMARY KEY, synced_at REAL, generation INTEGER DEFAULT 0)"
+        )
+        self._conn.commit()
+
+    def columns(self, sheet_name):
+        """Header columns of a mirrored sheet ([] if it has no table yet)"""
+        with self._lock:
+            if sheet_name not in self._columns:
+                info = self._conn.execute(f"PRAGMA table_info({_quote(sheet_name)})").fetchall()
+                cols = [r['name'] for r in info if not r['name'].startswith('_')]
+                if not cols:
+                    return []
+                self._columns[sheet_name] = cols
+            return self._columns[sheet_name]
+
+    def _create_table(self, sheet_name, headers):
+        """(Re)create a sheet's table with the given header columns"""
+        table = _quote(sheet_name)
+        cols = []
+        for header in headers:
+            header = str(header).strip()
+            if header and not header.startswith('_') and header not in cols:
+                cols.append(header)
+
+        self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+        self._conn.execute(
+            f"CREATE TABLE {table} (_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            f"_pending INTEGER NOT NULL DEFAULT 0"
+            + "".join(f", {_quote(c)} TEXT" for c in cols) + ")"
+        )
+        for col in INDEXED_COLUMNS:
+            if col in cols:
+                index = _quote(f"idx_{sheet_name}_{col}")
+                self._conn.execute(f"CREATE INDEX {index} ON {table} ({_quote(col)})")
+        self._columns[sheet_name] = cols
+        return cols
+
+    def _ensure_table(self, sheet_name):
+        cols = self.columns(sheet_name)
+        if not cols:
+            cols = self._create_table(sheet_name, SHEET_HEADERS.get(sheet_name, []))
+        return cols
+
+    def _bump_generation(self, sheet_name):
+        self._conn.execute(
+            "INSERT INTO _mirror_meta (sheet_name, generation) VALUES (?, 1) "
+            "ON CONFLICT(sheet_name) DO UPDATE SET generation = generation + 1",
+            (sheet_name,)
+        )
+
+    @staticmethod
+    def _where(where):
+        """Build a WHERE clause; list values become IN (...)"""
+        clauses, params = [], []
+        for col, value in (where or {}).items():
+            if isinstance(value, (list, tuple, set)):
+                values = list(value)
+                clauses.append(f"{_quote(col)} IN ({', '.join('?' * len(values))})")
+                params.extend(str(v) for v in values)
+            else:
+                clauses.append(f"{_quote(col)} = ?")
+                params.append(str(value))
+        sql = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        return sql, params
+
+    def insert(self, sheet_name, row, pending=False):
+        """
+        Add a row (positional values, same order as the sheet columns)
+
+        Returns:
+            int: Mirror row id
+        """
+        with self._lock:
+            cols = self._ensure_table(sheet_name)
+            values = [str(v) if v is not None else '' for v in list(row)[:len(cols)]]
+            used = cols[:len(values)]
+            cur = self._conn.execute(
+                f"INSERT INTO {_quote(sheet_name)} (_pending"
+                + "".join(f", {_quote(c)}" for c in used)
+                + ") VALUES (?" + ", ?" * len(used) + ")",
+                [os.getpid() if pending else 0] + values
+            )
+            self._bump_generation(sheet_name)
+            self._conn.commit()
+            return cur.lastrowid
+
+    def confirm(self, sheet_name, row_ids):
+        """
+        Mark pending rows as written to Sheets
+
+        Counts as a write: a sync downloading meanwhile may have missed the
+        rows, and replacing with that download would drop them.
+        """
+        if not row_ids:
+            return
+        with self._lock:
+            ids = list(row_ids)
+            self._conn.execute(
+                f"UPDATE {_quote(sheet_name)} SET _pending = 0 "
+                f"WHERE _id IN ({', '.join('?' * len(ids))})",
+                ids
+            )
+            self._bump_generation(sheet_name)
+            self._conn.commit()
+
+    def claim_orphaned(self):
+        """
+        Take over pending rows no running process is going to write
+
+        Those are rows buffered by a process that has exited, or by an
+        earlier process that had our pid; call once at startup, before
+        this process buffers anything itself.
+
+        Returns:
+            dict: {sheet_name: [(mirror id, row values), ...]} in _id order
+        """
+        me = os.getpid()
+        claimed = {}
+        with self._lock:
+            tables = [
+                r['name'] for r in self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+                if not r['name'].startswith(('_', 'sqlite_'))
+            ]
+            for sheet_name in tables:
+                cols = self.columns(sheet_name)
+                table = _quote(sheet_name)
+                rows = self._conn.execute(
+                    f"SELECT * FROM {table} WHERE _pending != 0 ORDER BY _id"
+                ).fetchall()
+                for r in rows:
+                    owner = r['_pending']
+                    if owner != me and _process_alive(owner):
+                        continue
+                    # Conditional, so two workers starting together can't both take a row
+                    cur = self._conn.execute(
+                        f"UPDATE {table} SET _pending = ? WHERE _id = ? AND _pending = ?",
+                        (me, r['_id'], owner)
+                    )
+                    if cur.rowcount:
+                        claimed.setdefault(sheet_name, []).append(
+                            (r['_id'], [r[c] if r[c] is not None else '' for c in cols])
+                        )
+            self._conn.commit()
+        return claimed
+
+    def select(self, sheet_name, where=None, newest_first=False, limit=None):
+        """
+        Find rows matching column values
+
+        Args:
+            sheet_name: Worksheet title
+            where: {column: value or list of values}
+            newest_first: Return the most recently added rows first
+            limit: Maximum number of rows
+
+        Returns:
+            list: Records as {header: value} dicts
+        """
+        with self._lock:
+            cols = self.columns(sheet_name)
+            if not cols or any(c not in cols for c in (where or {})):
+                return []
+            sql, params = self._where(where)
+            sql = f"SELECT * FROM {_quote(sheet_name)}{sql} ORDER BY _id"
+            if newest_first:
+                sql += " DESC"
+            if limit:
+                sql += f" LIMIT {int(limit)}"
+            rows = self._conn.execute(sql, params).fetchall()
+            return [{c: (r[c] if r[c] is not None else '') for c in cols} for r in rows]
+
+    def count(self, sheet_name, where=None):
+        """Number of rows matching column values"""
+        with self._lock:
+            cols = self.columns(sheet_name)
+            if not cols or any(c not in cols for c in (where or {})):
+                return 0
+            sql, params = self._where(where)
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM {_quote(sheet_name)}{sql}", params
+            ).fetchone()[0]
+
+    def update(self, sheet_name, where, changes, newest_only=False):
+        """
+        Set column values on matching rows
+
+        Args:
+            sheet_name: Worksheet title
+            where: {column: value or list of values}
+            changes: {column: new value}
+            newest_only: Only touch the most recently added matching row
+
+        Returns:
+            int: Number of rows changed
+        """
+        with self._lock:
+            cols = self.columns(sheet_name)
+            if not cols or any(c not in cols for c in where):
+                return 0
+            changes = {c: v for c, v in changes.items() if c in cols}
+            if not changes:
+                return 0
+
+            sql, params = self._where(where)
+            if newest_only:
+                sql = f" WHERE _id = (SELECT MAX(_id) FROM {_quote(sheet_name)}{sql})"
+            cur = self._conn.execute(
+                f"UPDATE {_quote(sheet_name)} SET "
+                + ", ".join(f"{_quote(c)} = ?" for c in changes)
+                + sql,
+                [str(v) for v in changes.values()] + params
+            )
+            self._bump_generation(sheet_name)
+            self._conn.commit()
+            return cur.rowcount
+
+    def replace(self, sheet_name, all_values, generation=None):
+        """
+        Replace confirmed rows with a fresh download of the sheet
+
+        Synced rows get ids -N..-1 in sheet order, so rows added since
+        (pending or not) keep sorting after them. Pending rows keep their
+        _id, which the write buffer holds to confirm them later, unless the
+        download already has them (their append landed while it ran).
+
+        Args:
+            sheet_name: Worksheet title
+            all_values: Result of worksheet.get_all_values() (header row first)
+            generation: generation() read before the download; if any
+                        process wrote since, nothing is replaced (ignored
+                        until the sheet's first sync)
+
+        Returns:
+            bool: True if the mirror was replaced
+        """
+        with self._lock:
+            headers = all_values[0] if all_values else SHEET_HEADERS.get(sheet_name, [])
+            table = _quote(sheet_name)
+            try:
+                if self._conn.in_transaction:
+                    self._conn.commit()
+                # Holds off other workers' writes between the check and the replace
+                self._conn.execute("BEGIN IMMEDIATE")
+                meta = self._conn.execute(
+                    "SELECT generation, synced_at FROM _mirror_meta WHERE sheet_name = ?", (sheet_name,)
+                ).fetchone()
+                if (generation is not None and meta and meta['synced_at'] is not None
+                        and meta['generation'] != generation):
+                    self._conn.rollback()
+                    return False
+
+                current = self.columns(sheet_name)
+                wanted = [str(h).strip() for h in headers]
+                pending = []
+                if current:
+                    pending = [
+                        dict(r) for r in self._conn.execute(
+                            f"SELECT * FROM {table} WHERE _pending != 0 ORDER BY _id"
+                        ).fetchall()
+                    ]
+                rows = all_values[1:]
+                in_sheet = Counter(row_key(row) for row in rows)
+                written = []
+                for record in pending:
+                    key = row_key([record.get(h, '') if h else '' for h in wanted])
+                    if in_sheet[key]:
+                        in_sheet[key] -= 1
+                        written.append(record['_id'])
+
+                if current and current == [h for h in wanted if h]:
+                    self._conn.execute(
+                        f"DELETE FROM {table} WHERE _pending = 0 OR _id IN ({', '.join('?' * len(written))})",
+                        written
+                    )
+                    pending = []
+                else:
+                    # Header row changed: rebuild, carrying pending rows over
+                    pending = [r for r in pending if r['_id'] not in written]
+                    self._columns.pop(sheet_name, None)
+                    self._create_table(sheet_name, headers)
+
+                cols = self._columns[sheet_name]
+                positions = [wanted.index(c) for c in cols]
+                insert_sql = (
+                    f"INSERT INTO {table} (_id"
+                    + "".join(f", {_quote(c)}" for c in cols)
+                    + ") VALUES (?" + ", ?" * len(cols) + ")"
+                )
+                self._conn.executemany(insert_sql, [
+                    [i - len(rows)] + [row[p] if p < len(row) else '' for p in positions]
+                    for i, row in enumerate(rows)
+                ])
+
+                for record in pending:
+                    kept = [c for c in cols if c in record]
+                    self._conn.execute(
+                        f"INSERT INTO {table} (_id, _pending"
+                        + "".join(f", {_quote(c)}" for c in kept)
+                        + ") VALUES (?, ?" + ", ?" * len(kept) + ")",
+                        [record['_id'], record['_pending']] + [record[c] for c in kept]
+                    )
+
+                self._conn.execute(
+                    "INSERT INTO _mirror_meta (sheet_name, synced_at) VALUES (?, ?) "
+                    "ON CONFLICT(sheet_name) DO UPDATE SET synced_at = excluded.synced_at",
+                    (sheet_name, time.time())
+                )
+                self._conn.commit()
+                return True
+            except Exception:
+                self._conn.rollback()
+                self._columns.pop(sheet_name, None)
+                raise
+
+    def generation(self, sheet_name):
+        """Write counter, used to detect local writes during a download"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT generation FROM _mirror_meta WHERE sheet_name = ?", (sheet_name,)
+            ).fetchone()
+            return row['generation'] if row else 0
+
+    def synced_at(self, sheet_name):
+        """Unix time of the last successful sync (None if never synced)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT synced_at FROM _mirror_meta WHERE sheet_name = ?", (sheet_name,)
+            ).fetchone()
+            return row['synced_at'] if row else None
+
+    def synced_sheets(self):
+        """Sheets that have been loaded at least once"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT sheet_name FROM _mirror_meta WHERE synced_at IS NOT NULL"
+            ).fetchall()
+            return [r['sheet_name'] for r in rows]
+
+
+def _process_alive(pid):
+    """Whether a process with this pid exists (1 marks rows from older versions)"""
+    if pid <= 1:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+_sync_thread = None
+_sync_listeners = {}  # sheet name -> [func()] run after each successful sync
+_started_at = time.time()
+
+
+def get_mirror():
+    """
+    Get the process-wide mirror (singleton pattern)
+    Returns: SheetMirror
+    """
+    global _mirror
+
+    with _mirror_lock:
+        if _mirror is None:
+            _mirror = SheetMirror(MIRROR_DB_PATH)
+            logger.info("Sheet mirror opened at %s", MIRROR_DB_PATH)
+        return _mirror
+
+
+def sync_sheet(sheet_name):
+    """
+    Reload one sheet from Google Sheets into the mirror
+
+    Picks up rows nurses added or edited by hand. If the app wrote to the
+    sheet while it was downloading (any worker, including a buffered row
+    being confirmed), the replace is skipped and the next sync tries again
+    (unless the sheet was never loaded).
+
+    Returns:
+        bool: True if the mirror now reflects the sheet
+    """
+    # Imported here: database.sheets and write_buffer both write through the mirror
+    from database.sheets import get_worksheet, discard_stale_worksheet
+    from database.write_buffer import flush_pending
+
+    mirror = get_mirror()
+    try:
+        flush_pending(sheet_name)
+        sheet = get_worksheet(sheet_name)
+        if not sheet:
+            return False
+
+        generation = mirror.generation(sheet_name)
+        all_values = call_api('sheets', sheet.get_all_values)
+
+        if not mirror.replace(sheet_name, all_values, generation):
+            logger.info("Skipped sync of %s: written during download", sheet_name)
+            return False
+
+        load_values(sheet_name, all_values)
+        logger.info("Synced %s into mirror (%d rows)", sheet_name, max(len(all_values) - 1, 0))
+
+    except Exception as e:
+        discard_stale_worksheet(sheet_name, e)
+        logger.exception(f"Error syncing {sheet_name} into mirror: {e}")
+        return False
+
+    with _mirror_lock:
+        listeners = list(_sync_listeners.get(sheet_name, ()))
+    for func in listeners:
+        try:
+            func()
+        except Exception as e:
+            logger.exception(f"Error in sync listener for {sheet_name}: {e}")
+    return True
+
+
+def on_sync(sheet_name, func):
+    """
+    Call func() after every successful sync of a sheet
+
+    Hand edits made in Google Sheets become visible to the app at a sync,
+    so this is where state kept elsewhere catches up with them.
+    """
+    with _mirror_lock:
+        _sync_listeners.setdefault(sheet_name, []).append(func)
+
+
+def _sync_loop():
+    """Background loop reconciling hand edits made in Google Sheets"""
+    # A mirror kept from the last run misses edits made while the app was
+    # down, so refresh it now rather than a full interval from now
+    mirror = get_mirror()
+    for sheet_name in mirror.synced_sheets():
+        if (mirror.synced_at(sheet_name) or 0) < _started_at:
+            sync_sheet(sheet_name)
+    while True:
+        time.sleep(MIRROR_SYNC_SECONDS)
+        for sheet_name in get_mirror().synced_sheets():
+            sync_sheet(sheet_name)
+
+
+def _ensure_sync_thread():
+    global _sync_thread
+
+    with _mirror_lock:
+        if _sync_thread is not None:
+            return
+        _sync_thread = threading.Thread(target=_sync_loop, name="sheets-mirror-sync", daemon=True)
+        _sync_thread.start()
+
+
+def mirrored(sheet_name):
+    """
+    Get the mirror for reading a sheet, loading the sheet on first use
+
+    Returns:
+        SheetMirror
+    """
+    mirror = get_mirror()
+    if mirror.synced_at(sheet_name) is None:
+        sync_sheet(sheet_name)
+    _ensure_sync_thread()
+    return mirror
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""
+Teleconsult Queue Engine Module
+In-memory priority queue for waiting teleconsult sessions
+
+The heap is the source of truth for queue order. Every change is appended
+to a local journal first (so a restart replays the queue) and then written
+to the TeleconsultQueue sheet in the background. Gunicorn workers on the
+same host share the journal: each change is made under a lock file after
+replaying the other workers' entries. Nurses take sessions off the queue
+by editing the sheet's Status column; each mirror sync of the sheet drops
+those sessions from the journal too.
+"""
+import heapq
+import itertools
+import json
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from config import (
+    SHEET_HEADERS,
+    SHEET_TELECONSULT_QUEUE,
+    QUEUE_JOURNAL_PATH,
+    QUEUE_JOURNAL_COMPACT_LINES,
+    get_logger
+)
+from database.backend import get_backend
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process locking only
+    fcntl = None
+
+logger = get_logger(__name__)
+
+QUEUE_COLUMNS = SHEET_HEADERS[SHEET_TELECONSULT_QUEUE]
+
+
+class QueueEngine:
+    """
+    Waiting sessions ordered by (priority, timestamp)
+
+    Removal is lazy: the heap entry is blanked out and skipped when it
+    reaches the top, and the heap is rebuilt from the live entries once
+    blanked ones outnumber them. Pushing, popping and removing are
+    amortised O(log n); position() and the position enqueue() returns
+    count the waiting sessions, O(n) with n capped by MAX_QUEUE_SIZE.
+    Records are kept as {column: value} dicts in TeleconsultQueue layout.
+    """
+
+    def __init__(self, journal_path=QUEUE_JOURNAL_PATH):
+        self.journal_path = journal_path
+        self._heap = []
+        self._entries = {}    # Session_ID -> heap entry [priority, timestamp, seq, session_id]
+        self._records = {}    # Session_ID -> queue record
+        self._dead = 0        # Blanked entries still in the heap
+        self._counter = itertools.count()
+        self._journal_inode = None
+        self._journal_offset = 0
+        self._journal_lines = 0
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._depth = 0
+
+    # ---- heap ------------------------------------------------------------
+
+    def _push(self, record):
+        session_id = record['Session_ID']
+        if session_id in self._entries:
+            self._discard(session_id)
+        entry = [int(record.get('Priority') or 3), record.get('Timestamp', ''), next(self._counter), session_id]
+        self._entries[session_id] = entry
+        self._records[session_id] = record
+        heapq.heappush(self._heap, entry)
+
+    def _discard(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return None
+        entry[-1] = None
+        self._dead += 1
+        if self._dead > len(self._entries):
+            self._rebuild_heap()
+        return self._records.pop(session_id)
+
+    def _rebuild_heap(self):
+        """Heap of the live entries only"""
+        self._heap = list(self._entries.values())
+        heapq.heapify(self._heap)
+        self._dead = 0
+
+    def _skip_dead(self):
+        while self._heap and self._heap[0][-1] is None:
+            heapq.heappop(self._heap)
+            self._dead -= 1
+
+    def _pop(self):
+        self._skip_dead()
+        if not self._heap:
+            return None
+        entry = heapq.heappop(self._heap)
+        del self._entries[entry[-1]]
+        return self._records.pop(entry[-1])
+
+    # ---- journal ---------------------------------------------------------
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold the queue exclusively, across threads and worker processes
+
+        Takes the journal's lock file and replays whatever other workers
+        appended since we last looked, so checks made inside the block
+        (queue size, duplicates) see the current queue. Re-entrant.
+        """
+        with self._lock:
+            self._depth += 1
+            try:
+                if self._depth == 1:
+                    self._acquire_file_lock()
+                    self._catch_up()
+                yield self
+            finally:
+                if self._depth == 1:
+                    self._release_file_lock()
+                self._depth -= 1
+
+    def _acquire_file_lock(self):
+        if not self.journal_path or fcntl is None:
+            return
+        if self._lock_file is None:
+            self._lock_file = open(self.journal_path + ".lock", 'a')
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+
+    def _release_file_lock(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _reset(self):
+        self._heap = []
+        self._entries = {}
+        self._records = {}
+        self._dead = 0
+        self._journal_inode = None
+        self._journal_offset = 0
+        self._journal_lines = 0
+
+    def _catch_up(self):
+        """Apply journal lines written since our last read (by us or another worker)"""
+        if not self.journal_path:
+            return
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            if self._journal_inode is not None:
+                self._reset()
+            return
+
+        if stat.st_ino != self._journal_inode or stat.st_size < self._journal_offset:
+            # Compacted (replaced) by another worker: replay from the start
+            self._reset()
+            self._journal_inode = stat.st_ino
+        if stat.st_size == self._journal_offset:
+            return
+
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._journal_offset)
+            data = f.read()
+        # Only whole lines; a partial one is still being written
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Skipped bad queue journal line: {e}")
+            self._journal_lines += 1
+        self._journal_offset += end
+
+    def _journal(self, op):
+        if not self.journal_path:
+            return
+        with open(self.journal_path, 'ab') as f:
+            f.write((json.dumps(op, ensure_ascii=False) + "\n").encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            self._journal_offset = f.tell()
+            self._journal_inode = os.fstat(f.fileno()).st_ino
+        self._journal_lines += 1
+
+    def _maybe_compact(self):
+        if self.journal_path and self._journal_lines >= QUEUE_JOURNAL_COMPACT_LINES:
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the journal as one enqueue per waiting session"""
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            for record in self.ordered():
+                op = {'op': 'enqueue', 'record': record}
+                f.write((json.dumps(op, ensure_ascii=False) + "\n").encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            self._journal_offset = f.tell()
+            self._journal_inode = os.fstat(f.fileno()).st_ino
+        os.replace(tmp_path, self.journal_path)
+        self._journal_lines = len(self._entries)
+        self._rebuild_heap()
+
+    def _apply(self, op):
+        if op.get('op') == 'enqueue':
+            self._push(op['record'])
+        elif op.get('op') == 'remove':
+            self._discard(op.get('session_id'))
+
+    def has_journal(self):
+        """True if a journal exists (otherwise the queue starts from the sheet)"""
+        return bool(self.journal_path) and os.path.exists(self.journal_path)
+
+    def seed(self, records):
+        """Start from the sheet's waiting rows and write them as a fresh journal"""
+        with self.transaction():
+            for record in records:
+                self._push({c: record.get(c, '') for c in QUEUE_COLUMNS})
+            if self.journal_path:
+                self._compact()
+            logger.info("Seeded queue from sheet: %d waiting", len(self._entries))
+
+    # ---- operations ------------------------------------------------------
+
+    def enqueue(self, record, wait_per_position=None):
+        """
+        Add a waiting session
+
+        Args:
+            record: Queue record ({column: value}, TeleconsultQueue layout)
+            wait_per_position: Minutes per place in line; fills Estimated_Wait
+
+        Returns:
+            int: 1-based position of the session
+        """
+        with self.transaction():
+            key = (int(record.get('Priority') or 3), record.get('Timestamp', ''))
+            position = 1 + sum(
+                1 for other in self._entries.values()
+                if other[-1] != record['Session_ID'] and tuple(other[:2]) <= key
+            )
+            if wait_per_position is not None:
+                record['Estimated_Wait'] = str(position * wait_per_position)
+            self._journal({'op': 'enqueue', 'record': record})
+            self._push(record)
+            self._maybe_compact()
+            return position
+
+    def remove(self, session_id, status='removed'):
+        """
+        Take a session out of the queue
+
+        Returns:
+            dict: The removed record, or None if it was not waiting
+        """
+        with self.transaction():
+            if session_id not in self._entries:
+                return None
+            self._journal({'op': 'remove', 'session_id': session_id, 'status': status})
+            record = self._discard(session_id)
+            self._maybe_compact()
+            return record
+
+    def dequeue(self, status='assigned'):
+        """
+        Take the next session (lowest priority number, then oldest)
+
+        Returns:
+            dict: The record, or None if the queue is empty
+        """
+        with self.transaction():
+            self._skip_dead()
+            if not self._heap:
+                return None
+            session_id = self._heap[0][-1]
+            self._journal({'op': 'remove', 'session_id': session_id, 'status': status})
+            record = self._pop()
+            self._maybe_compact()
+            return record
+
+    def position(self, session_id):
+        """1-based position in priority order, or None if not waiting"""
+        with self.transaction():
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            key = entry[:3]
+            return 1 + sum(1 for other in self._entries.values() if other[:3] < key)
+
+    def ordered(self):
+        """Waiting records in the order they will be served"""
+        with self.transaction():
+            entries = sorted(self._entries.values())
+            return [dict(self._records[entry[-1]]) for entry in entries]
+
+    def find_user(self, user_id):
+        """Waiting record for a user, or None"""
+        with self.transaction():
+            for record in self._records.values():
+                if record.get('User_ID') == user_id:
+                    return dict(record)
+            return None
+
+    def __len__(self):
+        with self.transaction():
+            return len(self._entries)
+
+    def __contains__(self, session_id):
+        with self.transaction():
+            return session_id in self._entries
+
+
+# ---- sheet writer -------------------------------------------------------
+
+_sheet_ops = queue.Queue()
+_writer_thread = None
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def _writer_loop():
+    """Apply queue changes to the TeleconsultQueue sheet in order"""
+    while True:
+        op, payload = _sheet_ops.get()
+        try:
+            backend = get_backend()
+            if op == 'append':
+                ok = backend.append(SHEET_TELECONSULT_QUEUE, payload)
+            else:
+                session_id, status = payload
+                ok = backend.patch_row(SHEET_TELECONSULT_QUEUE, {'Session_ID': session_id}, {'Status': status})
+            if not ok:
+                logger.error(f"Queue sheet write failed: {op} {payload}")
+        except Exception as e:
+            logger.exception(f"Error writing queue change to sheet: {e}")
+        finally:
+            _sheet_ops.task_done()
+
+
+def _write_sheet(op, payload):
+    global _writer_thread
+
+    with _engine_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_writer_loop, name="teleconsult-queue-writer", daemon=True)
+            _writer_thread.start()
+    _sheet_ops.put((op, payload))
+
+
+def wait_for_sheet_writes():
+    """Block until queued sheet writes are done (shutdown, tests)"""
+    _sheet_ops.join()
+
+
+def get_queue_engine():
+    """
+    Get the process-wide queue (singleton pattern)
+
+    Replays the journal on first use, or seeds it from the sheet's
+    waiting rows when there is no journal yet.
+
+    Returns:
+        QueueEngine
+    """
+    global _engine
+
+    with _engine_lock:
+        if _engine is None:
+            engine = QueueEngine()
+            with engine.transaction():
+                if engine.has_journal():
+                    logger.info("Replayed queue journal: %d waiting", len(engine))
+                else:
+                    backend = get_backend()
+                    if backend.available():
+                        engine.seed(backend.scan_by_status(SHEET_TELECONSULT_QUEUE, 'waiting'))
+            _engine = engine
+            get_backend().watch(SHEET_TELECONSULT_QUEUE, reconcile_with_sheet)
+        return _engine
+
+
+def reconcile_with_sheet():
+    """
+    Drop sessions whose sheet row is no longer 'waiting'
+
+    Nurses assign or remove sessions in the TeleconsultQueue sheet. A
+    session without a row yet (its append is still on the way) stays.
+
+    Returns:
+        int: Number of sessions removed
+    """
+    engine = _engine
+    if engine is None:
+        return 0
+    waiting = [record['Session_ID'] for record in engine.ordered()]
+    if not waiting:
+        return 0
+
+    statuses = {}
+    for row in get_backend().find_by_key(SHEET_TELECONSULT_QUEUE, {'Session_ID': waiting}):
+        statuses[row.get('Session_ID')] = row.get('Status')  # Newest row last
+
+    removed = 0
+    for session_id, status in statuses.items():
+        if status and status != 'waiting' and engine.remove(session_id, status) is not None:
+            removed += 1
+    if removed:
+        logger.info("Dropped %d sessions taken off the queue sheet", removed)
+    return removed
+
+
+def enqueue_session(record, wait_per_position=None):
+    """
+    Queue a session and write its row to the sheet in the background
+
+    Args:
+        record: Queue record ({column: value})
+        wait_per_position: Minutes per place in line (sets Estimated_Wait)
+
+    Returns:
+        int: Position in priority order
+    """
+    position = get_queue_engine().enqueue(record, wait_per_position)
+    _write_sheet('append', [record.get(c, '') for c in QUEUE_COLUMNS])
+    return position
+
+
+def remove_session(session_id, status='removed'):
+    """
+    Remove a session from the queue (sheet row updated in the background)
+
+    Returns:
+        dict: The removed record, or None if it was not waiting
+    """
+    record = get_queue_engine().remove(session_id, status)
+    if record is not None:
+        _write_sheet('status', (session_id, status))
+    return record
+
+
+def dequeue_next(status='assigned'):
+    """
+    Take the next waiting session for a nurse
+
+    Returns:
+        dict: Queue record, or None if nobody is waiting
+    """
+    record = get_queue_engine().dequeue(status)
+    if record is not None:
+        _write_sheet('status', (record['Session_ID'], status))
+    return record
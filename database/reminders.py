@@ -10,7 +10,8 @@ from config import (
     SHEET_REMINDER_SCHEDULES,
     get_logger
 )
-from database.sheets import get_sheet_client
+from database.backend import get_backend
+from utils.tracing import traced
 
 logger = get_logger(__name__)
 
@@ -30,14 +31,11 @@ def save_reminder_schedule(user_id, discharge_date, reminder_type, scheduled_dat
         bool: True if successful, False otherwise
     """
     try:
-        client = get_sheet_client()
-        if not client:
-            logger.error("No sheet client available")
+        backend = get_backend()
+        if not backend.available():
+            logger.error("No storage backend available")
             return False
         
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_REMINDER_SCHEDULES)
-        
         timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
         discharge_str = discharge_date.strftime("%Y-%m-%d") if isinstance(discharge_date, datetime) else str(discharge_date)
         scheduled_str = scheduled_date.strftime("%Y-%m-%d %H:%M:%S") if isinstance(scheduled_date, datetime) else str(scheduled_date)
@@ -52,7 +50,8 @@ def save_reminder_schedule(user_id, discharge_date, reminder_type, scheduled_dat
             notes               # Notes
         ]
         
-        sheet.append_row(row, value_input_option="USER_ENTERED")
+        if not backend.append(SHEET_REMINDER_SCHEDULES, row):
+            return False
         logger.info(f"Scheduled {reminder_type} reminder for user {user_id} at {scheduled_str}")
         return True
         
@@ -73,32 +72,57 @@ def save_reminder_sent(user_id, reminder_type, message_text=""):
     Returns:
         bool: True if successful
     """
+    return save_reminders_sent([(user_id, reminder_type, message_text)])
+
+
+def save_reminders_sent(records):
+    """
+    Record a wave of sent reminders in bulk
+    
+    The rows are appended together (one append_rows through the write
+    buffer) and the schedule statuses updated with one patch.
+    
+    Args:
+        records: List of (user_id, reminder_type, message_text) tuples
+        
+    Returns:
+        bool: True if successful
+    """
+    if not records:
+        return True
+    
     try:
-        client = get_sheet_client()
-        if not client:
-            logger.error("No sheet client available")
+        backend = get_backend()
+        if not backend.available():
+            logger.error("No storage backend available")
             return False
         
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_FOLLOW_UP_REMINDERS)
-        
         timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
         
-        row = [
-            timestamp,          # Timestamp
-            user_id,           # User_ID
-            reminder_type,     # Reminder_Type
-            'sent',            # Status
-            '',                # Response_Text (empty for now)
-            message_text,      # Message_Sent
-            ''                 # Response_Timestamp (empty for now)
-        ]
+        for user_id, reminder_type, message_text in records:
+            row = [
+                timestamp,          # Timestamp
+                user_id,           # User_ID
+                reminder_type,     # Reminder_Type
+                'sent',            # Status
+                '',                # Response_Text (empty for now)
+                message_text,      # Message_Sent
+                ''                 # Response_Timestamp (empty for now)
+            ]
+            
+            if not backend.append(SHEET_FOLLOW_UP_REMINDERS, row):
+                return False
         
-        sheet.append_row(row, value_input_option="USER_ENTERED")
-        logger.info(f"Recorded reminder sent: {reminder_type} to {user_id}")
+        if len(records) == 1:
+            logger.info(f"Recorded reminder sent: {records[0][1]} to {records[0][0]}")
+        else:
+            logger.info(f"Recorded {len(records)} reminders sent")
         
         # Update schedule status
-        update_schedule_status(user_id, reminder_type, 'sent')
+        update_schedule_statuses([
+            (user_id, reminder_type, 'sent')
+            for user_id, reminder_type, _ in records
+        ])
         
         return True
         
@@ -120,50 +144,30 @@ def save_reminder_response(user_id, reminder_type, response_text):
         bool: True if successful
     """
     try:
-        client = get_sheet_client()
-        if not client:
-            logger.error("No sheet client available")
+        backend = get_backend()
+        if not backend.available():
+            logger.error("No storage backend available")
             return False
         
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_FOLLOW_UP_REMINDERS)
-        
-        # Get all values safely
-        all_values = sheet.get_all_values()
-        
-        # If sheet is not empty, try to find matching record
-        if all_values and len(all_values) > 1:
-            headers = all_values[0]
+        # Update the most recent 'sent' record for this reminder
+        response_timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        found = backend.patch_row(
+            SHEET_FOLLOW_UP_REMINDERS,
+            {'User_ID': user_id, 'Reminder_Type': reminder_type, 'Status': 'sent'},
+            {
+                'Status': 'responded',
+                'Response_Text': response_text,
+                'Response_Timestamp': response_timestamp
+            }
+        )
+        
+        if found:
+            logger.info(f"Recorded response from {user_id} for {reminder_type}")
             
-            # Search backwards (most recent first)
-            for i in range(len(all_values) - 1, 0, -1):  # Start from end, skip header
-                row = all_values[i]
-                if len(row) >= len(headers):
-                    record = dict(zip(headers, row))
-                    
-                    if (record.get('User_ID') == user_id and 
-                        record.get('Reminder_Type') == reminder_type and
-                        record.get('Status') == 'sent'):
-                        
-                        # Update this row
-                        row_num = i + 1  # +1 for 1-indexed
-                        response_timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
-                        
-                        # Find column indices
-                        status_col = headers.index('Status') + 1 if 'Status' in headers else 4
-                        response_col = headers.index('Response_Text') + 1 if 'Response_Text' in headers else 5
-                        timestamp_col = headers.index('Response_Timestamp') + 1 if 'Response_Timestamp' in headers else 7
-                        
-                        sheet.update_cell(row_num, status_col, 'responded')
-                        sheet.update_cell(row_num, response_col, response_text)
-                        sheet.update_cell(row_num, timestamp_col, response_timestamp)
-                        
-                        logger.info(f"Recorded response from {user_id} for {reminder_type}")
-                        
-                        # Update schedule status
-                        update_schedule_status(user_id, reminder_type, 'responded')
-                        
-                        return True
+            # Update schedule status
+            update_schedule_status(user_id, reminder_type, 'responded')
+            
+            return True
         
         # If no 'sent' record found, create a new 'responded' record anyway
         timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
@@ -176,7 +180,8 @@ def save_reminder_response(user_id, reminder_type, response_text):
             '',  # Message_Sent (unknown)
             timestamp  # Response_Timestamp
         ]
-        sheet.append_row(row, value_input_option="USER_ENTERED")
+        if not backend.append(SHEET_FOLLOW_UP_REMINDERS, row):
+            return False
         logger.warning(f"No 'sent' record found for {user_id}/{reminder_type}, created new responded record")
         
         return True
@@ -195,39 +200,38 @@ def update_schedule_status(user_id, reminder_type, new_status):
         reminder_type: Type of reminder
         new_status: New status (sent, responded, no_response)
     """
+    update_schedule_statuses([(user_id, reminder_type, new_status)])
+
+
+def update_schedule_statuses(updates):
+    """
+    Update the status of several scheduled reminders in one pass
+    
+    All changes are written with a single backend patch (one batch_update
+    on Google Sheets).
+    
+    Args:
+        updates: List of (user_id, reminder_type, new_status) tuples
+    """
+    if not updates:
+        return
+    
     try:
-        client = get_sheet_client()
-        if not client:
+        backend = get_backend()
+        if not backend.available():
             return
         
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_REMINDER_SCHEDULES)
-        
-        # Get all values safely
-        all_values = sheet.get_all_values()
-        
-        if not all_values or len(all_values) <= 1:
-            logger.warning("ReminderSchedules sheet is empty, cannot update status")
-            return
-        
-        headers = all_values[0]
-        
-        # Find status column index
-        status_col = headers.index('Status') + 1 if 'Status' in headers else 6
+        patches = [
+            ({'User_ID': user_id, 'Reminder_Type': reminder_type}, {'Status': new_status})
+            for user_id, reminder_type, new_status in updates
+        ]
+        results = backend.patch_rows(SHEET_REMINDER_SCHEDULES, patches)
         
-        # Find the matching schedule (search backwards for most recent)
-        for i in range(len(all_values) - 1, 0, -1):
-            row = all_values[i]
-            if len(row) >= len(headers):
-                record = dict(zip(headers, row))
-                
-                if (record.get('User_ID') == user_id and 
-                    record.get('Reminder_Type') == reminder_type):
-                    
-                    row_num = i + 1
-                    sheet.update_cell(row_num, status_col, new_status)
-                    logger.info(f"Updated schedule status: {user_id}/{reminder_type} -> {new_status}")
-                    return
+        for (user_id, reminder_type, new_status), found in zip(updates, results):
+            if found:
+                logger.info(f"Updated schedule status: {user_id}/{reminder_type} -> {new_status}")
+            else:
+                logger.warning(f"No schedule found for {user_id}/{reminder_type}")
                 
     except Exception as e:
         logger.exception(f"Error updating schedule status: {e}")
@@ -245,41 +249,42 @@ def get_pending_reminders(user_id, reminder_type):
         list: List of pending reminders
     """
     try:
-        client = get_sheet_client()
-        if not client:
+        backend = get_backend()
+        if not backend.available():
             return []
         
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_FOLLOW_UP_REMINDERS)
-        
-        # Get all values safely
-        all_values = sheet.get_all_values()
-        
-        # Check if empty
-        if not all_values or len(all_values) <= 1:
-            logger.info("FollowUpReminders sheet is empty")
-            return []
+        # Filter pending reminders
+        match = {'User_ID': user_id}
+        if reminder_type is not None:
+            match['Reminder_Type'] = reminder_type
         
-        # Parse records
-        headers = all_values[0]
-        records = []
+        return backend.scan_by_status(SHEET_FOLLOW_UP_REMINDERS, 'sent', match)
         
-        for row in all_values[1:]:
-            if len(row) >= len(headers):
-                record = dict(zip(headers, row))
-                records.append(record)
+    except Exception as e:
+        logger.exception(f"Error getting pending reminders: {e}")
+        return []
+
+
+@traced
+def get_user_reminders(user_id):
+    """
+    Get every sent reminder for a user, newest first
+    
+    Args:
+        user_id: User ID
         
-        # Filter pending reminders
-        pending = []
-        for record in records:
-            if record.get('User_ID') == user_id and record.get('Status') == 'sent':
-                if reminder_type is None or record.get('Reminder_Type') == reminder_type:
-                    pending.append(record)
+    Returns:
+        list: FollowUpReminders rows (any status)
+    """
+    try:
+        backend = get_backend()
+        if not backend.available():
+            return []
         
-        return pending
+        return backend.find_by_key(SHEET_FOLLOW_UP_REMINDERS, {'User_ID': user_id}, newest_first=True)
         
     except Exception as e:
-        logger.exception(f"Error getting pending reminders: {e}")
+        logger.exception(f"Error getting reminders for {user_id}: {e}")
         return []
 
 
@@ -291,34 +296,12 @@ def get_scheduled_reminders():
         list: List of scheduled reminders
     """
     try:
-        client = get_sheet_client()
-        if not client:
-            return []
-        
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_REMINDER_SCHEDULES)
-        
-        # Get all values (safer than get_all_records for empty sheets)
-        all_values = sheet.get_all_values()
-        
-        # Check if sheet is empty or has only headers
-        if not all_values or len(all_values) <= 1:
-            logger.info("ReminderSchedules sheet is empty (no data rows)")
+        backend = get_backend()
+        if not backend.available():
             return []
         
-        # Parse records manually
-        headers = all_values[0]
-        records = []
-        
-        for row in all_values[1:]:  # Skip header
-            if len(row) >= len(headers):
-                record = dict(zip(headers, row))
-                records.append(record)
-        
         # Filter for scheduled status
-        scheduled = [r for r in records if r.get('Status') == 'scheduled']
-        
-        return scheduled
+        return backend.scan_by_status(SHEET_REMINDER_SCHEDULES, 'scheduled')
         
     except Exception as e:
         logger.exception(f"Error getting scheduled reminders: {e}")
@@ -333,61 +316,60 @@ def check_no_response_reminders():
         list: List of reminders with no response after 24 hours
     """
     try:
-        client = get_sheet_client()
-        if not client:
+        backend = get_backend()
+        if not backend.available():
             return []
         
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_FOLLOW_UP_REMINDERS)
+        sent = backend.scan_by_status(SHEET_FOLLOW_UP_REMINDERS, 'sent')
         
-        # Get all values safely
-        all_values = sheet.get_all_values()
-        
-        if not all_values or len(all_values) <= 1:
-            logger.info("FollowUpReminders sheet is empty, no reminders to check")
+        if not sent:
+            logger.info("No sent reminders awaiting a response")
             return []
         
-        headers = all_values[0]
-        
-        # Find column indices
-        status_col = headers.index('Status') + 1 if 'Status' in headers else 4
-        
         no_response = []
         now = datetime.now(tz=LOCAL_TZ)
         
-        for i in range(1, len(all_values)):  # Skip header
-            row = all_values[i]
-            if len(row) >= len(headers):
-                record = dict(zip(headers, row))
-                
-                if record.get('Status') == 'sent':
-                    # Check if sent more than 24 hours ago
-                    timestamp_str = record.get('Timestamp', '')
-                    if timestamp_str:
-                        try:
-                            sent_time = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-                            sent_time = sent_time.replace(tzinfo=LOCAL_TZ)
-                            
-                            hours_passed = (now - sent_time).total_seconds() / 3600
-                            
-                            if hours_passed >= 24:
-                                # Mark as no_response
-                                row_num = i + 1
-                                sheet.update_cell(row_num, status_col, 'no_response')
-                                
-                                record['row_num'] = row_num
-                                record['hours_passed'] = hours_passed
-                                no_response.append(record)
-                                
-                                # Update schedule status
-                                update_schedule_status(
-                                    record.get('User_ID'),
-                                    record.get('Reminder_Type'),
-                                    'no_response'
-                                )
-                                
-                        except Exception as e:
-                            logger.warning(f"Error parsing timestamp {timestamp_str}: {e}")
+        for record in sent:
+            # Check if sent more than 24 hours ago
+            timestamp_str = record.get('Timestamp', '')
+            if timestamp_str:
+                try:
+                    sent_time = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
+                    sent_time = sent_time.replace(tzinfo=LOCAL_TZ)
+                    
+                    hours_passed = (now - sent_time).total_seconds() / 3600
+                    
+                    if hours_passed >= 24:
+                        record['hours_passed'] = hours_passed
+                        no_response.append(record)
+                        
+                except Exception as e:
+                    logger.warning(f"Error parsing timestamp {timestamp_str}: {e}")
+        
+        if not no_response:
+            logger.info("Found 0 reminders with no response after 24h")
+            return []
+        
+        # Mark as no_response
+        results = backend.patch_rows(SHEET_FOLLOW_UP_REMINDERS, [
+            (
+                {
+                    'User_ID': record.get('User_ID'),
+                    'Reminder_Type': record.get('Reminder_Type'),
+                    'Timestamp': record.get('Timestamp'),
+                    'Status': 'sent'
+                },
+                {'Status': 'no_response'}
+            )
+            for record in no_response
+        ])
+        no_response = [record for record, found in zip(no_response, results) if found]
+        
+        # Update schedule status
+        update_schedule_statuses([
+            (record.get('User_ID'), record.get('Reminder_Type'), 'no_response')
+            for record in no_response
+        ])
         
         logger.info(f"Found {len(no_response)} reminders with no response after 24h")
         return no_response
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Row Index Module
+Remember which sheet row holds each key, so updates skip get_all_values
+"""
+import threading
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
+from config import SHEET_ROW_KEYS, get_logger
+from utils.ratelimit import call_api
+
+logger = get_logger(__name__)
+
+
+class RowLocator:
+    """
+    Key value -> 1-based row number for one worksheet
+
+    Filled from append responses and from full downloads. When a key
+    appears more than once the bottom-most (newest) row wins, like the scans it
+    replaces. Rows nurses insert, sort or delete by hand shift positions,
+    so locate_all() reads a cached row's key cell back before using it, and
+    the index is rebuilt on a miss or mismatch and on every mirror sync.
+    """
+
+    def __init__(self, sheet_name, key_column):
+        self.sheet_name = sheet_name
+        self.key_column = key_column
+        self._rows = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def record(self, key, row_num):
+        """Remember the row of a newly appended key"""
+        if not key:
+            return
+        with self._lock:
+            if row_num >= self._rows.get(key, 0):
+                self._rows[key] = row_num
+
+    def load(self, keys, first_row=2):
+        """
+        Replace the index with a column of keys
+
+        Args:
+            keys: Key values in sheet order (no header)
+            first_row: Row number of the first key
+        """
+        rows = {}
+        for offset, key in enumerate(keys):
+            if key:
+                rows[key] = first_row + offset
+        with self._lock:
+            self._rows = rows
+            self._loaded = True
+
+    def get(self, key):
+        with self._lock:
+            return self._rows.get(key)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+
+_locators = {}
+_locators_lock = threading.Lock()
+
+
+def get_locator(sheet_name):
+    """
+    Get the row locator for a sheet
+    Returns: RowLocator, or None if the sheet has no key column
+    """
+    key_column = SHEET_ROW_KEYS.get(sheet_name)
+    if not key_column:
+        return None
+    with _locators_lock:
+        locator = _locators.get(sheet_name)
+        if locator is None:
+            locator = RowLocator(sheet_name, key_column)
+            _locators[sheet_name] = locator
+        return locator
+
+
+def _start_row(response):
+    """First row number written by an append, from its updatedRange"""
+    try:
+        updated = response['updates']['updatedRange']
+        first_cell = updated.split('!')[-1].split(':')[0]
+        return a1_to_rowcol(first_cell)[0]
+    except (KeyError, TypeError, ValueError, IndexError):
+        return None
+
+
+def record_appended(sheet_name, headers, rows, response):
+    """
+    Index rows just written with append_row/append_rows
+
+    Args:
+        sheet_name: Worksheet title
+        headers: Header row of the worksheet
+        rows: The appended rows, in the order they were sent
+        response: API response of the append call
+    """
+    locator = get_locator(sheet_name)
+    if locator is None or locator.key_column not in headers:
+        return
+    start_row = _start_row(response)
+    if start_row is None:
+        logger.warning("Append to %s returned no updatedRange, row index not updated", sheet_name)
+        return
+    position = headers.index(locator.key_column)
+    for offset, row in enumerate(rows):
+        if position < len(row):
+            locator.record(str(row[position]), start_row + offset)
+
+
+def load_values(sheet_name, all_values):
+    """Rebuild a sheet's index from a full download (header row first)"""
+    locator = get_locator(sheet_name)
+    if locator is None or not all_values:
+        return
+    headers = all_values[0]
+    if locator.key_column not in headers:
+        return
+    position = headers.index(locator.key_column)
+    locator.load([row[position] if position < len(row) else '' for row in all_values[1:]])
+
+
+def locate_all(sheet_name, keys):
+    """
+    Find the rows holding keys, reloading the key column once if needed
+
+    Cached row numbers are checked with one batch_get of their key cells;
+    a row that no longer holds its key counts as a miss.
+
+    Args:
+        sheet_name: Worksheet title
+        keys: Values of the sheet's key column
+
+    Returns:
+        list: 1-based row numbers, None where a key is not in the sheet
+    """
+    # Imported here: database.sheets and write_buffer record into this module
+    from database.sheets import get_worksheet, get_headers
+
+    keys = [str(key) for key in keys]
+    locator = get_locator(sheet_name)
+    if locator is None or not keys:
+        return [None] * len(keys)
+    headers = get_headers(sheet_name)
+    if locator.key_column not in headers:
+        return [None] * len(keys)
+    sheet = get_worksheet(sheet_name)
+    if not sheet:
+        return [None] * len(keys)
+    col = headers.index(locator.key_column) + 1
+
+    rows = {key: locator.get(key) for key in keys}
+    cached = [(key, row_num) for key, row_num in rows.items() if row_num is not None]
+    if cached:
+        cells = call_api('sheets', sheet.batch_get, [rowcol_to_a1(row_num, col) for _, row_num in cached])
+        for (key, row_num), cell in zip(cached, cells):
+            value = cell[0][0] if cell and cell[0] else ''
+            if value != key:
+                logger.info("%s row %d no longer holds %s", sheet_name, row_num, key)
+                rows[key] = None
+
+    if None in rows.values():
+        # Miss: the row may have been added or moved by hand
+        column = call_api('sheets', sheet.col_values, col)
+        locator.load(column[1:])
+        logger.info("Reloaded %s row index (%d rows)", sheet_name, max(len(column) - 1, 0))
+        rows = {key: row_num if row_num is not None else locator.get(key) for key, row_num in rows.items()}
+
+    return [rows[key] for key in keys]
+
+
+def locate(sheet_name, key):
+    """
+    Find the row holding a key (see locate_all)
+
+    Returns:
+        int: 1-based row number, or None if the key is not in the sheet
+    """
+    return locate_all(sheet_name, [key])[0]
@@ -6,22 +6,41 @@ Handles all interactions with Google Sheets
 import gspread
 import json
 import os
+import threading
+import time
 from datetime import datetime
+from gspread.exceptions import APIError, SpreadsheetNotFound, WorksheetNotFound
+from gspread.utils import rowcol_to_a1
 from config import (
     get_logger,
     LOCAL_TZ,
     GSPREAD_CREDENTIALS,
     SPREADSHEET_NAME,
+    SHEET_HEADERS,
+    WORKSHEET_CACHE_TTL,
     SHEET_SYMPTOM_LOG,
     SHEET_RISK_PROFILE,
     SHEET_APPOINTMENTS
 )
+from database.backend import get_backend
+from utils.ratelimit import call_api
+from utils.tracing import traced
 
 logger = get_logger(__name__)
 
 # Module-level client cache
 _sheet_client = None
 
+# Worksheet handle registry: resolved once, reused until TTL or a stale-handle error
+_spreadsheet = None
+_spreadsheet_opened_at = 0.0
+_worksheets = {}
+_headers = {}
+_registry_lock = threading.RLock()
+
+# HTTP statuses that mean a cached handle (or the client behind it) is no longer valid
+_STALE_HANDLE_STATUSES = (401, 403, 404)
+
 
 def get_sheet_client():
     """
@@ -54,19 +73,191 @@ def get_sheet_client():
     return None
 
 
-def save_symptom_data(user_id, pain, wound, fever, mobility, risk_level, risk_score):
+def _get_spreadsheet():
     """
-    Save symptom report to SymptomLog sheet
-    Returns: boolean (success/failure)
+    Get the opened KhwanBot_Data spreadsheet, re-opening it after the TTL
+    Returns: gspread Spreadsheet or None
     """
-    try:
+    global _spreadsheet, _spreadsheet_opened_at
+    
+    with _registry_lock:
+        if (_spreadsheet is not None and
+                time.monotonic() - _spreadsheet_opened_at < WORKSHEET_CACHE_TTL):
+            return _spreadsheet
+        
         client = get_sheet_client()
         if not client:
+            return None
+        
+        _spreadsheet = call_api('sheets', client.open, SPREADSHEET_NAME)
+        _spreadsheet_opened_at = time.monotonic()
+        
+        # One metadata call resolves every worksheet in the spreadsheet
+        _worksheets.clear()
+        _headers.clear()
+        for worksheet in call_api('sheets', _spreadsheet.worksheets):
+            _worksheets[worksheet.title] = worksheet
+        
+        logger.info("Opened spreadsheet %s (%d worksheets cached)",
+                    SPREADSHEET_NAME, len(_worksheets))
+        return _spreadsheet
+
+
+@traced
+def get_worksheet(sheet_name):
+    """
+    Get a cached worksheet handle by name
+    
+    The spreadsheet is opened once and every worksheet handle is kept for
+    WORKSHEET_CACHE_TTL seconds, so callers go straight to the read/write call.
+    
+    Args:
+        sheet_name: Worksheet title (see SHEET_* in config)
+    
+    Returns:
+        gspread Worksheet or None if no client is available
+    """
+    with _registry_lock:
+        spreadsheet = _get_spreadsheet()
+        if spreadsheet is None:
+            return None
+        
+        worksheet = _worksheets.get(sheet_name)
+        if worksheet is None:
+            # Sheet added after the spreadsheet was opened
+            worksheet = call_api('sheets', spreadsheet.worksheet, sheet_name)
+            _worksheets[sheet_name] = worksheet
+        
+        return worksheet
+
+
+def invalidate_worksheets():
+    """Drop all cached handles so the next call re-opens the spreadsheet"""
+    global _spreadsheet
+    
+    with _registry_lock:
+        _spreadsheet = None
+        _worksheets.clear()
+        _headers.clear()
+
+
+def discard_stale_worksheet(sheet_name, error):
+    """
+    Refresh cached handles if an error shows they are no longer valid
+    
+    Call from an except block around worksheet operations. Auth errors also
+    drop the client so credentials are rebuilt on the next request.
+    
+    Args:
+        sheet_name: Worksheet the failed operation used
+        error: The exception that was raised
+    
+    Returns:
+        bool: True if the cache was invalidated
+    """
+    global _sheet_client
+    
+    if isinstance(error, (WorksheetNotFound, SpreadsheetNotFound)):
+        logger.warning("Worksheet %s not found, refreshing handles", sheet_name)
+        invalidate_worksheets()
+        return True
+    
+    if isinstance(error, APIError):
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+        if status in _STALE_HANDLE_STATUSES:
+            logger.warning("Sheets API %s on %s, refreshing handles", status, sheet_name)
+            with _registry_lock:
+                if status == 401:
+                    _sheet_client = None
+                invalidate_worksheets()
+            return True
+    
+    return False
+
+
+def get_headers(sheet_name):
+    """
+    Get a worksheet's header row (cached alongside its handle)
+    
+    Args:
+        sheet_name: Worksheet title
+    
+    Returns:
+        list: Column names, SHEET_HEADERS default if the sheet has none
+    """
+    with _registry_lock:
+        if sheet_name in _headers:
+            return _headers[sheet_name]
+    
+    sheet = get_worksheet(sheet_name)
+    headers = call_api('sheets', sheet.row_values, 1) if sheet else []
+    if not headers:
+        headers = SHEET_HEADERS.get(sheet_name, [])
+    
+    with _registry_lock:
+        _headers[sheet_name] = headers
+    return headers
+
+
+def patch_rows(sheet_name, changes, headers=None):
+    """
+    Update cells in several rows with a single batch_update call
+    
+    Args:
+        sheet_name: Worksheet title
+        changes: {row_number: {column_name: value}} (row numbers are 1-based)
+        headers: Header row if the caller already has it
+    
+    Returns:
+        bool: True if all cells were written
+    """
+    if not changes:
+        return True
+    
+    try:
+        sheet = get_worksheet(sheet_name)
+        if not sheet:
             logger.error("No gspread client available")
             return False
         
-        spreadsheet = client.open(SPREADSHEET_NAME)
-        sheet = spreadsheet.worksheet(SHEET_SYMPTOM_LOG)
+        headers = headers or get_headers(sheet_name)
+        defaults = SHEET_HEADERS.get(sheet_name, [])
+        
+        data = []
+        for row_num, values in changes.items():
+            for column, value in values.items():
+                if column in headers:
+                    col = headers.index(column) + 1
+                elif column in defaults:
+                    col = defaults.index(column) + 1
+                else:
+                    raise KeyError(f"Unknown column {column} in {sheet_name}")
+                data.append({
+                    'range': rowcol_to_a1(row_num, col),
+                    'values': [[value]]
+                })
+        
+        call_api('sheets', sheet.batch_update, data, value_input_option="USER_ENTERED")
+        logger.debug("Patched %d cells in %d rows of %s", len(data), len(changes), sheet_name)
+        return True
+    
+    except Exception as e:
+        discard_stale_worksheet(sheet_name, e)
+        logger.exception(f"Error patching rows in {sheet_name}: {e}")
+        return False
+
+
+@traced
+def save_symptom_data(user_id, pain, wound, fever, mobility, risk_level, risk_score):
+    """
+    Save symptom report to SymptomLog sheet
+    Returns: boolean (success/failure)
+    """
+    try:
+        backend = get_backend()
+        if not backend.available():
+            logger.error("No storage backend available")
+            return False
         
         timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
         row = [
@@ -80,8 +271,9 @@ def save_symptom_data(user_id, pain, wound, fever, mobility, risk_level, risk_sc
             risk_score
         ]
         
-        sheet.append_row(row, value_input_option='USER_ENTERED')
-        logger.info("Symptom data saved for user %s", user_id)
+        if not backend.append(SHEET_SYMPTOM_LOG, row):
+            return False
+        logger.info("Symptom data queued for user %s", user_id)
         return True
     
     except Exception:
@@ -89,20 +281,18 @@ def save_symptom_data(user_id, pain, wound, fever, mobility, risk_level, risk_sc
         return False
 
 
+@traced
 def save_profile_data(user_id, age, weight, height, bmi, diseases, risk_level, risk_score):
     """
     Save risk profile to RiskProfile sheet
     Returns: boolean (success/failure)
     """
     try:
-        client = get_sheet_client()
-        if not client:
-            logger.error("No gspread client available")
+        backend = get_backend()
+        if not backend.available():
+            logger.error("No storage backend available")
             return False
         
-        spreadsheet = client.open(SPREADSHEET_NAME)
-        sheet = spreadsheet.worksheet(SHEET_RISK_PROFILE)
-        
         timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
         diseases_str = ", ".join(diseases) if isinstance(diseases, list) else str(diseases)
         
@@ -118,8 +308,9 @@ def save_profile_data(user_id, age, weight, height, bmi, diseases, risk_level, r
             risk_score
         ]
         
-        sheet.append_row(row, value_input_option='USER_ENTERED')
-        logger.info("Profile data saved for user %s", user_id)
+        if not backend.append(SHEET_RISK_PROFILE, row):
+            return False
+        logger.info("Profile data queued for user %s", user_id)
         return True
     
     except Exception:
@@ -127,6 +318,7 @@ def save_profile_data(user_id, age, weight, height, bmi, diseases, risk_level, r
         return False
 
 
+@traced
 def save_appointment_data(user_id, name, phone, preferred_date, preferred_time, 
                           reason, status="New", assigned_to="", notes=""):
     """
@@ -134,14 +326,11 @@ def save_appointment_data(user_id, name, phone, preferred_date, preferred_time,
     Returns: boolean (success/failure)
     """
     try:
-        client = get_sheet_client()
-        if not client:
-            logger.error("No gspread client available")
+        backend = get_backend()
+        if not backend.available():
+            logger.error("No storage backend available")
             return False
         
-        spreadsheet = client.open(SPREADSHEET_NAME)
-        sheet = spreadsheet.worksheet(SHEET_APPOINTMENTS)
-        
         timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
         row = [
             timestamp,
@@ -156,8 +345,9 @@ def save_appointment_data(user_id, name, phone, preferred_date, preferred_time,
             notes
         ]
         
-        sheet.append_row(row, value_input_option="USER_ENTERED")
-        logger.info("Appointment saved for user %s", user_id)
+        if not backend.append(SHEET_APPOINTMENTS, row):
+            return False
+        logger.info("Appointment queued for user %s", user_id)
         return True
     
     except Exception:
@@ -3,18 +3,34 @@
 Teleconsult Database Module
 Handle all database operations for teleconsult sessions and queue
 """
+import threading
 import uuid
 from datetime import datetime
 from config import (
     LOCAL_TZ,
+    ISSUE_CATEGORIES,
+    MAX_QUEUE_SIZE,
+    SHEET_HEADERS,
     SHEET_TELECONSULT_SESSIONS,
-    SHEET_TELECONSULT_QUEUE,
     get_logger
 )
-from database.sheets import get_sheet_client
+from database.backend import get_backend
+from database.queue_engine import get_queue_engine, enqueue_session, remove_session
+from utils.tracing import traced
 
 logger = get_logger(__name__)
 
+ACTIVE_STATUSES = ('queued', 'in_progress')
+
+# User_ID -> active session record ({column: value}), plus the reverse map
+# used when a status update only knows the Session_ID. Built from one scan
+# and kept current by create_session / update_session_status; rebuilt if
+# the table changes under us (another worker, or a sync from the sheet).
+_active_sessions = {}
+_active_session_users = {}
+_active_index_key = None
+_active_index_lock = threading.RLock()
+
 
 def generate_session_id():
     """Generate unique session ID"""
@@ -26,7 +42,79 @@ def generate_queue_id():
     return f"Q{datetime.now(tz=LOCAL_TZ).strftime('%Y%m%d%H%M%S')}{str(uuid.uuid4())[:6]}"
 
 
-def create_session(user_id, issue_type, priority, description=""):
+def _active_index(backend):
+    """
+    Return the User_ID -> active session index, (re)building it if needed
+
+    Args:
+        backend: Storage backend in use
+
+    Returns:
+        dict: The index (callers must hold _active_index_lock)
+    """
+    global _active_index_key
+
+    key = (id(backend), backend.version(SHEET_TELECONSULT_SESSIONS))
+    if key != _active_index_key:
+        records = backend.find_by_key(
+            SHEET_TELECONSULT_SESSIONS,
+            {'Status': list(ACTIVE_STATUSES)}
+        )
+        _active_sessions.clear()
+        _active_session_users.clear()
+        # Oldest first, so the newest session wins for each user
+        for record in records:
+            _active_sessions[record.get('User_ID')] = record
+            _active_session_users[record.get('Session_ID')] = record.get('User_ID')
+        # The scan itself may have triggered a first sync
+        _active_index_key = (id(backend), backend.version(SHEET_TELECONSULT_SESSIONS))
+        logger.info(f"Indexed {len(_active_sessions)} active teleconsult sessions")
+    return _active_sessions
+
+
+def _index_session(backend, version_before, record):
+    """
+    Record a session this process just wrote as active
+
+    Args:
+        backend: Storage backend in use
+        version_before: backend.version() taken before the write
+        record: Session record ({column: value})
+    """
+    global _active_index_key
+
+    with _active_index_lock:
+        if _active_index_key != (id(backend), version_before):
+            # Something else changed the table too; the rebuild picks up our row
+            _active_index(backend)
+            return
+        user_id = record.get('User_ID')
+        _active_sessions[user_id] = record
+        _active_session_users[record.get('Session_ID')] = user_id
+        _active_index_key = (id(backend), backend.version(SHEET_TELECONSULT_SESSIONS))
+
+
+def _reindex_session(backend, version_before, session_id, changes):
+    """Apply a change this process just wrote (drops sessions that are no longer active)"""
+    global _active_index_key
+
+    with _active_index_lock:
+        if _active_index_key != (id(backend), version_before):
+            _active_index(backend)
+            return
+        user_id = _active_session_users.get(session_id)
+        record = _active_sessions.get(user_id)
+        if record is not None and record.get('Session_ID') == session_id:
+            if changes.get('Status', record.get('Status')) in ACTIVE_STATUSES:
+                record.update({k: str(v) for k, v in changes.items()})
+            else:
+                del _active_sessions[user_id]
+                del _active_session_users[session_id]
+        _active_index_key = (id(backend), backend.version(SHEET_TELECONSULT_SESSIONS))
+
+
+@traced
+def create_session(user_id, issue_type, priority, description="", session_id=None, queue_position=''):
     """
     Create a new teleconsult session
     
@@ -35,20 +123,19 @@ def create_session(user_id, issue_type, priority, description=""):
         issue_type: Category (emergency, medication, wound, appointment, other)
         priority: Priority level (1=high, 2=medium, 3=low)
         description: User's description of issue
+        session_id: ID to use (default: a new one)
+        queue_position: Position if already queued (saves patching it in later)
         
     Returns:
         dict: Session info or None if failed
     """
     try:
-        client = get_sheet_client()
-        if not client:
-            logger.error("No sheet client available")
+        backend = get_backend()
+        if not backend.available():
+            logger.error("No storage backend available")
             return None
         
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_TELECONSULT_SESSIONS)
-        
-        session_id = generate_session_id()
+        session_id = session_id or generate_session_id()
         timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
         
         row = [
@@ -59,14 +146,18 @@ def create_session(user_id, issue_type, priority, description=""):
             str(priority),     # Priority
             'queued',          # Status
             description,       # Description
-            '',                # Queue_Position (set later)
+            str(queue_position),  # Queue_Position
             '',                # Assigned_Nurse
             '',                # Started_At
             '',                # Completed_At
             ''                 # Notes
         ]
         
-        sheet.append_row(row, value_input_option="USER_ENTERED")
+        version_before = backend.version(SHEET_TELECONSULT_SESSIONS)
+        if not backend.append(SHEET_TELECONSULT_SESSIONS, row):
+            return None
+        
+        _index_session(backend, version_before, dict(zip(SHEET_HEADERS[SHEET_TELECONSULT_SESSIONS], row)))
         
         logger.info(f"Created teleconsult session: {session_id} for {user_id}")
         
@@ -84,6 +175,7 @@ def create_session(user_id, issue_type, priority, description=""):
         return None
 
 
+@traced
 def add_to_queue(session_id, user_id, issue_type, priority):
     """
     Add session to queue
@@ -98,67 +190,109 @@ def add_to_queue(session_id, user_id, issue_type, priority):
         dict: Queue info including position
     """
     try:
-        client = get_sheet_client()
-        if not client:
-            return None
-        
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_TELECONSULT_QUEUE)
+        queue_info = _enqueue(session_id, user_id, issue_type, priority)
         
-        # Get current queue to calculate position
-        all_values = sheet.get_all_values()
-        
-        # Count waiting entries
-        waiting_count = 0
-        if all_values and len(all_values) > 1:
-            headers = all_values[0]
-            for row in all_values[1:]:
-                if len(row) >= len(headers):
-                    record = dict(zip(headers, row))
-                    if record.get('Status') == 'waiting':
-                        waiting_count += 1
-        
-        queue_position = waiting_count + 1
-        
-        queue_id = generate_queue_id()
-        timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
-        
-        # Calculate estimated wait time based on priority
-        from config import ISSUE_CATEGORIES
-        max_wait = ISSUE_CATEGORIES.get(issue_type, {}).get('max_wait_minutes', 30)
-        estimated_wait = queue_position * max_wait
-        
-        row = [
-            queue_id,              # Queue_ID
-            timestamp,             # Timestamp
-            session_id,            # Session_ID
-            user_id,              # User_ID
-            issue_type,           # Issue_Type
-            str(priority),        # Priority
-            'waiting',            # Status
-            str(estimated_wait)   # Estimated_Wait
-        ]
+        # Update session with queue position
+        update_session_queue_position(session_id, queue_info['position'])
         
-        sheet.append_row(row, value_input_option="USER_ENTERED")
+        return queue_info
         
-        # Update session with queue position
-        update_session_queue_position(session_id, queue_position)
+    except Exception as e:
+        logger.exception(f"Error adding to queue: {e}")
+        return None
+
+
+def _enqueue(session_id, user_id, issue_type, priority):
+    """Put a session in the queue engine and build its queue info"""
+    queue_id = generate_queue_id()
+    timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    
+    # Calculate estimated wait time based on priority
+    max_wait = ISSUE_CATEGORIES.get(issue_type, {}).get('max_wait_minutes', 30)
+    
+    record = {
+        'Queue_ID': queue_id,
+        'Timestamp': timestamp,
+        'Session_ID': session_id,
+        'User_ID': user_id,
+        'Issue_Type': issue_type,
+        'Priority': str(priority),
+        'Status': 'waiting',
+        'Estimated_Wait': ''
+    }
+    
+    # Position in priority order, not arrival order
+    queue_position = enqueue_session(record, max_wait)
+    
+    logger.info(f"Added to queue: {session_id}, position {queue_position}")
+    
+    return {
+        'queue_id': queue_id,
+        'session_id': session_id,
+        'position': queue_position,
+        'estimated_wait': int(record['Estimated_Wait']),
+        'timestamp': timestamp
+    }
+
+
+@traced
+def admit_to_queue(user_id, issue_type, priority, description=""):
+    """
+    Create a session and queue it, unless the queue is full
+    
+    The size check, enqueue and session creation happen under the queue's
+    lock, so concurrent requests (in any gunicorn worker) cannot overshoot
+    MAX_QUEUE_SIZE or be handed the same position. The session is queued
+    first so its row is appended with Queue_Position already filled in;
+    the request makes no Sheets call of its own.
+    
+    Args:
+        user_id: Patient's LINE user ID
+        issue_type: Issue category
+        priority: Priority (1-3)
+        description: User's description of issue
         
-        logger.info(f"Added to queue: {session_id}, position {queue_position}")
+    Returns:
+        dict: {'admitted': bool, 'reason': 'queue_full' | 'already_queued' (if not),
+               'session': ..., 'queue': ...}, or None if failed
+    """
+    try:
+        engine = get_queue_engine()
+        
+        with engine.transaction():
+            if len(engine) >= MAX_QUEUE_SIZE:
+                return {'admitted': False, 'reason': 'queue_full'}
+            
+            # A second tap that reached another worker
+            waiting = engine.find_user(user_id)
+            if waiting:
+                return {
+                    'admitted': False,
+                    'reason': 'already_queued',
+                    'queue': waiting,
+                    'position': engine.position(waiting['Session_ID'])
+                }
+            
+            session_id = generate_session_id()
+            queue_info = _enqueue(session_id, user_id, issue_type, priority)
+            session = create_session(user_id, issue_type, priority, description,
+                                     session_id=session_id, queue_position=queue_info['position'])
+            if not session:
+                remove_session(session_id, status='cancelled')
+                return None
         
         return {
-            'queue_id': queue_id,
-            'session_id': session_id,
-            'position': queue_position,
-            'estimated_wait': estimated_wait,
-            'timestamp': timestamp
+            'admitted': True,
+            'session': session,
+            'queue': queue_info
         }
         
     except Exception as e:
-        logger.exception(f"Error adding to queue: {e}")
+        logger.exception(f"Error admitting to queue: {e}")
         return None
 
 
+@traced
 def update_session_status(session_id, new_status, assigned_nurse=None, notes=None):
     """
     Update session status
@@ -173,57 +307,36 @@ def update_session_status(session_id, new_status, assigned_nurse=None, notes=Non
         bool: Success
     """
     try:
-        client = get_sheet_client()
-        if not client:
+        backend = get_backend()
+        if not backend.available():
             return False
         
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_TELECONSULT_SESSIONS)
+        changes = {'Status': new_status}
         
-        all_values = sheet.get_all_values()
-        
-        if not all_values or len(all_values) <= 1:
-            logger.warning("Sessions sheet is empty")
+        # Update timestamps
+        timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        if new_status == 'in_progress':
+            changes['Started_At'] = timestamp
+        elif new_status == 'completed':
+            changes['Completed_At'] = timestamp
+        
+        # Update nurse if provided
+        if assigned_nurse:
+            changes['Assigned_Nurse'] = assigned_nurse
+        
+        # Update notes if provided
+        if notes:
+            changes['Notes'] = notes
+        
+        version_before = backend.version(SHEET_TELECONSULT_SESSIONS)
+        if not backend.patch_row(SHEET_TELECONSULT_SESSIONS, {'Session_ID': session_id}, changes):
+            logger.warning(f"Session {session_id} not found")
             return False
         
-        headers = all_values[0]
-        
-        # Find column indices
-        status_col = headers.index('Status') + 1 if 'Status' in headers else 6
-        nurse_col = headers.index('Assigned_Nurse') + 1 if 'Assigned_Nurse' in headers else 9
-        started_col = headers.index('Started_At') + 1 if 'Started_At' in headers else 10
-        completed_col = headers.index('Completed_At') + 1 if 'Completed_At' in headers else 11
-        notes_col = headers.index('Notes') + 1 if 'Notes' in headers else 12
-        
-        # Find the session
-        for i in range(1, len(all_values)):
-            row = all_values[i]
-            if len(row) > 0 and row[0] == session_id:
-                row_num = i + 1
-                
-                # Update status
-                sheet.update_cell(row_num, status_col, new_status)
-                
-                # Update timestamps
-                timestamp = datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
-                if new_status == 'in_progress':
-                    sheet.update_cell(row_num, started_col, timestamp)
-                elif new_status == 'completed':
-                    sheet.update_cell(row_num, completed_col, timestamp)
-                
-                # Update nurse if provided
-                if assigned_nurse:
-                    sheet.update_cell(row_num, nurse_col, assigned_nurse)
-                
-                # Update notes if provided
-                if notes:
-                    sheet.update_cell(row_num, notes_col, notes)
-                
-                logger.info(f"Updated session {session_id} status to {new_status}")
-                return True
-        
-        logger.warning(f"Session {session_id} not found")
-        return False
+        _reindex_session(backend, version_before, session_id, changes)
+        
+        logger.info(f"Updated session {session_id} status to {new_status}")
+        return True
         
     except Exception as e:
         logger.exception(f"Error updating session status: {e}")
@@ -233,34 +346,24 @@ def update_session_status(session_id, new_status, assigned_nurse=None, notes=Non
 def update_session_queue_position(session_id, position):
     """Update queue position in session"""
     try:
-        client = get_sheet_client()
-        if not client:
+        backend = get_backend()
+        if not backend.available():
             return False
         
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_TELECONSULT_SESSIONS)
-        
-        all_values = sheet.get_all_values()
-        
-        if not all_values or len(all_values) <= 1:
+        changes = {'Queue_Position': str(position)}
+        version_before = backend.version(SHEET_TELECONSULT_SESSIONS)
+        if not backend.patch_row(SHEET_TELECONSULT_SESSIONS, {'Session_ID': session_id}, changes):
             return False
         
-        headers = all_values[0]
-        pos_col = headers.index('Queue_Position') + 1 if 'Queue_Position' in headers else 8
-        
-        for i in range(1, len(all_values)):
-            if len(all_values[i]) > 0 and all_values[i][0] == session_id:
-                row_num = i + 1
-                sheet.update_cell(row_num, pos_col, str(position))
-                return True
-        
-        return False
+        _reindex_session(backend, version_before, session_id, changes)
+        return True
         
     except Exception as e:
         logger.exception(f"Error updating queue position: {e}")
         return False
 
 
+@traced
 def remove_from_queue(session_id):
     """
     Remove session from queue
@@ -272,37 +375,37 @@ def remove_from_queue(session_id):
         bool: Success
     """
     try:
-        client = get_sheet_client()
-        if not client:
+        if remove_session(session_id, 'removed') is None:
             return False
         
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_TELECONSULT_QUEUE)
-        
-        all_values = sheet.get_all_values()
-        
-        if not all_values or len(all_values) <= 1:
-            return False
-        
-        headers = all_values[0]
-        status_col = headers.index('Status') + 1 if 'Status' in headers else 7
-        
-        # Find and update status
-        for i in range(1, len(all_values)):
-            row = all_values[i]
-            if len(row) >= 3 and row[2] == session_id:  # Session_ID is column 3
-                row_num = i + 1
-                sheet.update_cell(row_num, status_col, 'removed')
-                logger.info(f"Removed session {session_id} from queue")
-                return True
-        
-        return False
+        logger.info(f"Removed session {session_id} from queue")
+        return True
         
     except Exception as e:
         logger.exception(f"Error removing from queue: {e}")
         return False
 
 
+@traced
+def get_queue_position(session_id):
+    """
+    Get a session's current place in the queue
+    
+    Args:
+        session_id: Session ID
+        
+    Returns:
+        int: 1-based position in priority order, or None if not waiting
+    """
+    try:
+        return get_queue_engine().position(session_id)
+        
+    except Exception as e:
+        logger.exception(f"Error getting queue position: {e}")
+        return None
+
+
+@traced
 def get_queue_status():
     """
     Get current queue status
@@ -311,26 +414,7 @@ def get_queue_status():
         dict: Queue information
     """
     try:
-        client = get_sheet_client()
-        if not client:
-            return {'total': 0, 'by_priority': {}}
-        
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_TELECONSULT_QUEUE)
-        
-        all_values = sheet.get_all_values()
-        
-        if not all_values or len(all_values) <= 1:
-            return {'total': 0, 'by_priority': {}}
-        
-        headers = all_values[0]
-        
-        waiting = []
-        for row in all_values[1:]:
-            if len(row) >= len(headers):
-                record = dict(zip(headers, row))
-                if record.get('Status') == 'waiting':
-                    waiting.append(record)
+        waiting = get_queue_engine().ordered()
         
         # Count by priority
         by_priority = {1: 0, 2: 0, 3: 0}
@@ -349,6 +433,7 @@ def get_queue_status():
         return {'total': 0, 'by_priority': {}}
 
 
+@traced
 def get_user_active_session(user_id):
     """
     Get user's active session (queued or in_progress)
@@ -360,31 +445,13 @@ def get_user_active_session(user_id):
         dict: Session info or None
     """
     try:
-        client = get_sheet_client()
-        if not client:
-            return None
-        
-        spreadsheet = client.open('KhwanBot_Data')
-        sheet = spreadsheet.worksheet(SHEET_TELECONSULT_SESSIONS)
-        
-        all_values = sheet.get_all_values()
-        
-        if not all_values or len(all_values) <= 1:
+        backend = get_backend()
+        if not backend.available():
             return None
         
-        headers = all_values[0]
-        
-        # Search for active session (most recent)
-        for i in range(len(all_values) - 1, 0, -1):
-            row = all_values[i]
-            if len(row) >= len(headers):
-                record = dict(zip(headers, row))
-                
-                if (record.get('User_ID') == user_id and 
-                    record.get('Status') in ['queued', 'in_progress']):
-                    return record
-        
-        return None
+        with _active_index_lock:
+            record = _active_index(backend).get(user_id)
+            return dict(record) if record else None
         
     except Exception as e:
         logger.exception(f"Error getting active session: {e}")
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Write-Behind Buffer Module
+Collect appended rows per worksheet and flush them in batches
+"""
+import atexit
+import threading
+from collections import Counter
+from config import (
+    STORAGE_BACKEND,
+    WRITE_BUFFER_ENABLED,
+    WRITE_BUFFER_FLUSH_SECONDS,
+    WRITE_BUFFER_BATCH_SIZE,
+    get_logger
+)
+from database.mirror import get_mirror, row_key
+from database.row_index import get_locator, record_appended
+from utils.ratelimit import call_api, maybe_applied
+
+logger = get_logger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Pending rows for a single worksheet
+
+    Rows are kept in arrival order and written with one append_rows call.
+    A failed flush puts the rows back at the front so nothing is lost.
+    Appends are not idempotent, so when a failure leaves it unclear whether
+    the rows were written (5xx, lost reply) they are set aside as
+    unverified and checked against the sheet before the next append.
+    Rows are appended RAW so they read back exactly as sent, which is what
+    that check compares (see mirror.row_key).
+    Each row remembers its mirror id so it can be confirmed once written.
+    """
+
+    def __init__(self, sheet_name):
+        self.sheet_name = sheet_name
+        self._rows = []
+        self._unverified = []
+        self._rows_lock = threading.Lock()
+        # Serializes flushes so batches reach the sheet in order
+        self._flush_lock = threading.Lock()
+
+    def add(self, row, mirror_id=None, unverified=False):
+        """
+        Queue a row, returns the number of rows now pending
+
+        unverified=True for rows that may already be in the sheet (they
+        are looked up before being appended).
+        """
+        with self._rows_lock:
+            (self._unverified if unverified else self._rows).append((row, mirror_id))
+            return len(self._rows) + len(self._unverified)
+
+    def pending(self):
+        """Number of rows waiting to be written"""
+        with self._rows_lock:
+            return len(self._rows) + len(self._unverified)
+
+    def flush(self):
+        """
+        Write all pending rows to the worksheet
+
+        Returns:
+            bool: True if the buffer is empty afterwards
+        """
+        with self._flush_lock:
+            with self._rows_lock:
+                rows, self._rows = self._rows, []
+                unverified, self._unverified = self._unverified, []
+
+            if not rows and not unverified:
+                return True
+
+            # Imported here: database.sheets hands its appends to this module
+            from database.sheets import get_worksheet, discard_stale_worksheet
+
+            attempted = False
+            try:
+                sheet = get_worksheet(self.sheet_name)
+                if not sheet:
+                    raise RuntimeError("No sheet client available")
+
+                if unverified:
+                    written, unverified = _split_written(sheet, unverified)
+                    if written:
+                        logger.warning("%d rows for %s were already in the sheet, not appending them again",
+                                       len(written), self.sheet_name)
+                        get_mirror().confirm(self.sheet_name, [m for _, m in written if m is not None])
+                rows, unverified = unverified + rows, []
+
+                response = None
+                if rows:
+                    attempted = True
+                    response = call_api(
+                        'sheets', sheet.append_rows, [row for row, _ in rows],
+                        value_input_option="RAW", idempotent=False
+                    )
+                    logger.info("Flushed %d rows to %s", len(rows), self.sheet_name)
+
+            except Exception as e:
+                discard_stale_worksheet(self.sheet_name, e)
+                logger.exception(f"Error flushing {len(rows) + len(unverified)} rows to {self.sheet_name}: {e}")
+                with self._rows_lock:
+                    if attempted and maybe_applied(e):
+                        self._unverified = rows + self._unverified
+                    else:
+                        self._unverified = unverified + self._unverified
+                        self._rows = rows + self._rows
+                return False
+
+            try:
+                get_mirror().confirm(self.sheet_name, [m for _, m in rows if m is not None])
+                if rows:
+                    _index_rows(self.sheet_name, [row for row, _ in rows], response)
+            except Exception as e:
+                logger.exception(f"Error recording flushed rows in {self.sheet_name}: {e}")
+            return True
+
+
+def _split_written(sheet, entries):
+    """
+    Sort rows that may have been appended already
+
+    Reads the sheet and matches whole rows (mirror.row_key), each sheet
+    row standing in for at most one buffered row.
+
+    Returns:
+        tuple: (entries already in the sheet, entries still to append)
+    """
+    values = call_api('sheets', sheet.get_all_values)
+    in_sheet = Counter(row_key(row) for row in values[1:])
+    written, missing = [], []
+    for entry in entries:
+        key = row_key(entry[0])
+        if in_sheet[key]:
+            in_sheet[key] -= 1
+            written.append(entry)
+        else:
+            missing.append(entry)
+    return written, missing
+
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+_flush_requested = threading.Event()
+_flusher_thread = None
+
+
+def _get_buffer(sheet_name):
+    """Get or create the buffer for a worksheet"""
+    with _buffers_lock:
+        buffer = _buffers.get(sheet_name)
+        if buffer is None:
+            buffer = WriteBehindBuffer(sheet_name)
+            _buffers[sheet_name] = buffer
+        return buffer
+
+
+def _flusher_loop():
+    """Background loop: flush every interval, or early when a batch fills up"""
+    while True:
+        _flush_requested.wait(WRITE_BUFFER_FLUSH_SECONDS)
+        _flush_requested.clear()
+        flush_pending()
+
+
+def _ensure_flusher():
+    """Start the background flusher on first use"""
+    global _flusher_thread
+
+    with _buffers_lock:
+        if _flusher_thread is not None:
+            return
+        # Nothing is buffered yet, so every pending row with our pid is an orphan
+        _recover_orphaned()
+        _flusher_thread = threading.Thread(
+            target=_flusher_loop,
+            name="sheets-write-behind",
+            daemon=True
+        )
+        _flusher_thread.start()
+        atexit.register(flush_pending)
+
+
+def _recover_orphaned():
+    """Buffer rows an earlier process left pending in the mirror (it may have crashed mid-append)"""
+    try:
+        orphaned = get_mirror().claim_orphaned()
+    except Exception as e:
+        logger.exception(f"Error recovering pending rows from the mirror: {e}")
+        return
+
+    for sheet_name, rows in orphaned.items():
+        buffer = _buffers.setdefault(sheet_name, WriteBehindBuffer(sheet_name))
+        for mirror_id, row in rows:
+            buffer.add(row, mirror_id, unverified=True)
+        logger.warning("Recovered %d unwritten rows for %s from the mirror", len(rows), sheet_name)
+    if orphaned:
+        _flush_requested.set()
+
+
+def start_write_buffer():
+    """
+    Start the flusher at startup, replaying rows left pending by an earlier run
+
+    Only applies to the Sheets backend with WRITE_BUFFER_ENABLED on.
+    """
+    if WRITE_BUFFER_ENABLED and STORAGE_BACKEND != "local":
+        _ensure_flusher()
+
+
+def _mirror_row(sheet_name, row, pending):
+    """Copy an appended row into the local mirror (Sheets stays the source of truth)"""
+    try:
+        return get_mirror().insert(sheet_name, row, pending=pending)
+    except Exception as e:
+        logger.exception(f"Error mirroring row for {sheet_name}: {e}")
+        return None
+
+
+def _index_rows(sheet_name, rows, response):
+    """Record the row numbers an append landed on (see database.row_index)"""
+    from database.sheets import get_headers
+    if get_locator(sheet_name) is not None:
+        record_appended(sheet_name, get_headers(sheet_name), rows, response)
+
+
+def enqueue_append(sheet_name, row):
+    """
+    Append a row to a worksheet without waiting for the Sheets API
+
+    The row lands in the local mirror right away, so reads see it before
+    it reaches Google Sheets. Falls back to a synchronous append_row when WRITE_BUFFER_ENABLED is off.
+
+    Args:
+        sheet_name: Worksheet title
+        row: List of cell values
+
+    Returns:
+        bool: True if the row was queued (or written)
+    """
+    if not WRITE_BUFFER_ENABLED:
+        from database.sheets import get_worksheet, discard_stale_worksheet
+        try:
+            sheet = get_worksheet(sheet_name)
+            if not sheet:
+                logger.error("No sheet client available")
+                return False
+            response = call_api('sheets', sheet.append_row, row, value_input_option="RAW", idempotent=False)
+        except Exception as e:
+            discard_stale_worksheet(sheet_name, e)
+            logger.exception(f"Error appending row to {sheet_name}: {e}")
+            return False
+        _mirror_row(sheet_name, row, pending=False)
+        try:
+            _index_rows(sheet_name, [row], response)
+        except Exception as e:
+            logger.exception(f"Error indexing row appended to {sheet_name}: {e}")
+        return True
+
+    _ensure_flusher()
+    mirror_id = _mirror_row(sheet_name, row, pending=True)
+    if _get_buffer(sheet_name).add(row, mirror_id) >= WRITE_BUFFER_BATCH_SIZE:
+        _flush_requested.set()
+    return True
+
+
+def flush_pending(sheet_name=None):
+    """
+    Write buffered rows now
+
+    Call before reading or updating a worksheet that has buffered appends,
+    so the sheet reflects every row the app has already accepted.
+
+    Args:
+        sheet_name: Worksheet to flush (None for all)
+
+    Returns:
+        bool: True if nothing is left pending
+    """
+    with _buffers_lock:
+        if sheet_name is None:
+            buffers = list(_buffers.values())
+        else:
+            buffers = [_buffers[sheet_name]] if sheet_name in _buffers else []
+
+    ok = True
+    for buffer in buffers:
+        if buffer.pending():
+            ok = buffer.flush() and ok
+    return ok
+
+
+def pending_count(sheet_name=None):
+    """Number of buffered rows (for one worksheet or in total)"""
+    with _buffers_lock:
+        if sheet_name is None:
+            buffers = list(_buffers.values())
+        else:
+            buffers = [_buffers[sheet_name]] if sheet_name in _buffers else []
+    return sum(buffer.pending() for buffer in buffers)
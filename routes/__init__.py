@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 """Routes package"""
 from .webhook import register_routes
+from .intents import intent, use_middleware, get_intent_metrics
 
-__all__ = ['register_routes']
+__all__ = ['register_routes', 'intent', 'use_middleware', 'get_intent_metrics']
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Follow-up Summary Intent Module
+GetFollowUpSummary handler (แก้ไขปัญหา Rich Menu ที่ trigger ผิด Intent)
+
+Registered through routes.intents; loaded via INTENT_MODULES.
+"""
+from config import get_logger
+from routes.intents import intent
+from services.reminder import get_reminder_summary
+
+logger = get_logger(__name__)
+
+# Format reminder type
+REMINDER_TYPE_DISPLAY = {
+    'day3': 'วันที่ 3',
+    'day7': 'วันที่ 7',
+    'day14': 'วันที่ 14',
+    'day30': 'วันที่ 30'
+}
+
+# Format status
+REMINDER_STATUS_DISPLAY = {
+    'sent': '⏳ รอตอบกลับ',
+    'responded': '✅ ตอบกลับแล้ว',
+    'no_response': '⚠️ ไม่ตอบกลับ'
+}
+
+
+@intent('GetFollowUpSummary', error_message=(
+    "ขอโทษค่ะ เกิดข้อผิดพลาดในการดึงข้อมูล\n"
+    "กรุณาลองใหม่อีกครั้งหรือติดต่อพยาบาลค่ะ"
+))
+def handle_get_followup_summary(req):
+    """
+    Handle GetFollowUpSummary intent
+    แสดงสรุปการติดตามผู้ป่วยหลังจำหน่าย
+
+    Args:
+        req: IntentRequest
+
+    Returns:
+        str: Follow-up summary text
+    """
+    logger.info(f"GetFollowUpSummary request from {req.user_id}")
+
+    # Get reminder summary from database
+    summary = get_reminder_summary(req.user_id)
+    if 'error' in summary:
+        raise RuntimeError(summary['error'])
+
+    # Check if user has any reminders
+    if summary['total_reminders'] == 0:
+        return (
+            "📋 ยังไม่มีข้อมูลการติดตามค่ะ\n\n"
+            "หลังจากที่คุณจำหน่ายจากโรงพยาบาล\n"
+            "ระบบจะเริ่มติดตามอาการของคุณอัตโนมัติ\n\n"
+            "💡 ระบบจะส่งการเตือนในวันที่:\n"
+            "   • วันที่ 3 หลังจำหน่าย\n"
+            "   • วันที่ 7 (สัปดาห์แรก)\n"
+            "   • วันที่ 14 (สัปดาห์ที่ 2)\n"
+            "   • วันที่ 30 (ครบ 1 เดือน)"
+        )
+
+    # Build summary message
+    message = (
+        f"📊 สรุปการติดตามของคุณ\n"
+        f"{'=' * 30}\n\n"
+        f"📌 รวมทั้งหมด: {summary['total_reminders']} ครั้ง\n"
+        f"✅ ตอบกลับแล้ว: {summary['responded']} ครั้ง\n"
+        f"⏳ รอตอบกลับ: {summary['pending']} ครั้ง\n"
+    )
+
+    if summary['no_response'] > 0:
+        message += f"⚠️ ไม่ตอบกลับ: {summary['no_response']} ครั้ง\n"
+
+    message += "\n"
+
+    # Add latest reminder info
+    if summary.get('latest'):
+        latest = summary['latest']
+        reminder_type = latest.get('Reminder_Type', 'unknown')
+        status = latest.get('Status', 'unknown')
+        timestamp = latest.get('Timestamp', '')
+
+        type_display = REMINDER_TYPE_DISPLAY.get(reminder_type, reminder_type)
+        status_display = REMINDER_STATUS_DISPLAY.get(status, status)
+
+        message += (
+            f"🔔 การติดตามล่าสุด:\n"
+            f"   📅 {type_display}\n"
+            f"   สถานะ: {status_display}\n"
+        )
+
+        if timestamp:
+            message += f"   ⏰ {timestamp}\n"
+
+    message += (
+        f"\n"
+        f"💡 พยาบาลจะติดตามอาการของคุณ\n"
+        f"เป็นประจำตามกำหนดการนะคะ"
+    )
+
+    return message
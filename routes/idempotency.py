@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Idempotency Middleware Module
+Answer Dialogflow webhook retries from cache
+
+Dialogflow re-sends a request when the webhook is slow. For intents
+registered with idempotent=True the first reply is kept for
+IDEMPOTENCY_TTL_SECONDS, keyed on the responseId (or the session when
+there is none) plus a hash of the intent and parameters. A repeat gets
+the stored reply without running the handler again; a repeat that
+arrives while the first request is still running waits for its reply.
+
+The cache is per process.
+"""
+import hashlib
+import json
+import threading
+from config import (
+    IDEMPOTENCY_ENABLED,
+    IDEMPOTENCY_TTL_SECONDS,
+    IDEMPOTENCY_MAX_ENTRIES,
+    IDEMPOTENCY_WAIT_SECONDS,
+    get_logger
+)
+from utils.cache import TTLCache
+
+logger = get_logger(__name__)
+
+IN_PROGRESS_MESSAGE = "⏳ กำลังดำเนินการคำขอของคุณ กรุณารอสักครู่ค่ะ"
+
+_replies = TTLCache(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL_SECONDS)
+_in_flight = {}  # key -> threading.Event, set when the first request finishes
+_lock = threading.Lock()
+
+_stats = {'hits': 0, 'misses': 0, 'waited': 0, 'timeouts': 0}
+
+
+def request_key(req):
+    """
+    Idempotency key for an IntentRequest
+
+    Returns:
+        str: sha256 of responseId-or-session, intent and parameters
+    """
+    params = json.dumps(req.params, sort_keys=True, ensure_ascii=False, default=str)
+    raw = f"{req.response_id or req.user_id}|{req.intent}|{params}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def idempotency_middleware(req, spec, call_next):
+    """Middleware for routes.intents: serve repeats of idempotent intents from cache"""
+    if not IDEMPOTENCY_ENABLED or not spec.idempotent:
+        return call_next(req)
+
+    key = request_key(req)
+    while True:
+        with _lock:
+            reply = _replies.get(key)
+            if reply is not None:
+                _stats['hits'] += 1
+                logger.info("Repeat %s request from %s answered from cache", spec.name, req.user_id)
+                return reply
+            event = _in_flight.get(key)
+            if event is None:
+                _in_flight[key] = threading.Event()
+                _stats['misses'] += 1
+                break
+            _stats['waited'] += 1
+
+        # Same request still running (Dialogflow retried early): wait for its reply
+        if not event.wait(IDEMPOTENCY_WAIT_SECONDS):
+            with _lock:
+                _stats['timeouts'] += 1
+            return IN_PROGRESS_MESSAGE
+        # Finished; loop to pick up its reply (or run it ourselves if it failed)
+
+    try:
+        reply = call_next(req)
+        _replies.set(key, reply)
+        return reply
+    finally:
+        with _lock:
+            _in_flight.pop(key).set()
+
+
+def get_idempotency_metrics():
+    """
+    Cache counters for this process
+
+    Returns:
+        dict: hits, misses, waited, timeouts and cached entries
+    """
+    with _lock:
+        stats = dict(_stats)
+    stats['entries'] = len(_replies)
+    return stats
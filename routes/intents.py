@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Intent Registry Module
+Table-driven dispatch of Dialogflow intents
+
+Handlers register by intent name with @intent and return the reply text.
+Every call runs through the middleware chain (timing, error handling,
+required-parameter checks), so instrumentation is attached in one place.
+Extra handler modules listed in INTENT_MODULES register themselves on import.
+"""
+import importlib
+import threading
+import time
+from collections import namedtuple
+from config import INTENT_MODULES, get_logger
+from utils.metrics import counter, histogram
+from utils.tracing import span
+
+logger = get_logger(__name__)
+
+# What a handler gets: intent name, LINE user ID, Dialogflow parameters, raw text,
+# and Dialogflow's responseId (the same on retries of a request)
+IntentRequest = namedtuple(
+    'IntentRequest', ['intent', 'user_id', 'params', 'query_text', 'response_id'], defaults=(None,)
+)
+
+# Registered handler and its options
+IntentSpec = namedtuple('IntentSpec', ['name', 'handler', 'required', 'error_message', 'idempotent'])
+
+DEFAULT_ERROR_MESSAGE = "เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้ง"
+
+_intents = {}
+_fallback = None
+_middleware = []
+
+# Per-intent latency stats (see get_intent_metrics)
+_intent_stats = {}
+_intent_stats_lock = threading.Lock()
+
+INTENT_REQUESTS = counter('kwannurse_intent_requests_total', "Intent calls handled", ('intent',))
+INTENT_ERRORS = counter('kwannurse_intent_errors_total', "Intent calls whose handler raised", ('intent',))
+INTENT_LATENCY = histogram('kwannurse_intent_duration_seconds', "Time to build the intent reply", ('intent',))
+
+
+def intent(*names, required=(), error_message=DEFAULT_ERROR_MESSAGE, idempotent=False):
+    """
+    Register a handler for one or more intents
+
+    Args:
+        names: Dialogflow intent display names
+        required: [(param_names, label), ...] parameters that must be filled;
+                  param_names is a name or a tuple of alternatives
+        error_message: Reply if the handler raises
+        idempotent: Answer repeats of the same request from cache (intents
+                    with side effects, see routes.idempotency)
+
+    Usage:
+        @intent('ReportSymptoms', required=[('pain_score', "ระดับความปวด")])
+        def handle_report_symptoms(req):
+            return "..."
+    """
+    def decorator(func):
+        for name in names:
+            if name in _intents:
+                logger.warning("Intent %s re-registered by %s", name, func.__name__)
+            _intents[name] = IntentSpec(name, func, tuple(required), error_message, idempotent)
+        return func
+    return decorator
+
+
+def fallback(func):
+    """Register the handler for intents nobody registered"""
+    global _fallback
+    _fallback = func
+    return func
+
+
+def use_middleware(func):
+    """
+    Add a middleware around every intent call (outermost first)
+
+    Middleware is called as func(req, spec, call_next) and returns the
+    reply text, normally by returning call_next(req). Adding the same
+    function again does nothing, so building a second app doesn't nest it.
+    """
+    if func not in _middleware:
+        _middleware.append(func)
+    return func
+
+
+def registered_intents():
+    """Names of all registered intents"""
+    return sorted(_intents)
+
+
+def dispatch(req):
+    """
+    Run the handler for req.intent through the middleware chain
+
+    Args:
+        req: IntentRequest
+
+    Returns:
+        str: Reply text
+    """
+    spec = _intents.get(req.intent)
+    if spec is None:
+        return _fallback(req) if _fallback else DEFAULT_ERROR_MESSAGE
+
+    chain = [timing_middleware, error_middleware] + _middleware + [required_params_middleware]
+
+    def call(index, current):
+        if index == len(chain):
+            with span(f"intent.{spec.name}"):
+                return spec.handler(current)
+        return chain[index](current, spec, lambda nxt: call(index + 1, nxt))
+
+    return call(0, req)
+
+
+# ---- built-in middleware ------------------------------------------------
+
+def timing_middleware(req, spec, call_next):
+    """Time each call and keep per-intent stats"""
+    started = time.perf_counter()
+    try:
+        return call_next(req)
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        _record_intent_call(spec.name, elapsed_ms)
+        logger.info("Intent %s handled in %.1f ms", spec.name, elapsed_ms)
+
+
+def error_middleware(req, spec, call_next):
+    """Turn handler errors into the intent's error reply"""
+    try:
+        return call_next(req)
+    except Exception as e:
+        logger.exception(f"Error in {spec.name}: {e}")
+        _record_intent_error(spec.name)
+        return spec.error_message
+
+
+def required_params_middleware(req, spec, call_next):
+    """Ask for required parameters that are missing instead of calling the handler"""
+    missing = [
+        label for names, label in spec.required
+        if not any(_filled(req.params.get(name)) for name in _as_tuple(names))
+    ]
+    if missing:
+        return "กรุณาระบุ " + " และ ".join(missing) + " ด้วยค่ะ"
+    return call_next(req)
+
+
+def _as_tuple(names):
+    return names if isinstance(names, tuple) else (names,)
+
+
+def _filled(value):
+    if value is None:
+        return False
+    if isinstance(value, str):
+        return value.strip() != ""
+    if isinstance(value, (list, dict)):
+        return bool(value)
+    return True
+
+
+# ---- stats --------------------------------------------------------------
+
+def _record_intent_call(name, elapsed_ms):
+    with _intent_stats_lock:
+        stats = _intent_stats.setdefault(name, {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['calls'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+    INTENT_REQUESTS.inc(intent=name)
+    INTENT_LATENCY.observe(elapsed_ms / 1000, intent=name)
+
+
+def _record_intent_error(name):
+    with _intent_stats_lock:
+        stats = _intent_stats.setdefault(name, {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['errors'] += 1
+    INTENT_ERRORS.inc(intent=name)
+
+
+def get_intent_metrics():
+    """
+    Latency stats per intent for this process
+
+    Returns:
+        dict: {intent: {calls, errors, avg_ms, max_ms}}
+    """
+    with _intent_stats_lock:
+        snapshot = {name: dict(stats) for name, stats in _intent_stats.items()}
+    return {
+        name: {
+            'calls': stats['calls'],
+            'errors': stats['errors'],
+            'avg_ms': round(stats['total_ms'] / stats['calls'], 1) if stats['calls'] else 0.0,
+            'max_ms': round(stats['max_ms'], 1)
+        }
+        for name, stats in snapshot.items()
+    }
+
+
+def load_intent_modules(modules=INTENT_MODULES):
+    """Import handler modules so their @intent registrations run"""
+    for module in modules:
+        try:
+            importlib.import_module(module)
+            logger.info("Loaded intent module %s", module)
+        except Exception as e:
+            logger.exception(f"Error loading intent module {module}: {e}")
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics Route Module
+Prometheus text for the /metrics endpoint
+
+Counters and histograms are recorded where the work happens (intents,
+external API calls, LINE pushes, scheduler jobs). The gauges below read
+queue depths when scraped. Values are per process: with several gunicorn
+workers, each scrape sees the worker that served it.
+"""
+from flask import Response
+from config import get_logger
+from utils.metrics import gauge, render
+from database import queue_engine
+from database.write_buffer import pending_count as write_buffer_pending
+from services.dispatcher import pending_count as dispatcher_pending
+from services.deferred import get_deferred_metrics
+from services.outbox import get_outbox_metrics
+from services.alert_digest import pending_alert_count
+
+logger = get_logger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _outbox_depth():
+    return {(status,): count for status, count in get_outbox_metrics().items()}
+
+
+def _teleconsult_depth():
+    # Only a worker that already loaded the queue reports it: building the
+    # engine here could mean reading the whole sheet on a scrape
+    engine = queue_engine._engine
+    return {} if engine is None else len(engine)
+
+
+def _deferred_depth():
+    stats = get_deferred_metrics()
+    return {('pending',): stats['pending'], ('retrying',): stats['retrying']}
+
+
+gauge('kwannurse_teleconsult_queue_depth', "Patients waiting in the teleconsult queue",
+      collect=_teleconsult_depth)
+gauge('kwannurse_outbox_messages', "Outbox messages not yet sent", ('status',), collect=_outbox_depth)
+gauge('kwannurse_notification_queue_depth', "Notifications waiting for a dispatcher worker",
+      collect=dispatcher_pending)
+gauge('kwannurse_deferred_tasks', "Deferred side effects not yet run", ('state',), collect=_deferred_depth)
+gauge('kwannurse_write_buffer_rows', "Sheet rows buffered for the next batch write",
+      collect=write_buffer_pending)
+gauge('kwannurse_alert_digest_pending', "Nurse alerts held for the next digest",
+      collect=pending_alert_count)
+
+
+def metrics_response():
+    """
+    Current metrics as a Flask response
+
+    Returns:
+        flask.Response: Prometheus text exposition format
+    """
+    return Response(render(), content_type=CONTENT_TYPE)
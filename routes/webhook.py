@@ -3,11 +3,12 @@
 Webhook Routes Module
 Handles Dialogflow webhook endpoints
 """
+import hmac
 import json
 import os
 from datetime import datetime
 from flask import request, jsonify
-from config import get_logger, LOCAL_TZ
+from config import get_logger, LOCAL_TZ, OFFICE_HOURS, DEBUG, TRACE_DEBUG_TOKEN, WEBHOOK_API_DEADLINE_SECONDS
 from utils import (
     parse_date_iso,
     resolve_time_from_params,
@@ -23,7 +24,8 @@ from services import (
     get_physical_therapy_guide,
     get_dvt_prevention_guide,
     get_medication_guide,
-    get_warning_signs_guide
+    get_warning_signs_guide,
+    get_outbox_metrics
 )
 from services.teleconsult import (
     is_office_hours,
@@ -33,6 +35,18 @@ from services.teleconsult import (
     cancel_consultation,
     get_queue_info_message
 )
+from routes.intents import (
+    IntentRequest,
+    intent,
+    fallback,
+    dispatch,
+    use_middleware,
+    load_intent_modules
+)
+from routes.idempotency import idempotency_middleware
+from routes.metrics import metrics_response
+from utils.ratelimit import api_deadline
+from utils.tracing import trace, get_recent_traces
 
 logger = get_logger(__name__)
 
@@ -55,9 +69,15 @@ def register_routes(app):
                 "FollowUpReminders",
                 "Teleconsult"
             ],
+            "outbox": get_outbox_metrics(),
             "timestamp": datetime.now(tz=LOCAL_TZ).isoformat()
         }), 200
     
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Prometheus scrape endpoint (this worker's metrics)"""
+        return metrics_response()
+    
     @app.route('/webhook', methods=['POST'])
     def webhook():
         """Main Dialogflow webhook endpoint"""
@@ -66,10 +86,11 @@ def register_routes(app):
             return jsonify({"fulfillmentText": "Request body empty"}), 400
         
         try:
-            intent = req.get('queryResult', {}).get('intent', {}).get('displayName')
+            intent_name = req.get('queryResult', {}).get('intent', {}).get('displayName')
             params = req.get('queryResult', {}).get('parameters', {}) or {}
             user_id = req.get('session', 'unknown').split('/')[-1]
             query_text = req.get('queryResult', {}).get('queryText', '')
+            response_id = req.get('responseId')
         except Exception:
             logger.exception("Error parsing request")
             return jsonify({
@@ -77,90 +98,84 @@ def register_routes(app):
             }), 200
         
         logger.info("Intent: %s | User: %s | Params: %s", 
-                   intent, user_id, json.dumps(params, ensure_ascii=False))
-        
-        # Route to appropriate handler
-        if intent == 'ReportSymptoms':
-            return handle_report_symptoms(user_id, params)
-        
-        elif intent == 'AssessPersonalRisk' or intent == 'AssessRisk':
-            return handle_assess_risk(user_id, params)
-        
-        elif intent == 'RequestAppointment':
-            return handle_request_appointment(user_id, params)
-        
-        elif intent == 'GetKnowledge':
-            return handle_get_knowledge(params)
-        
-        elif intent == 'ContactNurse':
-            return handle_contact_nurse(user_id, params, query_text)
+                   intent_name, user_id, json.dumps(params, ensure_ascii=False))
         
-        elif intent == 'CancelConsultation':
-            return handle_cancel_consultation(user_id)
-        
-        elif intent == 'GetGroupID':
-            return handle_get_group_id()
+        # Route to the registered handler (see routes.intents); Sheets/LINE
+        # retries must not outlast Dialogflow's webhook timeout
+        with api_deadline(WEBHOOK_API_DEADLINE_SECONDS), \
+                trace(f"webhook {intent_name}", user_id=user_id, response_id=response_id):
+            reply = dispatch(IntentRequest(intent_name, user_id, params, query_text, response_id))
+        return jsonify({"fulfillmentText": reply}), 200
+    
+    @app.route('/debug/traces', methods=['GET'])
+    def debug_traces():
+        """Recent request span trees (this worker); ?min_ms= and ?limit= filter"""
+        if not _debug_allowed():
+            return jsonify({"error": "Not found"}), 404
         
-        else:
-            return handle_unknown_intent(intent)
+        min_ms = request.args.get('min_ms', 0, type=float)
+        limit = request.args.get('limit', 50, type=int)
+        return jsonify({"traces": get_recent_traces(min_ms, limit)}), 200
+    
+    # Dialogflow retries of side-effecting intents are answered from cache
+    use_middleware(idempotency_middleware)
+    
+    # Handlers from INTENT_MODULES register themselves on import
+    load_intent_modules()
+
+
+def _debug_allowed():
+    """
+    Debug endpoints show patient user IDs: they need TRACE_DEBUG_TOKEN
+    (as X-Debug-Token or ?token=) or, when no token is set, DEBUG mode
+    """
+    if TRACE_DEBUG_TOKEN:
+        token = request.headers.get('X-Debug-Token') or request.args.get('token')
+        return hmac.compare_digest(token or '', TRACE_DEBUG_TOKEN)
+    return DEBUG
 
 
-def handle_report_symptoms(user_id, params):
+@intent('ReportSymptoms', idempotent=True, required=[
+    ('pain_score', "ระดับความปวด (0-10)"),
+    ('wound_status', "สภาพแผล"),
+    ('fever_check', "อาการไข้"),
+    ('mobility_status', "การเคลื่อนไหว")
+])
+def handle_report_symptoms(req):
     """Handle ReportSymptoms intent"""
-    pain = params.get('pain_score')
-    wound = params.get('wound_status')
-    fever = params.get('fever_check')
-    mobility = params.get('mobility_status')
-    
-    # Validate required parameters
-    missing = []
-    if pain is None or str(pain).strip() == "":
-        missing.append("ระดับความปวด (0-10)")
-    if not wound:
-        missing.append("สภาพแผล")
-    if not fever:
-        missing.append("อาการไข้")
-    if not mobility:
-        missing.append("การเคลื่อนไหว")
-    
-    if missing:
-        ask = "กรุณาระบุ " + " และ ".join(missing) + " ด้วยค่ะ"
-        return jsonify({"fulfillmentText": ask}), 200
+    params = req.params
     
     # Calculate risk
-    result = calculate_symptom_risk(user_id, pain, wound, fever, mobility)
-    return jsonify({"fulfillmentText": result}), 200
+    return calculate_symptom_risk(
+        req.user_id,
+        params.get('pain_score'),
+        params.get('wound_status'),
+        params.get('fever_check'),
+        params.get('mobility_status')
+    )
 
 
-def handle_assess_risk(user_id, params):
+@intent('AssessPersonalRisk', 'AssessRisk', idempotent=True, required=[
+    ('age', "อายุ"),
+    ('weight', "น้ำหนัก (กิโลกรัม)"),
+    ('height', "ส่วนสูง (เซนติเมตร)"),
+    (('disease', 'diseases'), "โรคประจำตัว (หรือพิมพ์ 'ไม่มี')")
+])
+def handle_assess_risk(req):
     """Handle AssessRisk intent"""
-    age = params.get('age')
-    weight = params.get('weight')
-    height = params.get('height')
+    params = req.params
     disease = params.get('disease') or params.get('diseases')
     
-    # Validate required parameters
-    missing = []
-    if age is None or str(age).strip() == "":
-        missing.append("อายุ")
-    if weight is None or str(weight).strip() == "":
-        missing.append("น้ำหนัก (กิโลกรัม)")
-    if height is None or str(height).strip() == "":
-        missing.append("ส่วนสูง (เซนติเมตร)")
-    if not disease:
-        missing.append("โรคประจำตัว (หรือพิมพ์ 'ไม่มี')")
-    
-    if missing:
-        ask = "กรุณาระบุ " + " และ ".join(missing) + " ด้วยค่ะ"
-        return jsonify({"fulfillmentText": ask}), 200
-    
     # Calculate risk
-    result = calculate_personal_risk(user_id, age, weight, height, disease)
-    return jsonify({"fulfillmentText": result}), 200
+    return calculate_personal_risk(
+        req.user_id, params.get('age'), params.get('weight'), params.get('height'), disease
+    )
 
 
-def handle_request_appointment(user_id, params):
+@intent('RequestAppointment', idempotent=True)
+def handle_request_appointment(req):
     """Handle RequestAppointment intent"""
+    params = req.params
     preferred_date_raw = (params.get('date') or 
                          params.get('preferred_date') or 
                          params.get('date-original'))
@@ -183,9 +198,7 @@ def handle_request_appointment(user_id, params):
         # Check if date is in the past
         today_local = datetime.now(tz=LOCAL_TZ).date()
         if preferred_date < today_local:
-            return jsonify({
-                "fulfillmentText": "⚠️ วันที่ที่เลือกเป็นอดีตแล้ว กรุณาเลือกวันที่ในอนาคตค่ะ"
-            }), 200
+            return "⚠️ วันที่ที่เลือกเป็นอดีตแล้ว กรุณาเลือกวันที่ในอนาคตค่ะ"
     
     if not preferred_time:
         missing.append("เวลานัด (เช่น 09:00 หรือ 'เช้า'/'บ่าย')")
@@ -196,28 +209,26 @@ def handle_request_appointment(user_id, params):
     # Validate phone if provided
     phone_norm = normalize_phone_number(phone_raw) if phone_raw else None
     if phone_norm and not is_valid_thai_mobile(phone_norm):
-        return jsonify({
-            "fulfillmentText": "⚠️ เบอร์โทรศัพท์ไม่ถูกต้อง กรุณาพิมพ์เป็นตัวเลข 10 หลัก (เช่น 0812345678)"
-        }), 200
+        return "⚠️ เบอร์โทรศัพท์ไม่ถูกต้อง กรุณาพิมพ์เป็นตัวเลข 10 หลัก (เช่น 0812345678)"
     
     if missing:
-        ask = "กรุณาระบุ " + " และ ".join(missing) + " ด้วยค่ะ"
-        return jsonify({"fulfillmentText": ask}), 200
+        return "กรุณาระบุ " + " และ ".join(missing) + " ด้วยค่ะ"
     
     # Create appointment
     pd_str = preferred_date.isoformat()
     pt_str = preferred_time
     
     success, message = create_appointment(
-        user_id, name, phone_norm, pd_str, pt_str, reason
+        req.user_id, name, phone_norm, pd_str, pt_str, reason
     )
     
-    return jsonify({"fulfillmentText": message}), 200
+    return message
 
 
-def handle_get_knowledge(params):
+@intent('GetKnowledge')
+def handle_get_knowledge(req):
     """Handle GetKnowledge intent"""
-    topic = params.get('topic') or params.get('knowledge_topic')
+    topic = req.params.get('topic') or req.params.get('knowledge_topic')
     
     # Map topics to guide functions
     knowledge_map = {
@@ -248,8 +259,7 @@ def handle_get_knowledge(params):
     
     # If no topic or "menu", return menu
     if not topic or str(topic).lower() in ['menu', 'เมนู', 'ความรู้', 'knowledge']:
-        result = get_knowledge_menu()
-        return jsonify({"fulfillmentText": result}), 200
+        return get_knowledge_menu()
     
     # Normalize topic
     topic_key = str(topic).lower().strip()
@@ -258,26 +268,23 @@ def handle_get_knowledge(params):
     if topic_key in knowledge_map:
         topic_name, guide_func = knowledge_map[topic_key]
         logger.info("Knowledge request: %s", topic_name)
-        result = guide_func()
-        return jsonify({"fulfillmentText": result}), 200
+        return guide_func()
     
     # Topic not found
-    return jsonify({
-        "fulfillmentText": (
-            f"ขอโทษค่ะ ไม่พบหัวข้อ '{topic}'\n\n"
-            f"กรุณาพิมพ์ 'ความรู้' เพื่อดูหัวข้อที่มีค่ะ"
-        )
-    }), 200
+    return (
+        f"ขอโทษค่ะ ไม่พบหัวข้อ '{topic}'\n\n"
+        f"กรุณาพิมพ์ 'ความรู้' เพื่อดูหัวข้อที่มีค่ะ"
+    )
 
 
-def handle_get_group_id():
+@intent('GetGroupID')
+def handle_get_group_id(req):
     """Handle GetGroupID debug intent"""
-    return jsonify({
-        "fulfillmentText": f"🔧 Debug Info:\nNURSE_GROUP_ID: {os.environ.get('NURSE_GROUP_ID', 'Not Set')}"
-    }), 200
+    return f"🔧 Debug Info:\nNURSE_GROUP_ID: {os.environ.get('NURSE_GROUP_ID', 'Not Set')}"
 
 
-def handle_contact_nurse(user_id, params, query_text):
+@intent('ContactNurse', idempotent=True, error_message="เกิดข้อผิดพลาด กรุณาลองใหม่ภายหลัง")
+def handle_contact_nurse(req):
     """
     Handle ContactNurse intent
     
@@ -286,77 +293,60 @@ def handle_contact_nurse(user_id, params, query_text):
     - Queue management
     - Office hours checking
     """
-    try:
-        logger.info(f"ContactNurse request from {user_id}")
-        
-        # Check if user provided category or description
-        category_param = params.get('issue_category') or params.get('category')
-        description_param = params.get('description') or params.get('issue_description')
-        
-        # If category is provided (or can be parsed from text)
-        if category_param:
-            issue_type = parse_category_choice(str(category_param))
-        else:
-            # Try to parse from query text
-            issue_type = parse_category_choice(query_text)
-        
-        if issue_type:
-            # Start teleconsult with the category
-            description = str(description_param) if description_param else ""
-            result = start_teleconsult(user_id, issue_type, description)
-            
-            return jsonify({"fulfillmentText": result['message']}), 200
+    user_id, params = req.user_id, req.params
+    logger.info(f"ContactNurse request from {user_id}")
+    
+    # Check if user provided category or description
+    category_param = params.get('issue_category') or params.get('category')
+    description_param = params.get('description') or params.get('issue_description')
+    
+    # If category is provided (or can be parsed from text)
+    if category_param:
+        issue_type = parse_category_choice(str(category_param))
+    else:
+        # Try to parse from query text
+        issue_type = parse_category_choice(req.query_text)
+    
+    if issue_type:
+        # Start teleconsult with the category
+        description = str(description_param) if description_param else ""
+        result = start_teleconsult(user_id, issue_type, description)
         
-        else:
-            # No category yet, show menu
-            menu = get_category_menu()
-            
-            # Add office hours info if outside hours
-            if not is_office_hours():
-                from datetime import datetime
-                from config import OFFICE_HOURS
-                now = datetime.now(tz=LOCAL_TZ)
-                current_time = now.strftime("%H:%M")
-                
-                menu = (
-                    f"⏰ ขณะนี้นอกเวลาทำการ ({current_time} น.)\n"
-                    f"เวลาทำการ: {OFFICE_HOURS['start']}-{OFFICE_HOURS['end']} น.\n\n"
-                    f"{menu}\n\n"
-                    f"💡 หากเป็นเรื่องฉุกเฉิน เลือกหมายเลข 1"
-                )
-            
-            return jsonify({"fulfillmentText": menu}), 200
+        return result['message']
+    
+    # No category yet, show menu
+    menu = get_category_menu()
+    
+    # Add office hours info if outside hours
+    if not is_office_hours():
+        now = datetime.now(tz=LOCAL_TZ)
+        current_time = now.strftime("%H:%M")
         
-    except Exception as e:
-        logger.exception(f"Error in ContactNurse: {e}")
-        return jsonify({
-            "fulfillmentText": "เกิดข้อผิดพลาด กรุณาลองใหม่ภายหลัง"
-        }), 200
+        menu = (
+            f"⏰ ขณะนี้นอกเวลาทำการ ({current_time} น.)\n"
+            f"เวลาทำการ: {OFFICE_HOURS['start']}-{OFFICE_HOURS['end']} น.\n\n"
+            f"{menu}\n\n"
+            f"💡 หากเป็นเรื่องฉุกเฉิน เลือกหมายเลข 1"
+        )
+    
+    return menu
 
 
-def handle_cancel_consultation(user_id):
+@intent('CancelConsultation', idempotent=True, error_message="เกิดข้อผิดพลาดในการยกเลิก กรุณาลองใหม่")
+def handle_cancel_consultation(req):
     """Handle cancellation of consultation"""
-    try:
-        result = cancel_consultation(user_id)
-        return jsonify({"fulfillmentText": result['message']}), 200
-        
-    except Exception as e:
-        logger.exception(f"Error cancelling consultation: {e}")
-        return jsonify({
-            "fulfillmentText": "เกิดข้อผิดพลาดในการยกเลิก กรุณาลองใหม่"
-        }), 200
+    return cancel_consultation(req.user_id)['message']
 
 
-def handle_unknown_intent(intent):
+@fallback
+def handle_unknown_intent(req):
     """Handle unknown/unhandled intents"""
-    logger.warning("Unhandled intent: %s", intent)
-    return jsonify({
-        "fulfillmentText": (
-            f"ขอโทษค่ะ บอทยังไม่รองรับคำสั่ง '{intent}' ในขณะนี้\n\n"
-            f"คุณสามารถใช้ฟีเจอร์หลักได้:\n"
-            f"• รายงานอาการ\n"
-            f"• ประเมินความเสี่ยง\n"
-            f"• นัดหมายพยาบาล\n"
-            f"• ความรู้และคำแนะนำ"
-        )
-    }), 200
+    logger.warning("Unhandled intent: %s", req.intent)
+    return (
+        f"ขอโทษค่ะ บอทยังไม่รองรับคำสั่ง '{req.intent}' ในขณะนี้\n\n"
+        f"คุณสามารถใช้ฟีเจอร์หลักได้:\n"
+        f"• รายงานอาการ\n"
+        f"• ประเมินความเสี่ยง\n"
+        f"• นัดหมายพยาบาล\n"
+        f"• ความรู้และคำแนะนำ"
+    )
@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 """Services package"""
-from .notification import send_line_push
-from .risk_assessment import calculate_symptom_risk, calculate_personal_risk
+from .notification import send_line_push, send_line_multicast, get_line_metrics
+from .outbox import get_outbox_metrics
+from .alert_digest import send_nurse_alert
+from .risk_assessment import (
+    calculate_symptom_risk,
+    calculate_personal_risk,
+    assess_symptoms,
+    assess_personal_risk
+)
+from .deferred import run_deferred, get_deferred_metrics
 from .appointment import create_appointment
 from .knowledge import (
     get_knowledge_menu,
@@ -36,8 +44,16 @@ from .teleconsult import (
 
 __all__ = [
     'send_line_push',
+    'send_line_multicast',
+    'get_line_metrics',
+    'get_outbox_metrics',
+    'send_nurse_alert',
     'calculate_symptom_risk',
     'calculate_personal_risk',
+    'assess_symptoms',
+    'assess_personal_risk',
+    'run_deferred',
+    'get_deferred_metrics',
     'create_appointment',
     'get_knowledge_menu',
     'get_wound_care_guide',
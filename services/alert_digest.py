@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Alert Digest Service Module
+Coalesce nurse group alerts into digests during surges
+
+Emergencies and high-priority alerts (new teleconsult requests,
+concerning symptoms) always go out at once. Any other alert is sent right
+away when the group has been quiet, then opens a window of
+ALERT_DIGEST_WINDOW_SECONDS: alerts arriving inside it are held and sent
+as one digest when it closes. The window stays open while alerts keep
+coming, so a surge produces one push per window instead of one per alert.
+
+Held alerts are recorded in the outbox, so they survive a crash: if this
+process dies before the digest goes out, the outbox replayer sends them
+one by one.
+"""
+import atexit
+import threading
+from collections import Counter
+from datetime import datetime
+from config import (
+    LOCAL_TZ,
+    NURSE_GROUP_ID,
+    ALERT_DIGEST_ENABLED,
+    ALERT_DIGEST_WINDOW_SECONDS,
+    ALERT_CATEGORIES,
+    LINE_TEXT_MAX,
+    DISPATCH_DRAIN_SECONDS,
+    get_logger
+)
+from services.dispatcher import PRIORITY_HIGH, PRIORITY_NORMAL, drain
+from services.notification import send_line_push
+from services.outbox import hold_message, claim_held, mark_held_sent
+
+logger = get_logger(__name__)
+
+DIGEST_SEPARATOR = "\n" + "─" * 20 + "\n"
+
+# Held alerts: (priority, arrival order, category, message, received_at, outbox ID)
+_pending = []
+_pending_lock = threading.Lock()
+_window_timer = None
+_arrivals = 0
+
+
+def send_nurse_alert(message, category, priority=PRIORITY_NORMAL):
+    """
+    Alert the nurse group, digesting routine alerts during surges
+
+    Args:
+        message: Alert text
+        category: Alert kind (key of ALERT_CATEGORIES)
+        priority: services.dispatcher PRIORITY_* value
+
+    Returns:
+        boolean: True if sent, queued or held for the next digest
+    """
+    global _window_timer, _arrivals
+
+    if priority <= PRIORITY_HIGH or not ALERT_DIGEST_ENABLED or ALERT_DIGEST_WINDOW_SECONDS <= 0:
+        return send_line_push(message, NURSE_GROUP_ID, priority=priority)
+
+    with _pending_lock:
+        if _window_timer is None:
+            # Quiet until now: send this one, hold what follows
+            _open_window()
+            send_now = True
+        else:
+            _arrivals += 1
+            message_id = hold_message('push', NURSE_GROUP_ID, message, priority)
+            _pending.append((priority, _arrivals, category, message, datetime.now(tz=LOCAL_TZ), message_id))
+            send_now = False
+
+    if send_now:
+        return send_line_push(message, NURSE_GROUP_ID, priority=priority)
+
+    logger.debug("Held %s alert for the next digest", category)
+    return True
+
+
+def _open_window():
+    global _window_timer
+
+    _window_timer = threading.Timer(ALERT_DIGEST_WINDOW_SECONDS, flush_alert_digest)
+    _window_timer.daemon = True
+    _window_timer.start()
+
+
+def flush_alert_digest(final=False):
+    """
+    Send the held alerts (one digest, or the alert itself if only one)
+
+    Args:
+        final: Close the window even if alerts were sent (shutdown)
+
+    Returns:
+        int: Number of alerts sent
+    """
+    global _window_timer
+
+    with _pending_lock:
+        alerts = sorted(_pending)
+        _pending.clear()
+        if alerts and not final:
+            # Still busy: keep holding for another window
+            _open_window()
+        else:
+            _window_timer = None
+
+    if not alerts:
+        return 0
+
+    # The replayer sends any it took over (it thought this process had died)
+    message_ids = claim_held([alert[5] for alert in alerts])
+    alerts = [alert for alert in alerts if alert[5] is None or alert[5] in message_ids]
+    if not alerts:
+        return 0
+
+    priority = alerts[0][0]
+    if len(alerts) == 1:
+        send_line_push(alerts[0][3], NURSE_GROUP_ID, priority=priority)
+    else:
+        for text in build_alert_digest([alert[:5] for alert in alerts]):
+            send_line_push(text, NURSE_GROUP_ID, priority=priority)
+        logger.info("Sent digest of %d nurse alerts", len(alerts))
+    # Only now: the digest is in the outbox itself
+    mark_held_sent(message_ids)
+    return len(alerts)
+
+
+def build_alert_digest(alerts):
+    """
+    Format held alerts as digest messages
+
+    Alerts are listed most urgent first. The digest is split into several
+    messages if it would exceed LINE's text limit.
+
+    Args:
+        alerts: List of (priority, order, category, message, received_at)
+
+    Returns:
+        list: Message texts
+    """
+    counts = Counter(category for _, _, category, _, _ in alerts)
+    times = [received_at for _, _, _, _, received_at in alerts]
+
+    header = (
+        f"📋 สรุปการแจ้งเตือน {len(alerts)} รายการ\n"
+        f"🕐 {min(times).strftime('%H:%M')}–{max(times).strftime('%H:%M')} น.\n"
+    )
+    for category, count in counts.most_common():
+        header += f"  {ALERT_CATEGORIES.get(category, category)}: {count}\n"
+
+    messages = []
+    current = header
+    for _, _, _, message, received_at in alerts:
+        item = f"[{received_at.strftime('%H:%M')}] {message}"
+        limit = LINE_TEXT_MAX - len(DIGEST_SEPARATOR) - 100  # Room for a continuation header
+        if len(item) > limit:
+            item = item[:limit - 1] + "…"
+        if len(current) + len(DIGEST_SEPARATOR) + len(item) > LINE_TEXT_MAX:
+            messages.append(current)
+            current = f"📋 สรุปการแจ้งเตือน (ต่อ {len(messages) + 1})"
+        current += DIGEST_SEPARATOR + item
+    messages.append(current)
+    return messages
+
+
+def pending_alert_count():
+    """Number of alerts held for the next digest"""
+    with _pending_lock:
+        return len(_pending)
+
+
+def _flush_alert_digest_at_exit():
+    flush_alert_digest(final=True)
+    drain(DISPATCH_DRAIN_SECONDS)
+
+
+atexit.register(_flush_alert_digest_at_exit)
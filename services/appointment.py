@@ -6,11 +6,14 @@ Handles appointment booking and management
 from datetime import datetime
 from config import get_logger
 from database import save_appointment_data
-from services.notification import send_line_push, build_appointment_notification
+from services.notification import build_appointment_notification
+from services.alert_digest import send_nurse_alert
+from utils.tracing import traced
 
 logger = get_logger(__name__)
 
 
+@traced
 def create_appointment(user_id, name, phone, preferred_date, preferred_time, reason):
     """
     Create new appointment request
@@ -45,7 +48,7 @@ def create_appointment(user_id, name, phone, preferred_date, preferred_time, rea
         notify_msg = build_appointment_notification(
             user_id, name, phone, preferred_date, preferred_time, reason
         )
-        send_line_push(notify_msg)
+        send_nurse_alert(notify_msg, 'appointment')
         
         # Format confirmation message
         date_display = format_thai_date(preferred_date)
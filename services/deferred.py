@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Deferred Task Service Module
+Run webhook side effects (sheet writes, nurse alerts) after the reply
+
+A task that raises or returns False is retried with exponential backoff
+up to DEFERRED_MAX_ATTEMPTS times, then logged as failed.
+"""
+import atexit
+import itertools
+import queue
+import random
+import threading
+import time
+from config import (
+    DEFERRED_ENABLED,
+    DEFERRED_WORKERS,
+    DEFERRED_QUEUE_SIZE,
+    DEFERRED_MAX_ATTEMPTS,
+    DEFERRED_RETRY_BASE_SECONDS,
+    DEFERRED_RETRY_MAX_SECONDS,
+    DISPATCH_DRAIN_SECONDS,
+    get_logger
+)
+from services.dispatcher import drain as drain_dispatcher
+
+logger = get_logger(__name__)
+
+_tasks = queue.Queue(maxsize=DEFERRED_QUEUE_SIZE)
+_task_ids = itertools.count(1)
+_workers = []
+_workers_lock = threading.Lock()
+
+# Tasks waiting out a retry delay: task_id -> threading.Timer
+_retrying = {}
+_retrying_lock = threading.Lock()
+
+_stats = {'queued': 0, 'completed': 0, 'retried': 0, 'failed': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def _task_name(func):
+    return getattr(func, '__name__', repr(func))
+
+
+def _worker_loop():
+    while True:
+        task = _tasks.get()
+        try:
+            _run(task)
+        finally:
+            _tasks.task_done()
+
+
+def _run(task):
+    """Run one attempt; schedule a retry if it failed"""
+    task_id, attempt, func, args, kwargs = task
+    try:
+        ok = func(*args, **kwargs) is not False
+    except Exception as e:
+        logger.exception(f"Deferred {_task_name(func)} raised: {e}")
+        ok = False
+
+    if ok:
+        _count('completed')
+        return True
+
+    if attempt + 1 >= DEFERRED_MAX_ATTEMPTS:
+        _count('failed')
+        logger.error("Deferred %s failed after %d attempts, giving up", _task_name(func), attempt + 1)
+        return False
+
+    delay = min(DEFERRED_RETRY_MAX_SECONDS, DEFERRED_RETRY_BASE_SECONDS * (2 ** attempt))
+    delay = random.uniform(delay / 2, delay)
+    logger.warning("Deferred %s failed (attempt %d), retrying in %.1fs",
+                   _task_name(func), attempt + 1, delay)
+    _count('retried')
+
+    timer = threading.Timer(delay, _requeue, ((task_id, attempt + 1, func, args, kwargs),))
+    timer.daemon = True
+    with _retrying_lock:
+        _retrying[task_id] = timer
+    timer.start()
+    return False
+
+
+def _requeue(task):
+    # Runs once per retry, whether from its timer or from drain()
+    with _retrying_lock:
+        if _retrying.pop(task[0], None) is None:
+            return
+    _submit(task)
+
+
+def _submit(task):
+    try:
+        _tasks.put_nowait(task)
+    except queue.Full:
+        logger.warning("Deferred queue full, running %s in the caller's thread", _task_name(task[2]))
+        _run(task)
+
+
+def _ensure_workers():
+    with _workers_lock:
+        if _workers:
+            return
+        for i in range(DEFERRED_WORKERS):
+            worker = threading.Thread(target=_worker_loop, name=f"deferred-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+        atexit.register(_drain_at_exit)
+
+
+def run_deferred(func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) in the background, retrying on failure
+
+    With DEFERRED_ENABLED off the task runs right away in the caller's
+    thread (retries still happen in the background).
+
+    Args:
+        func: Side effect to run; returning False counts as a failure
+
+    Returns:
+        bool: True if queued (or, when not deferred, if it succeeded)
+    """
+    task = (next(_task_ids), 0, func, args, kwargs)
+    _count('queued')
+    if not DEFERRED_ENABLED:
+        return _run(task)
+
+    _ensure_workers()
+    _submit(task)
+    return True
+
+
+def drain(timeout=None):
+    """
+    Wait for queued tasks to finish (shutdown, tests)
+
+    Tasks waiting for a retry are run once more right away.
+
+    Args:
+        timeout: Seconds to wait at most (None = until empty)
+
+    Returns:
+        bool: True if nothing is left
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        with _retrying_lock:
+            waiting = list(_retrying.values())
+        for timer in waiting:
+            timer.cancel()
+            _requeue(*timer.args)
+        
+        if not waiting and not _tasks.unfinished_tasks:
+            return True
+        if deadline is not None and time.monotonic() >= deadline:
+            logger.warning("Gave up waiting for %d deferred tasks", _tasks.unfinished_tasks + len(waiting))
+            return False
+        time.sleep(0.05)
+
+
+def _drain_at_exit():
+    drain(DISPATCH_DRAIN_SECONDS)
+    # Alerts queued by the tasks above still need the notification workers
+    drain_dispatcher(DISPATCH_DRAIN_SECONDS)
+
+
+def get_deferred_metrics():
+    """
+    Counters for deferred tasks
+
+    Returns:
+        dict: queued, completed, retried, failed, pending, retrying
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    with _retrying_lock:
+        stats['retrying'] = len(_retrying)
+    stats['pending'] = _tasks.qsize()
+    return stats
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Dispatcher Service Module
+Run outbound notifications on a background worker pool
+"""
+import atexit
+import itertools
+import queue
+import threading
+import time
+from config import (
+    DISPATCH_WORKERS,
+    DISPATCH_QUEUE_SIZE,
+    DISPATCH_DRAIN_SECONDS,
+    get_logger
+)
+
+logger = get_logger(__name__)
+
+# Lower number = sent first
+PRIORITY_EMERGENCY = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+PRIORITY_LOW = 3
+
+_tasks = queue.PriorityQueue(maxsize=DISPATCH_QUEUE_SIZE)
+_sequence = itertools.count()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def _worker_loop():
+    """Take the most urgent task, run it, report the result to its callback"""
+    while True:
+        _, _, func, args, on_done = _tasks.get()
+        try:
+            _run(func, args, on_done)
+        finally:
+            _tasks.task_done()
+
+
+def _run(func, args, on_done):
+    try:
+        result = func(*args)
+    except Exception as e:
+        logger.exception(f"Error in dispatched {getattr(func, '__name__', func)}: {e}")
+        result = False
+    if on_done is not None:
+        try:
+            on_done(result)
+        except Exception as e:
+            logger.exception(f"Error in delivery callback: {e}")
+    return result
+
+
+def _ensure_workers():
+    with _workers_lock:
+        if _workers:
+            return
+        for i in range(DISPATCH_WORKERS):
+            worker = threading.Thread(target=_worker_loop, name=f"notify-dispatch-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+        atexit.register(drain, DISPATCH_DRAIN_SECONDS)
+
+
+def submit(func, args=(), priority=PRIORITY_NORMAL, on_done=None):
+    """
+    Run func(*args) on the worker pool
+
+    Tasks with a lower priority number are taken first; equal priorities
+    keep their submission order. If the queue is full the task runs in the
+    caller's thread instead, so nothing is dropped.
+
+    Args:
+        func: Callable to run
+        args: Positional arguments
+        priority: PRIORITY_EMERGENCY .. PRIORITY_LOW
+        on_done: Optional callback, called with func's return value
+
+    Returns:
+        True if queued, otherwise func's result from the synchronous run
+    """
+    _ensure_workers()
+    try:
+        _tasks.put_nowait((priority, next(_sequence), func, tuple(args), on_done))
+        return True
+    except queue.Full:
+        logger.warning("Notification queue full, sending in the request thread")
+        return _run(func, args, on_done)
+
+
+def pending_count():
+    """Number of tasks waiting for a worker"""
+    return _tasks.qsize()
+
+
+def drain(timeout=None):
+    """
+    Wait for queued tasks to finish (shutdown, tests)
+
+    Args:
+        timeout: Seconds to wait at most (None = until empty)
+
+    Returns:
+        bool: True if everything was sent
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while _tasks.unfinished_tasks:
+        if deadline is not None and time.monotonic() >= deadline:
+            logger.warning("Gave up waiting for %d notifications", _tasks.unfinished_tasks)
+            return False
+        time.sleep(0.05)
+    return True
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite Job Store Module
+Persist APScheduler jobs in a local SQLite file (stdlib sqlite3, no SQLAlchemy)
+"""
+import pickle
+import sqlite3
+import threading
+from apscheduler.jobstores.base import BaseJobStore, JobLookupError, ConflictingIdError
+from apscheduler.job import Job
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+from config import get_logger
+
+logger = get_logger(__name__)
+
+
+class SQLiteJobStore(BaseJobStore):
+    """
+    Job store keeping pickled job state in SQLite
+
+    Same table layout as APScheduler's SQLAlchemyJobStore. Also keeps a
+    small key/value table the scheduler uses to remember what it last
+    reconciled against, and the ids of one-shot jobs that have fired
+    (they leave the jobs table once they run).
+    """
+
+    def __init__(self, path, tablename='apscheduler_jobs', pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        super().__init__()
+        self.path = path
+        self.tablename = tablename
+        self.pickle_protocol = pickle_protocol
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        with self._lock:
+            self._connect()
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        if self.path != ':memory:':
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.tablename} ("
+            "id TEXT PRIMARY KEY, next_run_time REAL, job_state BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.tablename}_next_run_time "
+            f"ON {self.tablename} (next_run_time)"
+        )
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.tablename}_meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.tablename}_fired (id TEXT PRIMARY KEY, fired_at REAL)"
+        )
+        self._conn.commit()
+        return self._conn
+
+    def lookup_job(self, job_id):
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT job_state FROM {self.tablename} WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._reconstitute_job(row[0]) if row else None
+
+    def get_due_jobs(self, now):
+        timestamp = datetime_to_utc_timestamp(now)
+        return self._get_jobs("WHERE next_run_time <= ?", (timestamp,))
+
+    def get_next_run_time(self):
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT MIN(next_run_time) FROM {self.tablename} WHERE next_run_time IS NOT NULL"
+            ).fetchone()
+        return utc_timestamp_to_datetime(row[0]) if row and row[0] is not None else None
+
+    def get_all_jobs(self):
+        jobs = self._get_jobs()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def get_job_ids(self):
+        """IDs of all stored jobs, without unpickling them"""
+        with self._lock:
+            return [r[0] for r in self._connect().execute(f"SELECT id FROM {self.tablename}").fetchall()]
+
+    def add_job(self, job):
+        try:
+            with self._lock:
+                self._connect().execute(
+                    f"INSERT INTO {self.tablename} (id, next_run_time, job_state) VALUES (?, ?, ?)",
+                    (job.id, datetime_to_utc_timestamp(job.next_run_time),
+                     pickle.dumps(job.__getstate__(), self.pickle_protocol))
+                )
+                self._conn.commit()
+        except sqlite3.IntegrityError:
+            raise ConflictingIdError(job.id)
+
+    def update_job(self, job):
+        with self._lock:
+            cur = self._connect().execute(
+                f"UPDATE {self.tablename} SET next_run_time = ?, job_state = ? WHERE id = ?",
+                (datetime_to_utc_timestamp(job.next_run_time),
+                 pickle.dumps(job.__getstate__(), self.pickle_protocol), job.id)
+            )
+            self._conn.commit()
+        if cur.rowcount == 0:
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        with self._lock:
+            cur = self._connect().execute(f"DELETE FROM {self.tablename} WHERE id = ?", (job_id,))
+            self._conn.commit()
+        if cur.rowcount == 0:
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        with self._lock:
+            self._connect().execute(f"DELETE FROM {self.tablename}")
+            self._conn.commit()
+
+    def shutdown(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get_meta(self, key):
+        """Stored value for a key (None if unset)"""
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT value FROM {self.tablename}_meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._connect().execute(
+                f"INSERT INTO {self.tablename}_meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+            self._conn.commit()
+
+    def mark_fired(self, job_id, fired_at):
+        """Remember that a job has run (fired_at: Unix time)"""
+        with self._lock:
+            self._connect().execute(
+                f"INSERT OR REPLACE INTO {self.tablename}_fired (id, fired_at) VALUES (?, ?)",
+                (job_id, fired_at)
+            )
+            self._conn.commit()
+
+    def get_fired_ids(self):
+        """IDs of jobs recorded with mark_fired()"""
+        with self._lock:
+            return {r[0] for r in self._connect().execute(f"SELECT id FROM {self.tablename}_fired").fetchall()}
+
+    def prune_fired(self, before):
+        """Forget jobs that fired before a Unix time"""
+        with self._lock:
+            self._connect().execute(f"DELETE FROM {self.tablename}_fired WHERE fired_at < ?", (before,))
+            self._conn.commit()
+
+    def _reconstitute_job(self, job_state):
+        job_state = pickle.loads(job_state)
+        job_state['jobstore'] = self
+        job = Job.__new__(Job)
+        job.__setstate__(job_state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _get_jobs(self, where="", params=()):
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT id, job_state FROM {self.tablename} {where} ORDER BY next_run_time",
+                params
+            ).fetchall()
+
+        jobs = []
+        failed_job_ids = []
+        for job_id, job_state in rows:
+            try:
+                jobs.append(self._reconstitute_job(job_state))
+            except Exception:
+                logger.exception(f"Unable to restore job {job_id} -- removing it")
+                failed_job_ids.append(job_id)
+
+        if failed_job_ids:
+            with self._lock:
+                self._connect().executemany(
+                    f"DELETE FROM {self.tablename} WHERE id = ?", [(i,) for i in failed_job_ids]
+                )
+                self._conn.commit()
+
+        return jobs
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} (path={self.path})>"
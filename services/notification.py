@@ -3,25 +3,234 @@
 Notification Service Module
 Handles LINE push notifications
 """
+import threading
+import time
+import uuid
+from collections import deque
 import requests
+from requests.adapters import HTTPAdapter
 from config import (
     get_logger,
     LINE_CHANNEL_ACCESS_TOKEN,
     NURSE_GROUP_ID,
     LINE_API_URL,
+    LINE_MULTICAST_URL,
+    LINE_MULTICAST_MAX,
+    LINE_HTTP_POOL_SIZE,
+    LINE_HTTP_CONNECT_TIMEOUT,
+    LINE_HTTP_READ_TIMEOUT,
+    DISPATCH_ENABLED,
     WORKSHEET_LINK
 )
+from services.dispatcher import submit, PRIORITY_NORMAL
+from services.outbox import record_message, finish_message
+from utils.ratelimit import call_api
+from utils.metrics import counter, histogram
 
 logger = get_logger(__name__)
 
+# Shared LINE API session (keep-alive connection pool)
+_line_session = None
+_line_session_lock = threading.Lock()
 
-def send_line_push(message, target_id=None):
+# Per-call latency stats (see get_line_metrics)
+_line_latencies = deque(maxlen=1000)
+_line_stats = {'calls': 0, 'failures': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+_line_stats_lock = threading.Lock()
+
+LINE_REQUESTS = counter('kwannurse_line_requests_total', "LINE API requests", ('endpoint', 'outcome'))
+LINE_LATENCY = histogram('kwannurse_line_request_duration_seconds', "LINE API request latency", ('endpoint',))
+
+
+def get_line_session():
+    """
+    Get the shared requests session for the LINE API (singleton pattern)
+    
+    Connections are kept alive and reused, so pushes after the first skip
+    the TCP/TLS handshake. Safe to share between threads.
+    
+    Returns:
+        requests.Session
     """
-    Send LINE push notification
+    global _line_session
+    
+    with _line_session_lock:
+        if _line_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=LINE_HTTP_POOL_SIZE,
+                pool_block=False
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({'Content-Type': 'application/json'})
+            _line_session = session
+            logger.info("LINE API session created (pool size %d)", LINE_HTTP_POOL_SIZE)
+        return _line_session
+
+
+def _record_line_call(endpoint, elapsed_ms, ok):
+    LINE_REQUESTS.inc(endpoint=endpoint, outcome='ok' if ok else 'failed')
+    LINE_LATENCY.observe(elapsed_ms / 1000, endpoint=endpoint)
+    with _line_stats_lock:
+        _line_stats['calls'] += 1
+        if not ok:
+            _line_stats['failures'] += 1
+        _line_stats['total_ms'] += elapsed_ms
+        _line_stats['max_ms'] = max(_line_stats['max_ms'], elapsed_ms)
+        _line_latencies.append(elapsed_ms)
+
+
+def get_line_metrics():
+    """
+    Latency stats for LINE API calls made by this process
+    
+    Returns:
+        dict: calls, failures, avg/max latency and p50/p95/p99 over the
+              last 1000 calls (milliseconds)
+    """
+    with _line_stats_lock:
+        stats = dict(_line_stats)
+        recent = sorted(_line_latencies)
+    
+    def percentile(p):
+        if not recent:
+            return 0.0
+        return round(recent[min(len(recent) - 1, int(len(recent) * p))], 1)
+    
+    return {
+        'calls': stats['calls'],
+        'failures': stats['failures'],
+        'avg_ms': round(stats['total_ms'] / stats['calls'], 1) if stats['calls'] else 0.0,
+        'max_ms': round(stats['max_ms'], 1),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99)
+    }
+
+
+def send_line_push(message, target_id=None, priority=PRIORITY_NORMAL, on_delivered=None,
+                   on_sent=None, context=None):
+    """
+    Send LINE push notification without blocking the caller
+    
+    The push is recorded in the outbox and handed to the dispatcher's
+    worker pool; more urgent pushes (lower priority number) go out first.
+    If LINE fails, the outbox retries it later with the same retry key.
     
     Args:
         message: Message text to send
         target_id: Target user/group ID (default: NURSE_GROUP_ID)
+        priority: services.dispatcher PRIORITY_* value
+        on_delivered: Optional callback, called with True/False after the first attempt
+        on_sent: Optional outbox handler name, run whenever the push is delivered
+        context: JSON-serializable data passed to the on_sent handler
+    
+    Returns:
+        boolean: True if queued (or sent, when dispatch is disabled)
+    """
+    if not target_id:
+        target_id = NURSE_GROUP_ID
+    if not LINE_CHANNEL_ACCESS_TOKEN or not target_id:
+        logger.warning("LINE token or target_id not configured")
+        return False
+    
+    retry_key = str(uuid.uuid4())
+    message_id = record_message('push', target_id, message, priority, on_sent, context, retry_key)
+    return _dispatch(deliver_line_push, (message, target_id, retry_key), message_id, priority,
+                     on_delivered, lambda ok: [target_id] if ok else [])
+
+
+def _dispatch(func, args, message_id, priority, on_delivered, delivered_ids):
+    """Run a delivery on the worker pool, then record it in the outbox"""
+    def on_done(result):
+        finish_message(message_id, delivered_ids(result))
+        if on_delivered is not None:
+            on_delivered(result)
+    
+    if not DISPATCH_ENABLED:
+        result = func(*args)
+        on_done(result)
+        return bool(result)
+    
+    return submit(func, args, priority, on_done)
+
+
+def resend_message(message):
+    """
+    Hand an outbox message back to the dispatcher (see services.outbox)
+    
+    Args:
+        message: Outbox message dict
+    
+    Returns:
+        boolean: True if queued (or sent, when dispatch is disabled)
+    """
+    target = message['target']
+    retry_key = message.get('retry_key')
+    if message['kind'] == 'push':
+        return _dispatch(deliver_line_push, (message['message'], target, retry_key), message['id'],
+                         message['priority'], None, lambda ok: [target] if ok else [])
+    return _dispatch(deliver_line_multicast, (message['message'], target, retry_key), message['id'],
+                     message['priority'], None, lambda delivered: delivered)
+
+
+def _post_line(url, payload, retry_key=None):
+    """
+    POST to the LINE API on the shared session, recording latency
+    
+    Goes through the 'line' rate limiter, which retries 429/5xx and
+    connection errors. Every attempt carries the same X-Line-Retry-Key,
+    so LINE drops a retry of a message it already accepted (409).
+    
+    Args:
+        retry_key: The message's key, so outbox replays reuse it too
+                   (a new one per call if not given)
+    
+    Returns:
+        tuple: (ok, response, elapsed_ms)
+    """
+    headers = {
+        'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}',
+        'X-Line-Retry-Key': retry_key or str(uuid.uuid4())
+    }
+    
+    endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+    elapsed = [0.0]
+    
+    def post():
+        started = time.perf_counter()
+        try:
+            resp = get_line_session().post(
+                url,
+                headers=headers,
+                json=payload,
+                timeout=(LINE_HTTP_CONNECT_TIMEOUT, LINE_HTTP_READ_TIMEOUT)
+            )
+        except Exception:
+            _record_line_call(endpoint, (time.perf_counter() - started) * 1000, False)
+            raise
+        elapsed[0] = (time.perf_counter() - started) * 1000
+        _record_line_call(endpoint, elapsed[0], resp.status_code // 100 == 2)
+        return resp
+    
+    resp = call_api('line', post)
+    elapsed_ms = elapsed[0]
+    if resp.status_code == 409 and resp.headers.get('x-line-accepted-request-id'):
+        # A retry of a request LINE had already accepted
+        return True, resp, elapsed_ms
+    return resp.status_code // 100 == 2, resp, elapsed_ms
+
+
+def deliver_line_push(message, target_id=None, retry_key=None):
+    """
+    Send LINE push notification and wait for the result
+    
+    Args:
+        message: Message text to send
+        target_id: Target user/group ID (default: NURSE_GROUP_ID)
+        retry_key: X-Line-Retry-Key (see _post_line)
     
     Returns:
         boolean (success/failure)
@@ -35,20 +244,15 @@ def send_line_push(message, target_id=None):
             logger.warning("LINE token or target_id not configured")
             return False
         
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {access_token}'
-        }
-        
         payload = {
             "to": target_id,
             "messages": [{"type": "text", "text": message}]
         }
         
-        resp = requests.post(LINE_API_URL, headers=headers, json=payload, timeout=8)
+        ok, resp, elapsed_ms = _post_line(LINE_API_URL, payload, retry_key)
         
-        if resp.status_code // 100 == 2:
-            logger.info("Push notification sent to %s", target_id)
+        if ok:
+            logger.info("Push notification sent to %s (%.0f ms)", target_id, elapsed_ms)
             return True
         else:
             logger.error("LINE push failed: %s %s", resp.status_code, resp.text)
@@ -59,6 +263,87 @@ def send_line_push(message, target_id=None):
         return False
 
 
+def deliver_line_multicast(message, user_ids, retry_key=None):
+    """
+    Send the same message to many users with LINE multicast
+    
+    Recipients are sent in chunks of LINE_MULTICAST_MAX (the API limit is
+    500 per call). A single recipient goes out as a normal push. Each
+    chunk's retry key is derived from `retry_key` and its recipients, so
+    resending the same chunk reuses it.
+    
+    Args:
+        message: Message text to send
+        user_ids: LINE user IDs (not group IDs)
+        retry_key: The message's X-Line-Retry-Key (None: new keys)
+    
+    Returns:
+        list: User IDs in chunks LINE accepted
+    """
+    user_ids = list(dict.fromkeys(u for u in user_ids if u))
+    if not user_ids:
+        return []
+    if len(user_ids) == 1:
+        return user_ids if deliver_line_push(message, user_ids[0], _chunk_key(retry_key, user_ids)) else []
+    
+    if not LINE_CHANNEL_ACCESS_TOKEN:
+        logger.warning("LINE token not configured")
+        return []
+    
+    delivered = []
+    for start in range(0, len(user_ids), LINE_MULTICAST_MAX):
+        chunk = user_ids[start:start + LINE_MULTICAST_MAX]
+        payload = {
+            "to": chunk,
+            "messages": [{"type": "text", "text": message}]
+        }
+        try:
+            ok, resp, elapsed_ms = _post_line(LINE_MULTICAST_URL, payload, _chunk_key(retry_key, chunk))
+            if ok:
+                delivered.extend(chunk)
+                logger.info("Multicast sent to %d users (%.0f ms)", len(chunk), elapsed_ms)
+            else:
+                logger.error("LINE multicast failed for %d users: %s %s", len(chunk), resp.status_code, resp.text)
+        except Exception:
+            logger.exception(f"Error sending LINE multicast to {len(chunk)} users")
+    
+    return delivered
+
+
+def _chunk_key(retry_key, user_ids):
+    """Retry key for one multicast call: the same message and recipients give the same key"""
+    if not retry_key:
+        return None
+    return str(uuid.uuid5(uuid.UUID(retry_key), ",".join(user_ids)))
+
+
+def send_line_multicast(message, user_ids, priority=PRIORITY_NORMAL, on_delivered=None,
+                        on_sent=None, context=None):
+    """
+    Multicast without blocking the caller (see send_line_push)
+    
+    Args:
+        message: Message text to send
+        user_ids: LINE user IDs
+        priority: services.dispatcher PRIORITY_* value
+        on_delivered: Optional callback, called with the user IDs LINE accepted on the first attempt
+        on_sent: Optional outbox handler name, run with the user IDs of each delivery
+        context: JSON-serializable data passed to the on_sent handler
+    
+    Returns:
+        boolean: True if queued (or sent, when dispatch is disabled)
+    """
+    user_ids = list(dict.fromkeys(u for u in user_ids if u))
+    if not LINE_CHANNEL_ACCESS_TOKEN or not user_ids:
+        logger.warning("LINE token or recipients not configured")
+        return False
+    
+    retry_key = str(uuid.uuid4())
+    message_id = record_message('multicast', user_ids, message, priority, on_sent, context, retry_key)
+    return _dispatch(deliver_line_multicast, (message, user_ids, retry_key), message_id, priority,
+                     on_delivered, lambda delivered: delivered)
+
+
 def build_symptom_notification(user_id, pain, wound, fever, mobility, risk_level, risk_score):
     """
     Build notification message for symptom report
@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+"""
+Outbox Service Module
+Keep every outbound LINE message in SQLite until LINE has accepted it
+
+A message is recorded before it is handed to the dispatcher and marked
+sent once delivered. Failed messages wait with exponential backoff and are
+replayed by a background thread; gunicorn workers share the file and claim
+rows atomically, so each message is sent by one worker. The first success
+after an outage pulls the whole backlog forward.
+
+Every message keeps one X-Line-Retry-Key for all its attempts, so LINE
+drops a resend of something it already accepted. Rows record the process
+sending them, and each process checks in from its replayer thread; a
+"sending" row is only taken over once its process has stopped checking in.
+
+Messages can also be recorded as "held" (nurse alerts waiting for a
+digest). The process holding them sends them later; if it dies first, they
+are taken over the same way and sent one by one.
+
+Follow-up work that must happen after delivery (e.g. recording a reminder
+as sent) is registered as a named handler and stored with the message, so
+it also runs when the message is only delivered on a later replay.
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from config import (
+    OUTBOX_DB_PATH,
+    OUTBOX_POLL_SECONDS,
+    OUTBOX_REPLAY_BATCH,
+    OUTBOX_RETRY_BASE_SECONDS,
+    OUTBOX_RETRY_MAX_SECONDS,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_STALE_SECONDS,
+    OUTBOX_RETENTION_HOURS,
+    get_logger
+)
+
+logger = get_logger(__name__)
+
+# Message statuses
+STATUS_SENDING = 'sending'
+STATUS_RETRY = 'retry'
+STATUS_SENT = 'sent'
+STATUS_DEAD = 'dead'
+STATUS_HELD = 'held'
+
+# Distinguishes this run from an earlier process that had the same pid
+_INSTANCE = uuid.uuid4().hex[:8]
+
+
+def _owner():
+    """This process, as stored in outbox.owner (forked workers differ by pid)"""
+    return f"{os.getpid()}-{_INSTANCE}"
+
+
+class Outbox:
+    """
+    Outbound messages table
+
+    kind is 'push' (target = one user/group ID) or 'multicast' (target =
+    list of user IDs). A partly delivered multicast keeps only the users
+    still waiting as its target.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        if path != ':memory:':
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, target TEXT NOT NULL, "
+            "message TEXT NOT NULL, priority INTEGER NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+            "on_sent TEXT, context TEXT, retry_key TEXT, owner TEXT)"
+        )
+        # Files from before retry keys and owners
+        columns = {r['name'] for r in self._conn.execute("PRAGMA table_info(outbox)").fetchall()}
+        for column in ('retry_key', 'owner'):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} TEXT")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, next_attempt_at)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox_owners (owner TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def add(self, kind, target, message, priority, on_sent=None, context=None, retry_key=None, held=False):
+        """
+        Record a message that is about to be sent
+
+        Args:
+            retry_key: X-Line-Retry-Key for every attempt (a new one if not given)
+            held: Not sent now; this process sends it later (claim_held)
+
+        Returns:
+            int: Message ID
+        """
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO outbox (kind, target, message, priority, status, created_at, "
+                "updated_at, on_sent, context, retry_key, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(target), message, priority, STATUS_HELD if held else STATUS_SENDING, now, now,
+                 on_sent, json.dumps(context) if context is not None else None,
+                 retry_key or str(uuid.uuid4()), _owner())
+            )
+            self._conn.commit()
+            return cur.lastrowid
+
+    def heartbeat(self):
+        """Record that this process is alive (its "sending" rows are not stale)"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO outbox_owners (owner, seen_at) VALUES (?, ?) "
+                "ON CONFLICT(owner) DO UPDATE SET seen_at = excluded.seen_at",
+                (_owner(), time.time())
+            )
+            self._conn.commit()
+
+    def get(self, message_id):
+        """Message as a dict (target and context decoded), or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM outbox WHERE id = ?", (message_id,)).fetchone()
+        return _decode(row) if row else None
+
+    def claim_due(self, limit=OUTBOX_REPLAY_BATCH):
+        """
+        Take messages that are due for another attempt
+
+        Includes messages left "sending" or "held" by a worker that died:
+        stale, and their process hasn't checked in (heartbeat) within
+        OUTBOX_STALE_SECONDS. A live worker's rows may sit in its
+        dispatcher queue that long. Each row is claimed with a conditional
+        UPDATE, so only one worker gets it.
+
+        Returns:
+            list: Claimed messages (dicts)
+        """
+        now = time.time()
+        stale = now - OUTBOX_STALE_SECONDS
+        claimed = []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM outbox WHERE (status = ? AND next_attempt_at <= ?) "
+                "OR (status IN (?, ?) AND updated_at < ? AND COALESCE(owner, '') NOT IN "
+                "(SELECT owner FROM outbox_owners WHERE seen_at >= ?)) ORDER BY priority, id LIMIT ?",
+                (STATUS_RETRY, now, STATUS_SENDING, STATUS_HELD, stale, stale, limit)
+            ).fetchall()
+            for row in rows:
+                cur = self._conn.execute(
+                    "UPDATE outbox SET status = ?, updated_at = ?, owner = ? "
+                    "WHERE id = ? AND status = ? AND updated_at = ?",
+                    (STATUS_SENDING, now, _owner(), row['id'], row['status'], row['updated_at'])
+                )
+                if cur.rowcount:
+                    claimed.append(_decode(row))
+            self._conn.commit()
+        return claimed
+
+    def claim_held(self, message_ids):
+        """
+        Take held messages for sending (those no other worker took over)
+
+        Returns:
+            list: IDs claimed
+        """
+        now = time.time()
+        claimed = []
+        with self._lock:
+            for message_id in message_ids:
+                cur = self._conn.execute(
+                    "UPDATE outbox SET status = ?, updated_at = ?, owner = ? WHERE id = ? AND status = ?",
+                    (STATUS_SENDING, now, _owner(), message_id, STATUS_HELD)
+                )
+                if cur.rowcount:
+                    claimed.append(message_id)
+            self._conn.commit()
+        return claimed
+
+    def mark_sent(self, message_ids):
+        """Close messages whose content went out in another message (a digest)"""
+        ids = list(message_ids)
+        if not ids:
+            return
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE outbox SET status = ?, updated_at = ? "
+                f"WHERE id IN ({', '.join('?' * len(ids))}) AND status = ?",
+                [STATUS_SENT, time.time()] + ids + [STATUS_SENDING]
+            )
+            self._conn.commit()
+
+    def finish(self, message_id, delivered):
+        """
+        Record the outcome of an attempt
+
+        Args:
+            message_id: Message ID
+            delivered: IDs LINE accepted (all of the target, some, or none)
+
+        Returns:
+            dict: The message as it was before this update (None if unknown)
+        """
+        with self._lock:
+            message = self.get(message_id)
+            if message is None:
+                return None
+
+            if message['kind'] == 'push':
+                remaining = [] if delivered else [message['target']]
+            else:
+                delivered_set = set(delivered)
+                remaining = [u for u in message['target'] if u not in delivered_set]
+
+            now = time.time()
+            attempts = message['attempts'] + 1
+            if not remaining:
+                self._conn.execute(
+                    "UPDATE outbox SET status = ?, attempts = ?, updated_at = ? WHERE id = ?",
+                    (STATUS_SENT, attempts, now, message_id)
+                )
+            elif attempts >= OUTBOX_MAX_ATTEMPTS:
+                self._conn.execute(
+                    "UPDATE outbox SET status = ?, attempts = ?, updated_at = ?, target = ? WHERE id = ?",
+                    (STATUS_DEAD, attempts, now, json.dumps(_target(message['kind'], remaining)), message_id)
+                )
+                logger.error("Outbox message %s gave up after %d attempts", message_id, attempts)
+            else:
+                delay = min(OUTBOX_RETRY_MAX_SECONDS, OUTBOX_RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+                delay = random.uniform(delay / 2, delay)
+                self._conn.execute(
+                    "UPDATE outbox SET status = ?, attempts = ?, updated_at = ?, "
+                    "next_attempt_at = ?, target = ? WHERE id = ?",
+                    (STATUS_RETRY, attempts, now, now + delay,
+                     json.dumps(_target(message['kind'], remaining)), message_id)
+                )
+                logger.warning("Outbox message %s failed (attempt %d), retrying in %.0fs",
+                               message_id, attempts, delay)
+            self._conn.commit()
+            return message
+
+    def expedite(self):
+        """
+        Make every waiting message due now (LINE is reachable again)
+
+        Returns:
+            int: Number of messages moved forward
+        """
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE outbox SET next_attempt_at = ? WHERE status = ? AND next_attempt_at > ?",
+                (now, STATUS_RETRY, now)
+            )
+            self._conn.commit()
+            return cur.rowcount
+
+    def prune(self, hours=OUTBOX_RETENTION_HOURS):
+        """Delete sent messages (and processes last seen) older than `hours`"""
+        before = time.time() - hours * 3600
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM outbox WHERE status = ? AND updated_at < ?",
+                (STATUS_SENT, before)
+            )
+            self._conn.execute("DELETE FROM outbox_owners WHERE seen_at < ?", (before,))
+            self._conn.commit()
+            return cur.rowcount
+
+    def depth(self):
+        """Number of messages per status, sent ones excluded"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM outbox WHERE status != ? GROUP BY status",
+                (STATUS_SENT,)
+            ).fetchall()
+        counts = {STATUS_SENDING: 0, STATUS_RETRY: 0, STATUS_DEAD: 0, STATUS_HELD: 0}
+        counts.update({status: n for status, n in rows})
+        return counts
+
+
+def _target(kind, remaining):
+    return remaining[0] if kind == 'push' else remaining
+
+
+def _decode(row):
+    message = dict(row)
+    message['target'] = json.loads(message['target'])
+    message['context'] = json.loads(message['context']) if message['context'] else None
+    return message
+
+
+# ---- module API ---------------------------------------------------------
+
+_outbox = None
+_outbox_lock = threading.Lock()
+_handlers = {}
+_wake = threading.Event()
+_replayer_thread = None
+
+
+def get_outbox():
+    """
+    Get the outbox (singleton pattern)
+    Returns: Outbox or None if OUTBOX_DB_PATH is empty
+    """
+    global _outbox
+
+    if not OUTBOX_DB_PATH:
+        return None
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox(OUTBOX_DB_PATH)
+        return _outbox
+
+
+def register_handler(name, func):
+    """
+    Register follow-up work to run once a message is delivered
+
+    Args:
+        name: Handler name stored with the message (on_sent)
+        func: Called as func(message_text, context, delivered_ids)
+    """
+    _handlers[name] = func
+
+
+def record_message(kind, target, message, priority, on_sent=None, context=None, retry_key=None):
+    """
+    Record an outbound message before sending it
+
+    Args:
+        retry_key: X-Line-Retry-Key the first attempt uses; replays reuse it
+
+    Returns:
+        int: Message ID, or None if the outbox is disabled or unavailable
+    """
+    try:
+        outbox = get_outbox()
+        if outbox is None:
+            return None
+        start_replayer()
+        return outbox.add(kind, target, message, priority, on_sent, context, retry_key)
+    except Exception as e:
+        logger.exception(f"Error recording outbound message: {e}")
+        return None
+
+
+def hold_message(kind, target, message, priority):
+    """
+    Record a message to be sent later by this process (see claim_held)
+
+    If the process dies first, the replayer sends it once it is stale.
+
+    Returns:
+        int: Message ID, or None if the outbox is disabled or unavailable
+    """
+    try:
+        outbox = get_outbox()
+        if outbox is None:
+            return None
+        start_replayer()
+        return outbox.add(kind, target, message, priority, held=True)
+    except Exception as e:
+        logger.exception(f"Error holding outbound message: {e}")
+        return None
+
+
+def claim_held(message_ids):
+    """
+    Take held messages back for sending
+
+    Args:
+        message_ids: IDs from hold_message (None entries are kept as is)
+
+    Returns:
+        list: The IDs this process may send; the rest were taken over
+    """
+    ids = [m for m in message_ids if m is not None]
+    try:
+        claimed = set(get_outbox().claim_held(ids)) if ids else set()
+    except Exception as e:
+        logger.exception(f"Error claiming held messages: {e}")
+        claimed = set(ids)
+    return [m for m in message_ids if m is None or m in claimed]
+
+
+def mark_held_sent(message_ids):
+    """Record claimed held messages as sent (their text went out in a digest)"""
+    ids = [m for m in message_ids if m is not None]
+    if not ids:
+        return
+    try:
+        get_outbox().mark_sent(ids)
+    except Exception as e:
+        logger.exception(f"Error closing held messages: {e}")
+
+
+def finish_message(message_id, delivered):
+    """
+    Record a delivery attempt and run the message's on_sent handler
+
+    Args:
+        message_id: ID from record_message (None is ignored)
+        delivered: IDs LINE accepted in this attempt
+    """
+    if message_id is None:
+        return
+    try:
+        message = get_outbox().finish(message_id, delivered)
+    except Exception as e:
+        logger.exception(f"Error updating outbox message {message_id}: {e}")
+        return
+
+    if message is None or not delivered:
+        return
+
+    if message['attempts'] > 0:
+        logger.info("Outbox message %s delivered on replay", message_id)
+    # LINE is answering: retry the backlog now instead of waiting out the backoff
+    if get_outbox().expedite():
+        _wake.set()
+
+    handler = _handlers.get(message['on_sent'])
+    if message['on_sent'] and handler is None:
+        logger.error("No outbox handler named %s", message['on_sent'])
+    elif handler is not None:
+        try:
+            handler(message['message'], message['context'], list(delivered))
+        except Exception as e:
+            logger.exception(f"Error in outbox handler {message['on_sent']}: {e}")
+
+
+def replay_due():
+    """
+    Resend messages that are due for another attempt
+
+    Returns:
+        int: Number of messages handed to the dispatcher
+    """
+    outbox = get_outbox()
+    if outbox is None:
+        return 0
+
+    # Imported here: services.notification records its messages through this module
+    from services.notification import resend_message
+
+    messages = outbox.claim_due()
+    for message in messages:
+        resend_message(message)
+    if messages:
+        logger.info("Replaying %d outbox messages", len(messages))
+    return len(messages)
+
+
+def _replayer_loop():
+    last_prune = 0.0
+    while True:
+        try:
+            get_outbox().heartbeat()
+        except Exception as e:
+            logger.exception(f"Error recording outbox heartbeat: {e}")
+        _wake.wait(OUTBOX_POLL_SECONDS)
+        _wake.clear()
+        try:
+            replay_due()
+            if time.monotonic() - last_prune > 3600:
+                get_outbox().prune()
+                last_prune = time.monotonic()
+        except Exception as e:
+            logger.exception(f"Error replaying outbox: {e}")
+
+
+def start_replayer():
+    """Start the background replayer (once per process)"""
+    global _replayer_thread
+
+    if not OUTBOX_DB_PATH:
+        return
+    with _outbox_lock:
+        if _replayer_thread is not None:
+            return
+        _replayer_thread = threading.Thread(target=_replayer_loop, name="outbox-replayer", daemon=True)
+        _replayer_thread.start()
+        logger.info("Outbox replayer started (%s)", OUTBOX_DB_PATH)
+
+
+def get_outbox_metrics():
+    """
+    Outbox depth for monitoring
+
+    Returns:
+        dict: sending, retry, held and dead message counts (empty if disabled)
+    """
+    try:
+        outbox = get_outbox()
+        return outbox.depth() if outbox is not None else {}
+    except Exception as e:
+        logger.exception(f"Error reading outbox depth: {e}")
+        return {}
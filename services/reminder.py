@@ -3,24 +3,36 @@
 Reminder Service Module
 Handle follow-up reminder scheduling and sending
 """
+import atexit
+import threading
 from datetime import datetime, timedelta
 from config import (
     LOCAL_TZ,
     REMINDER_INTERVALS,
-    NURSE_GROUP_ID,
+    REMINDER_WAVE_WINDOW_SECONDS,
+    DISPATCH_DRAIN_SECONDS,
     get_logger
 )
 from database.reminders import (
     save_reminder_schedule,
-    save_reminder_sent,
+    save_reminders_sent,
     save_reminder_response,
     get_pending_reminders,
     check_no_response_reminders
 )
-from services.notification import send_line_push
+from services.notification import send_line_multicast
+from services.alert_digest import send_nurse_alert
+from services.dispatcher import PRIORITY_HIGH, PRIORITY_LOW, drain
+from services.outbox import register_handler
+from utils.keywords import get_symptom_classifier
 
 logger = get_logger(__name__)
 
+# Reminders waiting to go out together: message text -> [(user_id, reminder_type)]
+_wave = {}
+_wave_lock = threading.Lock()
+_wave_timer = None
+
 
 def get_reminder_message(reminder_type):
     """
@@ -81,36 +93,94 @@ def send_reminder(user_id, reminder_type):
     """
     Send a follow-up reminder to user
     
+    Reminders due at the same time (patients discharged on the same day)
+    are collected for REMINDER_WAVE_WINDOW_SECONDS and sent as one LINE
+    multicast per message text.
+    
     Args:
         user_id: User ID to send to
         reminder_type: Type of reminder (day3, day7, day14, day30)
         
     Returns:
-        bool: True if sent successfully
+        bool: True if queued for sending
     """
+    global _wave_timer
+    
     try:
         logger.info(f"Sending {reminder_type} reminder to {user_id}")
         
         # Get message
         message = get_reminder_message(reminder_type)
         
-        # Send via LINE
-        success = send_line_push(user_id, message)
-        
-        if success:
-            # Record in database
-            save_reminder_sent(user_id, reminder_type, message)
-            logger.info(f"Successfully sent {reminder_type} reminder to {user_id}")
-            return True
-        else:
-            logger.error(f"Failed to send {reminder_type} reminder to {user_id}")
-            return False
+        with _wave_lock:
+            _wave.setdefault(message, []).append((user_id, reminder_type))
+            if REMINDER_WAVE_WINDOW_SECONDS <= 0:
+                flush_now = True
+            else:
+                flush_now = False
+                if _wave_timer is None:
+                    _wave_timer = threading.Timer(REMINDER_WAVE_WINDOW_SECONDS, flush_reminder_wave)
+                    _wave_timer.daemon = True
+                    _wave_timer.start()
+        
+        if flush_now:
+            flush_reminder_wave()
+        return True
             
     except Exception as e:
         logger.exception(f"Error sending reminder: {e}")
         return False
 
 
+def flush_reminder_wave():
+    """
+    Send the collected reminders, one multicast per distinct message
+    
+    Returns:
+        int: Number of recipients handed to LINE
+    """
+    global _wave_timer
+    
+    with _wave_lock:
+        wave = dict(_wave)
+        _wave.clear()
+        _wave_timer = None
+    
+    queued = 0
+    for message, recipients in wave.items():
+        # Recorded as sent by the outbox handler, also when LINE only accepts a retry
+        send_line_multicast(
+            message,
+            [u for u, _ in recipients],
+            on_sent='reminders_sent',
+            context={'recipients': recipients}
+        )
+        queued += len(recipients)
+    
+    return queued
+
+
+def _record_reminders_sent(message, context, delivered):
+    """Outbox handler: save the delivered part of a reminder wave"""
+    delivered = set(delivered)
+    sent = [(u, t, message) for u, t in context['recipients'] if u in delivered]
+    if sent:
+        # Record in database
+        save_reminders_sent(sent)
+        logger.info(f"Successfully sent {len(sent)} reminders")
+
+
+register_handler('reminders_sent', _record_reminders_sent)
+
+
+def _flush_reminder_wave_at_exit():
+    flush_reminder_wave()
+    drain(DISPATCH_DRAIN_SECONDS)
+
+
+atexit.register(_flush_reminder_wave_at_exit)
+
+
 def schedule_follow_up_reminders(user_id, discharge_date):
     """
     Schedule all follow-up reminders for a patient
@@ -240,16 +310,8 @@ def check_response_for_concerns(user_id, reminder_type, response_text):
         response_text: User's response
     """
     try:
-        # Concerning keywords
-        concern_keywords = [
-            'ปวดมาก', 'ปวดเพิ่มขึ้น', 'หนอง', 'มีกลิ่น',
-            'บวมแดง', 'มีไข้', 'ตัวร้อน', 'เจ็บมาก',
-            'แผลแยก', 'เลือดออก', 'ไม่ดีขึ้น'
-        ]
-        
-        response_lower = response_text.lower()
-        
-        has_concern = any(keyword in response_lower for keyword in concern_keywords)
+        # Concerning keywords (SYMPTOM_KEYWORDS['concern'])
+        has_concern = 'concern' in get_symptom_classifier().classify(response_text)
         
         if has_concern:
             logger.warning(f"Concerning response detected from {user_id}: {response_text}")
@@ -263,7 +325,7 @@ def check_response_for_concerns(user_id, reminder_type, response_text):
                 f"กรุณาติดตามด่วนค่ะ"
             )
             
-            send_line_push(NURSE_GROUP_ID, alert_message)
+            send_nurse_alert(alert_message, 'concern', priority=PRIORITY_HIGH)
             logger.info(f"Sent concern alert for {user_id} to nurse")
             
     except Exception as e:
@@ -309,7 +371,7 @@ def check_and_alert_no_response():
                 f"กรุณาติดตามผู้ป่วยค่ะ"
             )
             
-            success = send_line_push(NURSE_GROUP_ID, alert_message)
+            success = send_nurse_alert(alert_message, 'no_response', priority=PRIORITY_LOW)
             if success:
                 alerts_sent += 1
                 logger.info(f"Sent no-response alert for {user_id}")
@@ -330,18 +392,25 @@ def get_reminder_summary(user_id):
         user_id: User ID
         
     Returns:
-        dict: Summary of user's reminders
+        dict: Summary of user's reminders (sent reminder counts by status,
+              the latest one, and the schedule still to come)
     """
     try:
-        from database.reminders import get_scheduled_reminders
+        from database.reminders import get_scheduled_reminders, get_user_reminders
         
         all_scheduled = get_scheduled_reminders()
         user_reminders = [r for r in all_scheduled if r.get('User_ID') == user_id]
         
-        pending = get_pending_reminders(user_id, None)
+        sent = get_user_reminders(user_id)
+        pending = [r for r in sent if r.get('Status') == 'sent']
         
         summary = {
             'user_id': user_id,
+            'total_reminders': len(sent),
+            'responded': sum(1 for r in sent if r.get('Status') == 'responded'),
+            'pending': len(pending),
+            'no_response': sum(1 for r in sent if r.get('Status') == 'no_response'),
+            'latest': sent[0] if sent else None,
             'total_scheduled': len(user_reminders),
             'pending_response': len(pending),
             'scheduled_reminders': user_reminders,
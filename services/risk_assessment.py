@@ -12,10 +12,13 @@ from config import (
 )
 from database import save_symptom_data, save_profile_data
 from services.notification import (
-    send_line_push,
     build_symptom_notification,
     build_risk_notification
 )
+from services.alert_digest import send_nurse_alert
+from services.dispatcher import PRIORITY_HIGH
+from services.deferred import run_deferred
+from utils.keywords import get_symptom_classifier
 
 logger = get_logger(__name__)
 
@@ -24,9 +27,35 @@ def calculate_symptom_risk(user_id, pain, wound, fever, mobility):
     """
     Calculate symptom-based risk score
     
+    The reply depends only on the scoring; saving the report and alerting
+    the nurses run as deferred tasks (see services.deferred).
+    
     Returns:
         str: Formatted message with risk assessment
     """
+    result = assess_symptoms(pain, wound, fever, mobility)
+    risk_level, risk_score = result['risk_level'], result['risk_score']
+    
+    # Save to sheet
+    run_deferred(save_symptom_data, user_id, pain, wound, fever, mobility, risk_level, risk_score)
+    
+    # Send notification if high risk
+    if risk_score >= 3:
+        notify_msg = build_symptom_notification(
+            user_id, pain, wound, fever, mobility, risk_level, risk_score
+        )
+        run_deferred(send_nurse_alert, notify_msg, 'symptom', priority=PRIORITY_HIGH)
+    
+    return result['message']
+
+
+def assess_symptoms(pain, wound, fever, mobility):
+    """
+    Score a symptom report (no saving or notifications)
+    
+    Returns:
+        dict: message, risk_level, risk_score
+    """
     risk_score = 0
     risk_details = []
     
@@ -45,31 +74,34 @@ def calculate_symptom_risk(user_id, pain, wound, fever, mobility):
     elif p_val > 0:
         risk_details.append(f"🟢 ความปวดเล็กน้อย ({p_val}/10)")
     
+    # Keyword categories per answer (see SYMPTOM_KEYWORDS)
+    classifier = get_symptom_classifier()
+    wound_found = classifier.classify(wound)
+    fever_found = classifier.classify(fever)
+    mobility_found = classifier.classify(mobility)
+    
     # Wound Status Analysis
-    wound_text = str(wound or "").lower()
-    if any(x in wound_text for x in ["หนอง", "มีกลิ่น", "แฉะ", "pus", "discharge"]):
+    if 'wound_infected' in wound_found:
         risk_score += 3
         risk_details.append("🔴 แผลมีหนองหรือมีกลิ่น - ต้องพบแพทย์ทันที!")
-    elif any(x in wound_text for x in ["บวมแดง", "อักเสบ", "swelling", "red", "inflamed"]):
+    elif 'wound_inflamed' in wound_found:
         risk_score += 2
         risk_details.append("🟡 แผลบวมแดงอักเสบ")
-    elif any(x in wound_text for x in ["ปกติ", "ดี", "แห้ง", "normal", "dry", "good"]):
+    elif 'wound_normal' in wound_found:
         risk_details.append("🟢 สภาพแผลปกติ")
     
     # Fever Check
-    fever_text = str(fever or "").lower()
-    if any(x in fever_text for x in ["มี", "ตัวร้อน", "fever", "hot", "ไข้"]):
+    if 'fever' in fever_found:
         risk_score += 2
         risk_details.append("🔴 มีไข้ - อาจมีการติดเชื้อ")
     else:
         risk_details.append("🟢 ไม่มีไข้")
     
     # Mobility Status
-    mobility_text = str(mobility or "").lower()
-    if any(x in mobility_text for x in ["ไม่ได้", "ติดเตียง", "ไม่เดิน", "cannot", "bedridden"]):
+    if 'immobile' in mobility_found:
         risk_score += 1
         risk_details.append("🟡 เคลื่อนไหวลำบาก")
-    elif any(x in mobility_text for x in ["เดินได้", "ปกติ", "normal", "can walk"]):
+    elif 'mobile' in mobility_found:
         risk_details.append("🟢 เคลื่อนไหวได้ปกติ")
     
     # Risk Level Classification
@@ -109,17 +141,7 @@ def calculate_symptom_risk(user_id, pain, wound, fever, mobility):
     message += f"(คะแนนรวม: {risk_score})\n\n"
     message += f"💡 คำแนะนำ:\n{action}"
     
-    # Save to sheet
-    save_symptom_data(user_id, pain, wound, fever, mobility, risk_level, risk_score)
-    
-    # Send notification if high risk
-    if risk_score >= 3:
-        notify_msg = build_symptom_notification(
-            user_id, pain, wound, fever, mobility, risk_level, risk_score
-        )
-        send_line_push(notify_msg)
-    
-    return message
+    return {'message': message, 'risk_level': risk_level, 'risk_score': risk_score}
 
 
 def normalize_diseases(disease_param):
@@ -193,9 +215,37 @@ def calculate_personal_risk(user_id, age, weight, height, disease):
     """
     Calculate personal health risk based on demographics and conditions
     
+    Saving the profile and alerting the nurses run as deferred tasks.
+    
     Returns:
         str: Formatted message with risk assessment
     """
+    result = assess_personal_risk(age, weight, height, disease)
+    risk_level, risk_score = result['risk_level'], result['risk_score']
+    
+    # Save to sheet
+    run_deferred(save_profile_data, user_id, result['age'], result['weight'], result['height'],
+                 result['bmi'], result['diseases'], risk_level, risk_score)
+    
+    # Send notification if high risk
+    if risk_score >= 4:
+        diseases_str = ", ".join(result['diseases']) if result['diseases'] else "ไม่มีโรคประจำตัว"
+        notify_msg = build_risk_notification(
+            user_id, result['age'], result['bmi'], diseases_str, risk_level, risk_score
+        )
+        run_deferred(send_nurse_alert, notify_msg, 'risk')
+    
+    return result['message']
+
+
+def assess_personal_risk(age, weight, height, disease):
+    """
+    Score a personal risk profile (no saving or notifications)
+    
+    Returns:
+        dict: message, risk_level, risk_score and the parsed age, weight,
+              height, bmi and diseases
+    """
     risk_score = 0
     risk_factors = []
     bmi = 0.0
@@ -331,15 +381,13 @@ def calculate_personal_risk(user_id, age, weight, height, disease):
     for adv in advice:
         message += f"  {adv}\n"
     
-    # Save to sheet
-    save_profile_data(user_id, age_val, weight_val, height_cm, bmi, 
-                      disease_normalized, risk_level, risk_score)
-    
-    # Send notification if high risk
-    if risk_score >= 4:
-        notify_msg = build_risk_notification(
-            user_id, age_val, bmi, diseases_str, risk_level, risk_score
-        )
-        send_line_push(notify_msg)
-    
-    return message
+    return {
+        'message': message,
+        'risk_level': risk_level,
+        'risk_score': risk_score,
+        'age': age_val,
+        'weight': weight_val,
+        'height': height_cm,
+        'bmi': bmi,
+        'diseases': disease_normalized
+    }
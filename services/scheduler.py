@@ -6,55 +6,235 @@ Manage scheduled tasks using APScheduler
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.cron import CronTrigger
-from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.events import (
+    EVENT_JOB_SUBMITTED,
+    EVENT_JOB_EXECUTED,
+    EVENT_JOB_ERROR,
+    EVENT_JOB_MISSED
+)
 from datetime import datetime, timedelta
 import atexit
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, run as the only scheduler
+    fcntl = None
 
 from config import (
     LOCAL_TZ,
     SCHEDULER_TIMEZONE,
+    SCHEDULER_JOBSTORE,
+    SCHEDULER_DB_PATH,
+    SCHEDULER_MISFIRE_GRACE_SECONDS,
+    REMINDER_RECONCILE_MINUTES,
+    SCHEDULER_LOCK_PATH,
+    SCHEDULER_LEADER_POLL_SECONDS,
+    SHEET_REMINDER_SCHEDULES,
     get_logger
 )
 from services.reminder import (
     send_reminder,
     check_and_alert_no_response
 )
+from services.jobstore import SQLiteJobStore
+from database.backend import get_backend
 from database.reminders import get_scheduled_reminders
+from utils.metrics import counter, histogram
 
 logger = get_logger(__name__)
 
-# Initialize scheduler
+# Jobs that are not patient reminders
+SYSTEM_JOB_IDS = ('check_no_response', 'reconcile_reminders')
+
+# Initialize scheduler (jobs persist across restarts)
+jobstore = SQLiteJobStore(SCHEDULER_DB_PATH)
 jobstores = {
-    'default': MemoryJobStore()
+    SCHEDULER_JOBSTORE: jobstore
 }
 
 scheduler = BackgroundScheduler(
     jobstores=jobstores,
+    job_defaults={
+        'misfire_grace_time': SCHEDULER_MISFIRE_GRACE_SECONDS,
+        'coalesce': True
+    },
     timezone=SCHEDULER_TIMEZONE
 )
 
+JOB_RUNS = counter('kwannurse_scheduler_jobs_total', "Scheduler job runs by outcome", ('job', 'outcome'))
+JOB_LAG = histogram(
+    'kwannurse_scheduler_job_lag_seconds', "Delay between a job's scheduled time and its start",
+    ('job',), buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 3600)
+)
+
+_JOB_OUTCOMES = {
+    EVENT_JOB_EXECUTED: 'executed',
+    EVENT_JOB_ERROR: 'error',
+    EVENT_JOB_MISSED: 'missed'
+}
+
+
+def _job_label(job_id):
+    # Reminder jobs have one id per patient; keep the label set small
+    return job_id if job_id in SYSTEM_JOB_IDS else 'reminder'
+
+
+def _on_job_event(event):
+    """Scheduler listener: job lag on submit, outcome counts after"""
+    try:
+        job = _job_label(event.job_id)
+        if event.code == EVENT_JOB_SUBMITTED:
+            if event.scheduled_run_times:
+                lag = datetime.now(tz=LOCAL_TZ) - event.scheduled_run_times[-1]
+                JOB_LAG.observe(max(0.0, lag.total_seconds()), job=job)
+        else:
+            JOB_RUNS.inc(job=job, outcome=_JOB_OUTCOMES[event.code])
+    except Exception as e:
+        logger.exception(f"Error recording scheduler metrics: {e}")
+
+
+scheduler.add_listener(
+    _on_job_event,
+    EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED
+)
+
+
+def _on_job_submitted(event):
+    """
+    Scheduler listener: remember reminder jobs that have started
+
+    A fired job leaves the job store, but its ReminderSchedules row stays
+    'scheduled' until the message is delivered; reconcile_reminders must
+    not add it again meanwhile.
+    """
+    if event.job_id in SYSTEM_JOB_IDS:
+        return
+    try:
+        jobstore.mark_fired(event.job_id, time.time())
+    except Exception as e:
+        logger.exception(f"Error recording fired job {event.job_id}: {e}")
+
+
+scheduler.add_listener(_on_job_submitted, EVENT_JOB_SUBMITTED)
+
+# Leader election state (see init_scheduler)
+_leader_lock_file = None
+_leader_thread = None
+
+
+def _try_acquire_leadership():
+    """
+    Try to take the scheduler lock (non-blocking)
+    
+    The OS drops the lock when the holding process dies, so a waiting
+    worker takes over on its next poll.
+    
+    Returns:
+        bool: True if this process is the leader
+    """
+    global _leader_lock_file
+    
+    if _leader_lock_file is not None:
+        return True
+    if fcntl is None:
+        # No flock on this platform: assume a single process
+        _leader_lock_file = True
+        return True
+    
+    lock_file = open(SCHEDULER_LOCK_PATH, 'a+')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(f"{os.getpid()}\n")
+    lock_file.flush()
+    _leader_lock_file = lock_file
+    return True
+
+
+def is_leader():
+    """True if this process runs the scheduled jobs"""
+    return _leader_lock_file is not None
+
+
+def _become_leader():
+    """Register system jobs, reconcile reminders and start running jobs"""
+    logger.info(f"✅ Scheduler leader elected (pid {os.getpid()})")
+    
+    # Schedule recurring job to check no-response reminders
+    scheduler.add_job(
+        func=check_and_alert_no_response,
+        trigger=CronTrigger(hour=10, minute=0, timezone=LOCAL_TZ),  # Daily at 10 AM
+        id='check_no_response',
+        name='Check for no-response reminders',
+        replace_existing=True
+    )
+    logger.info("✅ Scheduled daily no-response check at 10:00")
+    
+    # Pick up reminder rows added since the last run
+    scheduler.add_job(
+        func=reconcile_reminders,
+        trigger=IntervalTrigger(minutes=REMINDER_RECONCILE_MINUTES, timezone=LOCAL_TZ),
+        id='reconcile_reminders',
+        name='Reconcile reminder jobs with ReminderSchedules',
+        replace_existing=True
+    )
+    
+    # Jobs from the last run are already in the job store, but the sheet may
+    # have been edited while no leader was running: reload it and compare
+    # every row (the stored version predates those edits)
+    synced = get_backend().refresh(SHEET_REMINDER_SCHEDULES)
+    reconcile_reminders(force=True, save_version=synced)
+    scheduler.resume()
+
+
+def _leader_loop():
+    """
+    Followers retry the lock; the leader wakes its scheduler so it sees
+    jobs other workers added to the shared job store
+    """
+    while True:
+        time.sleep(SCHEDULER_LEADER_POLL_SECONDS)
+        try:
+            if is_leader():
+                scheduler.wakeup()
+            elif _try_acquire_leadership():
+                _become_leader()
+        except Exception as e:
+            logger.exception(f"Error in scheduler leader election: {e}")
+
 
 def init_scheduler():
     """
     Initialize and start the scheduler
+    
+    Every worker starts a scheduler on the shared job store (so any
+    worker can add or cancel jobs), but only the elected leader runs
+    them. The others stay paused and take over if the leader exits.
     """
+    global _leader_thread
+    
     try:
         if not scheduler.running:
-            scheduler.start()
+            # Paused until this worker is leader and jobs are reconciled
+            scheduler.start(paused=True)
             logger.info("✅ Scheduler started successfully")
             
-            # Schedule recurring job to check no-response reminders
-            scheduler.add_job(
-                func=check_and_alert_no_response,
-                trigger=CronTrigger(hour=10, minute=0, timezone=LOCAL_TZ),  # Daily at 10 AM
-                id='check_no_response',
-                name='Check for no-response reminders',
-                replace_existing=True
-            )
-            logger.info("✅ Scheduled daily no-response check at 10:00")
+            if _try_acquire_leadership():
+                _become_leader()
+            else:
+                logger.info(f"Scheduler standing by as follower (pid {os.getpid()})")
             
-            # Load and schedule pending reminders from database
-            load_pending_reminders()
+            _leader_thread = threading.Thread(target=_leader_loop, name="scheduler-leader", daemon=True)
+            _leader_thread.start()
             
             # Register shutdown handler
             atexit.register(shutdown_scheduler)
@@ -70,33 +250,59 @@ def shutdown_scheduler():
     """
     Gracefully shutdown the scheduler
     """
+    global _leader_lock_file
+    
     try:
         if scheduler.running:
             scheduler.shutdown(wait=False)
             logger.info("Scheduler shutdown successfully")
+        
+        # Hand leadership to another worker right away
+        if _leader_lock_file not in (None, True):
+            _leader_lock_file.close()
+        _leader_lock_file = None
     except Exception as e:
         logger.exception(f"Error shutting down scheduler: {e}")
 
 
-def load_pending_reminders():
+def _reminder_job_id(user_id, reminder_type, scheduled_date):
+    return f"{user_id}_{reminder_type}_{scheduled_date.strftime('%Y%m%d%H%M')}"
+
+
+def reconcile_reminders(force=False, save_version=True):
     """
-    Load pending reminders from database and schedule them
+    Bring the stored reminder jobs in line with ReminderSchedules
+    
+    Adds jobs for 'scheduled' rows that have none and removes jobs whose
+    row is gone or no longer 'scheduled'. Jobs that are already stored are
+    left alone, as are rows whose job has already fired (the row stays
+    'scheduled' until LINE confirms delivery). Nothing is read at all if
+    the sheet has not changed since the last reconcile.
+    
+    Args:
+        force: Reconcile even if the sheet looks unchanged
+        save_version: Remember the sheet version, so the next reconcile is
+                      skipped if nothing changes (False if the rows read
+                      may be stale, e.g. the sheet could not be reloaded)
+        
+    Returns:
+        dict: Counts of added, removed and kept jobs (None if skipped)
     """
     try:
-        logger.info("Loading pending reminders from database")
-        
-        scheduled_reminders = get_scheduled_reminders()
+        version = str(get_backend().version(SHEET_REMINDER_SCHEDULES))
+        if not force and jobstore.get_meta('reminders_version') == version:
+            logger.info("Reminder schedules unchanged, nothing to reconcile")
+            return None
         
-        if not scheduled_reminders:
-            logger.info("No pending reminders to schedule")
-            return
+        logger.info("Reconciling reminder jobs with database")
         
-        loaded_count = 0
+        wanted = {}
         skipped_count = 0
         
-        now = datetime.now(tz=LOCAL_TZ)
+        # Reminders missed within the grace period (e.g. during a restart) still run
+        cutoff = datetime.now(tz=LOCAL_TZ) - timedelta(seconds=SCHEDULER_MISFIRE_GRACE_SECONDS)
         
-        for reminder in scheduled_reminders:
+        for reminder in get_scheduled_reminders():
             user_id = reminder.get('User_ID')
             reminder_type = reminder.get('Reminder_Type')
             scheduled_date_str = reminder.get('Scheduled_Date')
@@ -110,16 +316,30 @@ def load_pending_reminders():
                 # Parse scheduled date
                 scheduled_date = datetime.strptime(scheduled_date_str, "%Y-%m-%d %H:%M:%S")
                 scheduled_date = scheduled_date.replace(tzinfo=LOCAL_TZ)
-                
-                # Skip if in the past
-                if scheduled_date < now:
-                    logger.info(f"Skipping past reminder: {reminder_type} for {user_id} scheduled at {scheduled_date}")
-                    skipped_count += 1
-                    continue
-                
-                # Schedule the job
-                job_id = f"{user_id}_{reminder_type}_{scheduled_date.strftime('%Y%m%d%H%M')}"
-                
+            except ValueError as e:
+                logger.warning(f"Bad scheduled date in {reminder}: {e}")
+                skipped_count += 1
+                continue
+            
+            # Skip if in the past
+            if scheduled_date < cutoff:
+                skipped_count += 1
+                continue
+            
+            wanted[_reminder_job_id(user_id, reminder_type, scheduled_date)] = (
+                user_id, reminder_type, scheduled_date
+            )
+        
+        stored = {job_id for job_id in jobstore.get_job_ids() if job_id not in SYSTEM_JOB_IDS}
+        
+        # A job that fired before the cutoff was scheduled before it too
+        jobstore.prune_fired(cutoff.timestamp())
+        fired = jobstore.get_fired_ids() & wanted.keys()
+        
+        added_count = 0
+        for job_id in wanted.keys() - stored - fired:
+            user_id, reminder_type, scheduled_date = wanted[job_id]
+            try:
                 scheduler.add_job(
                     func=send_reminder,
                     trigger=DateTrigger(run_date=scheduled_date, timezone=LOCAL_TZ),
@@ -128,18 +348,46 @@ def load_pending_reminders():
                     name=f"Reminder {reminder_type} for {user_id}",
                     replace_existing=True
                 )
-                
-                loaded_count += 1
+                added_count += 1
                 logger.info(f"Scheduled {reminder_type} for {user_id} at {scheduled_date}")
-                
             except Exception as e:
-                logger.exception(f"Error scheduling reminder {reminder}: {e}")
+                logger.exception(f"Error scheduling reminder {job_id}: {e}")
                 skipped_count += 1
         
-        logger.info(f"Loaded {loaded_count} reminders, skipped {skipped_count}")
+        removed_count = 0
+        for job_id in stored - wanted.keys():
+            try:
+                scheduler.remove_job(job_id)
+                removed_count += 1
+            except Exception:
+                pass  # Already ran or removed
+        
+        if save_version:
+            jobstore.set_meta('reminders_version', version)
+        
+        result = {
+            'added': added_count,
+            'removed': removed_count,
+            'kept': len(stored & wanted.keys()),
+            'skipped': skipped_count + len(fired - stored)
+        }
+        logger.info(
+            f"Reconciled reminders: {added_count} added, {removed_count} removed, "
+            f"{result['kept']} unchanged, {skipped_count} skipped"
+        )
+        return result
         
     except Exception as e:
-        logger.exception(f"Error loading pending reminders: {e}")
+        logger.exception(f"Error reconciling reminders: {e}")
+        return None
+
+
+def load_pending_reminders():
+    """
+    Load pending reminders from database and schedule them
+    (jobs that are already stored are kept)
+    """
+    reconcile_reminders(force=True)
 
 
 def schedule_reminder_job(user_id, reminder_type, scheduled_date):
@@ -166,7 +414,7 @@ def schedule_reminder_job(user_id, reminder_type, scheduled_date):
             return False
         
         # Create unique job ID
-        job_id = f"{user_id}_{reminder_type}_{scheduled_date.strftime('%Y%m%d%H%M')}"
+        job_id = _reminder_job_id(user_id, reminder_type, scheduled_date)
         
         # Add job to scheduler
         scheduler.add_job(
@@ -259,17 +507,16 @@ def reschedule_all_reminders():
         logger.info("Rescheduling all reminders")
         
         # Clear existing reminder jobs (keep system jobs like check_no_response)
-        jobs = scheduler.get_jobs()
-        for job in jobs:
-            if job.id != 'check_no_response':
-                scheduler.remove_job(job.id)
+        for job_id in jobstore.get_job_ids():
+            if job_id not in SYSTEM_JOB_IDS:
+                scheduler.remove_job(job_id)
         
         # Reload from database
         load_pending_reminders()
         
         # Count current jobs
         jobs_after = scheduler.get_jobs()
-        reminder_jobs = [j for j in jobs_after if j.id != 'check_no_response']
+        reminder_jobs = [j for j in jobs_after if j.id not in SYSTEM_JOB_IDS]
         
         logger.info(f"Rescheduled {len(reminder_jobs)} reminders")
         return len(reminder_jobs)
@@ -291,9 +538,10 @@ def get_scheduler_status():
         
         status = {
             'running': scheduler.running,
+            'leader': is_leader(),
             'total_jobs': len(jobs),
-            'reminder_jobs': len([j for j in jobs if j.id != 'check_no_response']),
-            'system_jobs': len([j for j in jobs if j.id == 'check_no_response']),
+            'reminder_jobs': len([j for j in jobs if j.id not in SYSTEM_JOB_IDS]),
+            'system_jobs': len([j for j in jobs if j.id in SYSTEM_JOB_IDS]),
             'timezone': str(LOCAL_TZ),
             'current_time': datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
         }
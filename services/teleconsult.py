@@ -8,19 +8,20 @@ from config import (
     LOCAL_TZ,
     OFFICE_HOURS,
     ISSUE_CATEGORIES,
-    MAX_QUEUE_SIZE,
-    NURSE_GROUP_ID,
     get_logger
 )
 from database.teleconsult import (
     create_session,
-    add_to_queue,
+    admit_to_queue,
     update_session_status,
     remove_from_queue,
     get_queue_status,
+    get_queue_position,
     get_user_active_session
 )
-from services.notification import send_line_push
+from services.alert_digest import send_nurse_alert
+from services.dispatcher import PRIORITY_EMERGENCY, PRIORITY_HIGH
+from utils.tracing import traced
 
 logger = get_logger(__name__)
 
@@ -106,6 +107,7 @@ def parse_category_choice(choice_text):
         return None
 
 
+@traced
 def start_teleconsult(user_id, issue_type, description=""):
     """
     Start a teleconsult session
@@ -124,17 +126,11 @@ def start_teleconsult(user_id, issue_type, description=""):
         # Check if user already has active session
         existing_session = get_user_active_session(user_id)
         if existing_session:
-            queue_pos = existing_session.get('Queue_Position', '?')
-            return {
-                'success': False,
-                'message': (
-                    f"⚠️ คุณมีคำขอปรึกษาที่กำลังดำเนินการอยู่แล้วค่ะ\n\n"
-                    f"📊 ตำแหน่งในคิว: {queue_pos}\n"
-                    f"📋 ประเภท: {existing_session.get('Issue_Type')}\n\n"
-                    f"กรุณารอพยาบาลติดต่อกลับนะคะ\n"
-                    f"หรือพิมพ์ 'ยกเลิก' เพื่อยกเลิกคำขอเดิม"
-                )
-            }
+            queue_pos = (
+                get_queue_position(existing_session.get('Session_ID'))
+                or existing_session.get('Queue_Position', '?')
+            )
+            return already_active_response(queue_pos, existing_session.get('Issue_Type'))
         
         # Get category info
         category_info = ISSUE_CATEGORIES.get(issue_type, ISSUE_CATEGORIES['other'])
@@ -151,9 +147,19 @@ def start_teleconsult(user_id, issue_type, description=""):
         if not is_office_hours():
             return handle_after_hours(user_id, issue_type, description)
         
-        # Check queue size
-        queue_status = get_queue_status()
-        if queue_status['total'] >= MAX_QUEUE_SIZE:
+        # Check queue size, create session and enqueue in one locked step
+        admission = admit_to_queue(user_id, issue_type, priority, description)
+        if not admission:
+            return {
+                'success': False,
+                'message': "เกิดข้อผิดพลาด กรุณาลองใหม่อีกครั้ง"
+            }
+        
+        if not admission['admitted']:
+            if admission['reason'] == 'already_queued':
+                waiting = admission['queue']
+                return already_active_response(admission['position'], waiting.get('Issue_Type'))
+            
             return {
                 'success': False,
                 'message': (
@@ -165,27 +171,8 @@ def start_teleconsult(user_id, issue_type, description=""):
                 )
             }
         
-        # Create session
-        session = create_session(user_id, issue_type, priority, description)
-        if not session:
-            return {
-                'success': False,
-                'message': "เกิดข้อผิดพลาด กรุณาลองใหม่อีกครั้ง"
-            }
-        
-        # Add to queue
-        queue_info = add_to_queue(
-            session['session_id'],
-            user_id,
-            issue_type,
-            priority
-        )
-        
-        if not queue_info:
-            return {
-                'success': False,
-                'message': "เกิดข้อผิดพลาดในการเข้าคิว กรุณาลองใหม่"
-            }
+        session = admission['session']
+        queue_info = admission['queue']
         
         # Alert nurse
         alert_nurse_new_request(session, queue_info)
@@ -217,6 +204,30 @@ def start_teleconsult(user_id, issue_type, description=""):
         }
 
 
+def already_active_response(queue_pos, issue_type):
+    """
+    Response for a user who already has a consultation in progress
+    
+    Args:
+        queue_pos: Current queue position
+        issue_type: Issue category of the existing request
+        
+    Returns:
+        dict: Response
+    """
+    return {
+        'success': False,
+        'message': (
+            f"⚠️ คุณมีคำขอปรึกษาที่กำลังดำเนินการอยู่แล้วค่ะ\n\n"
+            f"📊 ตำแหน่งในคิว: {queue_pos}\n"
+            f"📋 ประเภท: {issue_type}\n\n"
+            f"กรุณารอพยาบาลติดต่อกลับนะคะ\n"
+            f"หรือพิมพ์ 'ยกเลิก' เพื่อยกเลิกคำขอเดิม"
+        )
+    }
+
+
+@traced
 def handle_emergency(user_id, description):
     """
     Handle emergency consultation request
@@ -253,7 +264,7 @@ def handle_emergency(user_id, description):
             f"Session ID: {session['session_id']}"
         )
         
-        send_line_push(NURSE_GROUP_ID, alert_message)
+        send_nurse_alert(alert_message, 'teleconsult', priority=PRIORITY_EMERGENCY)
         
         message = (
             "🚨 รับเรื่องฉุกเฉินแล้วค่ะ\n\n"
@@ -278,6 +289,7 @@ def handle_emergency(user_id, description):
         }
 
 
+@traced
 def handle_after_hours(user_id, issue_type, description):
     """
     Handle request made outside office hours
@@ -319,6 +331,7 @@ def handle_after_hours(user_id, issue_type, description):
         }
 
 
+@traced
 def cancel_consultation(user_id):
     """
     Cancel user's active consultation
@@ -365,6 +378,7 @@ def cancel_consultation(user_id):
         }
 
 
+@traced
 def alert_nurse_new_request(session, queue_info):
     """
     Send alert to nurse about new consultation request
@@ -393,7 +407,7 @@ def alert_nurse_new_request(session, queue_info):
             f"Session ID: {session['session_id']}"
         )
         
-        send_line_push(NURSE_GROUP_ID, message)
+        send_nurse_alert(message, 'teleconsult', priority=PRIORITY_HIGH)
         
         logger.info(f"Sent nurse alert for session {session['session_id']}")
         
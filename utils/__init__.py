@@ -7,11 +7,17 @@ from .parsers import (
     normalize_phone_number,
     is_valid_thai_mobile
 )
+from .ratelimit import call_api, get_limiter, get_rate_limit_metrics
+from .cache import TTLCache
 
 __all__ = [
     'parse_date_iso',
     'parse_time_hhmm',
     'resolve_time_from_params',
     'normalize_phone_number',
-    'is_valid_thai_mobile'
+    'is_valid_thai_mobile',
+    'call_api',
+    'get_limiter',
+    'get_rate_limit_metrics',
+    'TTLCache'
 ]
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Keyword Matching Module
+Classify free text by keyword category in a single pass
+
+KeywordClassifier compiles every keyword of every category into one
+Aho-Corasick automaton, so classify() reads the text once and finds all
+matching categories, however many keywords there are. Matching is by
+lowercase substring, like `keyword in text.lower()`.
+"""
+import json
+import threading
+from collections import deque
+from config import SYMPTOM_KEYWORDS, SYMPTOM_KEYWORDS_FILE, get_logger
+
+logger = get_logger(__name__)
+
+
+class KeywordClassifier:
+    """
+    Aho-Corasick automaton over {category: [keywords]}
+
+    Usage:
+        classifier = KeywordClassifier({'fever': ["ไข้", "fever"], 'pus': ["หนอง"]})
+        classifier.classify("มีไข้ แผลมีหนอง")  # {'fever', 'pus'}
+    """
+
+    def __init__(self, categories):
+        self.categories = {name: [k.lower() for k in keywords if k] for name, keywords in categories.items()}
+
+        goto = [{}]  # state -> {char: next state}
+        outputs = [set()]  # state -> categories whose keyword ends here
+        for name, keywords in self.categories.items():
+            for keyword in keywords:
+                state = 0
+                for char in keyword:
+                    nxt = goto[state].get(char)
+                    if nxt is None:
+                        nxt = len(goto)
+                        goto.append({})
+                        outputs.append(set())
+                        goto[state][char] = nxt
+                    state = nxt
+                outputs[state].add(name)
+
+        # Breadth first, so a state's fallback (failure link) is finished
+        # before it; each state's moves include its fallback's, so scanning
+        # never has to follow failure links
+        fail = [0] * len(goto)
+        moves = [dict(goto[0])] + [None] * (len(goto) - 1)
+        pending = deque(goto[0].values())
+        while pending:
+            state = pending.popleft()
+            if moves[state] is None:
+                moves[state] = dict(moves[fail[state]], **goto[state])
+            for char, nxt in goto[state].items():
+                pending.append(nxt)
+                fail[nxt] = moves[fail[state]].get(char, 0) if state else 0
+                outputs[nxt] |= outputs[fail[nxt]]
+
+        self._moves = moves
+        self._outputs = [frozenset(names) for names in outputs]
+
+    def classify(self, text):
+        """
+        Categories with at least one keyword in the text
+
+        Args:
+            text: Free text (None and non-strings are converted)
+
+        Returns:
+            set: Category names
+        """
+        moves, outputs = self._moves, self._outputs
+        found = set()
+        state = 0
+        for char in str(text or "").lower():
+            state = moves[state].get(char, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return found
+
+
+def load_symptom_keywords(path=SYMPTOM_KEYWORDS_FILE):
+    """
+    SYMPTOM_KEYWORDS, with categories from the JSON file at `path` replacing them
+
+    Returns:
+        dict: {category: [keywords]}
+    """
+    keywords = {name: list(words) for name, words in SYMPTOM_KEYWORDS.items()}
+    if not path:
+        return keywords
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            overrides = json.load(f)
+        for name, words in overrides.items():
+            if not isinstance(words, list):
+                raise ValueError(f"{name}: expected a list of keywords")
+            keywords[name] = [str(word) for word in words]
+        logger.info("Loaded symptom keywords from %s (%s)", path, ", ".join(sorted(overrides)))
+    except Exception as e:
+        logger.exception(f"Error loading symptom keywords from {path}, using defaults: {e}")
+        keywords = {name: list(words) for name, words in SYMPTOM_KEYWORDS.items()}
+    return keywords
+
+
+_symptom_classifier = None
+_symptom_classifier_lock = threading.Lock()
+
+
+def get_symptom_classifier():
+    """
+    Classifier for symptom text (singleton pattern, compiled on first use)
+
+    Returns:
+        KeywordClassifier over load_symptom_keywords()
+    """
+    global _symptom_classifier
+
+    with _symptom_classifier_lock:
+        if _symptom_classifier is None:
+            _symptom_classifier = KeywordClassifier(load_symptom_keywords())
+        return _symptom_classifier
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics Module
+Process-local counters, gauges and histograms in Prometheus text format
+
+A small stand-in for prometheus_client (not a dependency): metrics are
+created once at import time with counter()/histogram()/gauge() and
+rendered by render() for the /metrics endpoint. Each gunicorn worker
+keeps and serves its own values.
+"""
+import threading
+from config import get_logger
+
+logger = get_logger(__name__)
+
+# Seconds; covers fast cache hits up to the Dialogflow webhook timeout and slow Sheets calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Base class: a named family of values keyed by label values"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """[(suffix, label values, extra labels, value), ...]"""
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down
+
+    Either set() it, or pass `collect`: a function called at render time
+    returning a number (no labels) or {label values tuple: number}.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.collect is None:
+            return super().samples()
+        try:
+            values = self.collect()
+        except Exception as e:
+            logger.exception(f"Error collecting {self.name}: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [('', tuple(str(v) for v in key), (), value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            snapshot = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        samples = []
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), count))
+        return samples
+
+
+def _register(cls, name, *args, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} already registered as {metric.kind}")
+        return metric
+
+
+def counter(name, documentation, labelnames=()):
+    """Get or create a Counter"""
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=(), collect=None):
+    """Get or create a Gauge (optionally computed at render time)"""
+    return _register(Gauge, name, documentation, labelnames, collect=collect)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Get or create a Histogram"""
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def render():
+    """
+    All metrics in Prometheus text exposition format (version 0.0.4)
+
+    Returns:
+        str
+    """
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    return "\n".join(metric.render() for metric in metrics) + "\n"
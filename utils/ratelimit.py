@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Rate Limit Module
+Token bucket per external API, with retries and exponential backoff
+
+Every Google Sheets and LINE API call goes through call_api(), which
+waits for a token from that API's bucket before calling and retries
+throttled (429) or transient (5xx, connection) failures. A Retry-After
+from the server pauses the whole bucket, so other threads back off too.
+The quotas are shared by every gunicorn worker, and each process's
+buckets get 1/WEB_CONCURRENCY of them: a fixed split rather than a bucket
+shared through SQLite, which would cost a write per API call.
+Calls that must not run twice (appends) pass idempotent=False and are
+only retried when the request certainly did not take effect. Inside an
+api_deadline() block (a webhook request), waits that would run past the
+deadline are skipped and the call fails instead.
+"""
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from config import (
+    SHEETS_REQUESTS_PER_MINUTE,
+    SHEETS_BURST,
+    LINE_REQUESTS_PER_SECOND,
+    LINE_BURST,
+    WEB_CONCURRENCY,
+    API_RETRY_ATTEMPTS,
+    API_RETRY_BASE_SECONDS,
+    API_RETRY_MAX_SECONDS,
+    get_logger
+)
+from utils.metrics import counter, histogram
+from utils.tracing import span
+
+logger = get_logger(__name__)
+
+# HTTP statuses worth another try
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+API_CALLS = counter(
+    'kwannurse_api_calls_total', "External API call attempts (retries included)",
+    ('api', 'operation', 'worksheet', 'outcome')
+)
+API_LATENCY = histogram(
+    'kwannurse_api_call_duration_seconds', "External API call attempt latency",
+    ('api', 'operation', 'worksheet')
+)
+
+# time.monotonic() by which API calls in this context stop waiting (see api_deadline)
+_deadline = contextvars.ContextVar('api_deadline', default=None)
+
+
+class ApiDeadlineExceeded(RuntimeError):
+    """No token could be had before the caller's deadline"""
+
+
+# API name -> (tokens per second, bucket size), this process's share
+API_LIMITS = {
+    'sheets': (SHEETS_REQUESTS_PER_MINUTE / 60.0 / WEB_CONCURRENCY, SHEETS_BURST / WEB_CONCURRENCY),
+    'line': (LINE_REQUESTS_PER_SECOND / WEB_CONCURRENCY, LINE_BURST / WEB_CONCURRENCY)
+}
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, at most `capacity` saved up
+
+    pause() empties the bucket and holds it shut for a while (Retry-After).
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = max(1, int(capacity))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self._updated)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = max(self._updated, now)
+
+    def acquire(self, timeout=None):
+        """
+        Take one token, sleeping until one is available
+
+        Args:
+            timeout: Give up instead of sleeping longer than this in total
+
+        Returns:
+            float: Seconds spent waiting, or None if timed out
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+                    delay = (1 - self._tokens) / self.rate
+            if timeout is not None and waited + delay > timeout:
+                return None
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds`"""
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._paused_until:
+                self._paused_until = until
+                self._tokens = 0.0
+                self._updated = until
+
+
+class ApiLimiter:
+    """Token bucket plus retry policy and counters for one API"""
+
+    def __init__(self, name, rate, capacity, attempts=API_RETRY_ATTEMPTS,
+                 base_delay=API_RETRY_BASE_SECONDS, max_delay=API_RETRY_MAX_SECONDS):
+        self.name = name
+        self.bucket = TokenBucket(rate, capacity)
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._stats = {
+            'calls': 0, 'retries': 0, 'throttled': 0, 'failures': 0,
+            'wait_seconds': 0.0, 'backoff_seconds': 0.0
+        }
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Seconds to wait before retry number `attempt` (0-based)
+
+        Full jitter on an exponential schedule; a server Retry-After is a floor.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, func, *args, idempotent=True, **kwargs):
+        """
+        Call func(*args, **kwargs) within the rate limit, retrying transient failures
+
+        A returned response (anything with a status_code) in RETRY_STATUSES
+        is retried like a raised error. When retries run out the last
+        response is returned, or the last error re-raised. With
+        idempotent=False only a 429 or a connect timeout is retried; after
+        a 5xx or a lost reply the call may already have happened.
+        """
+        labels = _call_labels(self.name, func)
+        with span(f"{self.name}.{labels['operation']}", worksheet=labels['worksheet']) as current:
+            return self._call(labels, current, func, args, kwargs, idempotent)
+
+    def _call(self, labels, current, func, args, kwargs, idempotent=True):
+        result, error = None, None
+        for attempt in range(self.attempts + 1):
+            waited = self.bucket.acquire(_remaining())
+            if waited is None:
+                logger.warning("%s API: no token before the request deadline, giving up", self.name)
+                if attempt == 0:
+                    self._count('failures')
+                    raise ApiDeadlineExceeded(f"{self.name} API rate limited past the request deadline")
+                break
+            self._count('wait_seconds', waited)
+            self._count('calls')
+
+            result, error = None, None
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                error = e
+            API_LATENCY.observe(time.perf_counter() - started, **labels)
+
+            retry, status, retry_after = _classify(result, error)
+            if retry and not idempotent and status != 429 and not isinstance(error, requests.ConnectTimeout):
+                retry = False
+            API_CALLS.inc(outcome=_outcome(error, status), **labels)
+            if current is not None and attempt:
+                current.attrs['attempts'] = attempt + 1
+            if not retry:
+                if error is not None:
+                    raise error
+                return result
+
+            if status == 429:
+                self._count('throttled')
+            if retry_after is not None:
+                self.bucket.pause(retry_after)
+
+            if attempt == self.attempts:
+                break
+
+            delay = self.backoff(attempt, retry_after)
+            remaining = _remaining()
+            if remaining is not None and delay > remaining:
+                logger.warning("%s API %s, not retrying: request deadline in %.1fs",
+                               self.name, status or type(error).__name__, remaining)
+                break
+            logger.warning("%s API %s, retrying in %.1fs (attempt %d/%d)",
+                           self.name, status or type(error).__name__, delay,
+                           attempt + 1, self.attempts)
+            self._count('retries')
+            self._count('backoff_seconds', delay)
+            time.sleep(delay)
+
+        self._count('failures')
+        logger.error("%s API still failing after %d attempts", self.name, attempt + 1)
+        if error is not None:
+            raise error
+        return result
+
+    def stats(self):
+        """Counters since start (calls include retries)"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['wait_seconds'] = round(stats['wait_seconds'], 3)
+        stats['backoff_seconds'] = round(stats['backoff_seconds'], 3)
+        return stats
+
+
+def _remaining():
+    """Seconds left before this context's API deadline (None if there is none)"""
+    until = _deadline.get()
+    return None if until is None else max(0.0, until - time.monotonic())
+
+
+@contextmanager
+def api_deadline(seconds):
+    """
+    Bound how long API calls made inside the block may wait
+
+    Backoff sleeps and rate-limit waits that would end after the deadline
+    are skipped; the call raises its last error (or ApiDeadlineExceeded)
+    instead. Threads the block starts don't inherit it. Nested blocks keep
+    the earlier deadline.
+    """
+    until = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(until if current is None else min(current, until))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _call_labels(api, func):
+    """Metric labels for a call: API, method name and worksheet/spreadsheet title"""
+    owner = getattr(func, '__self__', None)
+    try:
+        worksheet = getattr(owner, 'title', '') or ''
+    except Exception:
+        worksheet = ''
+    return {'api': api, 'operation': getattr(func, '__name__', 'call'), 'worksheet': worksheet}
+
+
+def _outcome(error, status):
+    if status is not None:
+        return str(status)
+    return 'ok' if error is None else type(error).__name__
+
+
+def _classify(result, error):
+    """(retry?, HTTP status, Retry-After seconds) for a call outcome"""
+    if error is not None:
+        response = getattr(error, 'response', None)
+        status = getattr(response, 'status_code', None)
+        if status is None:
+            transient = isinstance(error, (requests.ConnectionError, requests.Timeout))
+            return transient, None, None
+    else:
+        response = result
+        status = getattr(result, 'status_code', None)
+        if status is None:
+            return False, None, None
+
+    if status not in RETRY_STATUSES:
+        return False, status, None
+    return True, status, parse_retry_after(response)
+
+
+def maybe_applied(error):
+    """
+    Whether a call that raised `error` may still have taken effect
+
+    True for server errors, timeouts and connections dropped after the
+    request was sent: the server may have done the work and only the
+    reply was lost.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status is not None and status >= 500
+
+
+def parse_retry_after(response):
+    """
+    Retry-After header as seconds (delta-seconds or HTTP date)
+
+    Returns:
+        float or None if absent/unparseable
+    """
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(api):
+    """
+    Get the limiter for an API (singleton per name, see API_LIMITS)
+
+    Args:
+        api: 'sheets' or 'line'
+
+    Returns:
+        ApiLimiter
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(api)
+        if limiter is None:
+            rate, capacity = API_LIMITS[api]
+            limiter = ApiLimiter(api, rate, capacity)
+            _limiters[api] = limiter
+        return limiter
+
+
+def call_api(api, func, *args, idempotent=True, **kwargs):
+    """
+    Call an external API function through that API's limiter
+
+    Args:
+        api: 'sheets' or 'line'
+        func: The call to make (e.g. worksheet.append_rows)
+        idempotent: False for calls that must not be repeated blindly
+                    (see ApiLimiter.call)
+
+    Returns:
+        func's result
+    """
+    return get_limiter(api).call(func, *args, idempotent=idempotent, **kwargs)
+
+
+def get_rate_limit_metrics():
+    """Counters per API: {api: {calls, retries, throttled, failures, ...}}"""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Tracing Module
+Nested timing spans for one request at a time
+
+trace() opens the root span for a webhook request; span() and @traced
+add children wherever they run inside it (the current span lives in a
+contextvar, so concurrent requests don't mix). Outside a trace they do
+nothing, which keeps background threads and scheduler jobs free of cost.
+
+Finished traces are kept in memory for /debug/traces; requests slower
+than TRACE_SLOW_MS are also logged as a JSON span tree.
+"""
+import contextvars
+import functools
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from config import (
+    LOCAL_TZ,
+    TRACING_ENABLED,
+    TRACE_SLOW_MS,
+    TRACE_BUFFER_SIZE,
+    TRACE_MAX_SPANS,
+    get_logger
+)
+
+logger = get_logger(__name__)
+
+_current_span = contextvars.ContextVar('kwannurse_current_span', default=None)
+
+_recent = deque(maxlen=TRACE_BUFFER_SIZE)
+_recent_lock = threading.Lock()
+
+
+class Span:
+    """One timed step; children are the steps it called"""
+
+    __slots__ = ('name', 'attrs', 'root', 'started', 'duration_ms', 'error', 'children', 'span_count', 'dropped')
+
+    def __init__(self, name, attrs, root=None):
+        self.name = name
+        self.attrs = attrs
+        self.root = root or self
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self.error = None
+        self.children = []
+        self.span_count = 1  # Root only: spans in this trace
+        self.dropped = 0  # Root only: spans over TRACE_MAX_SPANS
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self.started) * 1000
+
+    def to_dict(self, origin):
+        """Span tree as plain data; start_ms is relative to `origin`"""
+        data = {
+            'name': self.name,
+            'start_ms': round((self.started - origin) * 1000, 2),
+            'duration_ms': round(self.duration_ms, 2) if self.duration_ms is not None else None
+        }
+        if self.attrs:
+            data['attrs'] = {key: str(value) for key, value in self.attrs.items()}
+        if self.error:
+            data['error'] = self.error
+        if self.children:
+            data['children'] = [child.to_dict(origin) for child in self.children]
+        return data
+
+
+@contextmanager
+def trace(name, **attrs):
+    """
+    Root span for one request
+
+    Usage:
+        with trace("webhook ContactNurse", user_id=user_id):
+            reply = dispatch(req)
+    """
+    if not TRACING_ENABLED:
+        yield None
+        return
+
+    root = Span(name, attrs)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root.error = type(e).__name__
+        raise
+    finally:
+        root.finish()
+        _current_span.reset(token)
+        _finish_trace(root)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Child span of the current one (no-op outside a trace)
+
+    Usage:
+        with span("sheets.append_rows", worksheet="Symptoms"):
+            ...
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    root = parent.root
+    if root.span_count >= TRACE_MAX_SPANS:
+        root.dropped += 1
+        yield None
+        return
+    root.span_count += 1
+
+    current = Span(name, attrs, root)
+    parent.children.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.finish()
+        _current_span.reset(token)
+
+
+def traced(func=None, name=None):
+    """
+    Decorator: run the function in a span named after it
+
+    Usage:
+        @traced
+        def get_queue_status(): ...
+
+        @traced(name="queue.admit")
+        def admit_to_queue(...): ...
+    """
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator(func) if func is not None else decorator
+
+
+def _finish_trace(root):
+    record = root.to_dict(root.started)
+    record['trace_id'] = uuid.uuid4().hex[:16]
+    record['timestamp'] = datetime.now(tz=LOCAL_TZ).isoformat()
+    if root.dropped:
+        record['dropped_spans'] = root.dropped
+
+    with _recent_lock:
+        _recent.append(record)
+
+    if root.duration_ms >= TRACE_SLOW_MS:
+        logger.warning("Slow request %s took %.0f ms: %s",
+                       root.name, root.duration_ms, json.dumps(record, ensure_ascii=False))
+
+
+def get_recent_traces(min_ms=0, limit=None):
+    """
+    Finished traces of this process, newest first
+
+    Args:
+        min_ms: Only traces at least this slow
+        limit: Return at most this many
+
+    Returns:
+        list: Span trees (dicts with name, start_ms, duration_ms, children, ...)
+    """
+    with _recent_lock:
+        traces = [t for t in reversed(_recent) if t['duration_ms'] >= min_ms]
+    return traces[:limit] if limit else traces